@@ -1,10 +1,13 @@
 from django.contrib import admin
 
 from .models import KioskItem
+from .utils import invalidate_kiosk_items
 
 
 def set_active_kiosk_item(modeladmin, request, queryset):
     queryset.update(active=True)
+    # update() doesn't send the signals that would do this
+    invalidate_kiosk_items()
 
 
 set_active_kiosk_item.short_description = "Make selected kiosk items active"
@@ -12,6 +15,7 @@ set_active_kiosk_item.short_description = "Make selected kiosk items active"
 
 def set_inactive_kiosk_item(modeladmin, request, queryset):
     queryset.update(active=False)
+    invalidate_kiosk_items()
 
 
 set_inactive_kiosk_item.short_description = "Make selected kiosk items inactive"
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from kiosk.models import KioskItem
+
+
+class Command(BaseCommand):
+    help = "Make the screen sized images of the kiosk items that don't have one"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--all", action="store_true", default=False,
+                            help="Remake the images of every kiosk item")
+
+    def handle(self, *args, **options):
+        items = KioskItem.objects.exclude(image="")
+        if not options["all"]:
+            items = items.filter(screen_image__isnull=True)
+
+        made = 0
+        for item in items.iterator():
+            item.update_screen_image()
+            if item.screen_image:
+                made += 1
+            else:
+                self.stderr.write("Could not read the image of {}: {}".format(
+                    item.id, item.image.name))
+
+        self.stdout.write("Made {} screen images".format(made))
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-16 21:02
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kiosk', '0003_kioskitem_ordering'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='kioskitem',
+            name='screen_image',
+            field=models.ImageField(blank=True, editable=False, null=True, upload_to='kiosk/screen'),
+        ),
+    ]
@@ -1,8 +1,15 @@
 from __future__ import unicode_literals
 
+import os
+
 from django.db import models
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.urls import reverse
 import random
 
+from .utils import invalidate_kiosk_items, make_screen_image
+
 
 def random_ordering():
     return random.randint(1, 1000)
@@ -15,3 +22,35 @@ class KioskItem(models.Model):
     active = models.BooleanField(default=True)
     image = models.ImageField(upload_to='kiosk', null=False)
     ordering = models.IntegerField(null=False, default=random_ordering, blank=False)
+    # The image re-encoded for the kiosk screens, made when it's uploaded
+    screen_image = models.ImageField(upload_to='kiosk/screen', blank=True, null=True, editable=False)
+
+    def save(self, *args, **kwargs):
+        new_image = bool(self.image) and not self.image._committed
+        super(KioskItem, self).save(*args, **kwargs)
+        if new_image or (self.image and not self.screen_image):
+            self.update_screen_image()
+
+    def update_screen_image(self):
+        """
+        Make the screen sized image from the uploaded one
+        """
+        try:
+            name = make_screen_image(self.image, self._meta.get_field('screen_image').upload_to)
+        except (IOError, OSError):
+            # Not an image Pillow can read, the screens get the original
+            name = None
+        self.screen_image = name
+        KioskItem.objects.filter(pk=self.pk).update(screen_image=name)
+        invalidate_kiosk_items()
+
+    def screen_url(self):
+        if not self.screen_image:
+            return self.image.url
+        return reverse('kiosk_screen_image', args=(os.path.basename(self.screen_image.name),))
+
+
+@receiver(post_save, sender=KioskItem)
+@receiver(post_delete, sender=KioskItem)
+def kiosk_item_changed(sender, **kwargs):
+    invalidate_kiosk_items()
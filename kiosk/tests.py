@@ -1,12 +1,35 @@
 # -*- coding: utf8 -*-
 
+from io import BytesIO
+
+from django.core.cache import cache
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
 from django.test import TestCase, Client
+from django.utils.six import StringIO
+from PIL import Image
 
+from kiosk import admin
 from kiosk.models import KioskItem
 
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+
+def make_png(color, size=(4, 4), mode="RGB"):
+    output = BytesIO()
+    Image.new(mode, size, color).save(output, "PNG")
+    return output.getvalue()
+
 
 class KioskTests(TestCase):
+    def setUp(self):
+        # The active items are cached, and the cache outlives the test
+        # transactions
+        cache.clear()
+
     def test_kiosk_empty(self):
         c = Client()
         response = c.get('/kiosk/next')
@@ -25,8 +48,7 @@ class KioskTests(TestCase):
         response = c.get('/kiosk/{}'.format(mode))
         self.assertEqual(200, response.status_code)
 
-        # Django generates a random string to add to the filename
-        self.assertIn(b'/media/kiosk/test_image_', response.content)
+        self.assertIn(b'/kiosk/screen/', response.content)
 
     def test_kiosk_one_item_mode_next(self):
         self.kiosk_one_item("next")
@@ -53,11 +75,202 @@ class KioskTests(TestCase):
         response = c.get('/kiosk/{}'.format(mode))
         self.assertEqual(200, response.status_code)
 
-        # Django generates a random string to add to the filename
-        self.assertIn(b'/media/kiosk/test_image', response.content)
+        self.assertIn(b'/kiosk/screen/', response.content)
 
     def test_kiosk_two_items_mode_next(self):
         self.kiosk_two_items("next")
 
     def test_kiosk_two_items_mode_random(self):
         self.kiosk_two_items("random")
+
+
+class KioskRandomTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def create_item(self, name, active=True):
+        image = SimpleUploadedFile(name='{}.png'.format(name),
+                                   content=open("media/kiosk/test_image.png", 'rb').read(),
+                                   content_type='image/png')
+        return KioskItem.objects.create(name=name, image=image, active=active)
+
+    def test_random_cached(self):
+        item = self.create_item("test_image_cached")
+        c = Client()
+        c.get('/kiosk/random')
+
+        with self.assertNumQueries(0):
+            response = c.get('/kiosk/random')
+
+        self.assertEqual(item.screen_url().encode("utf-8"), response.content)
+
+    def test_random_only_active(self):
+        item = self.create_item("test_image_active")
+        inactive = self.create_item("test_image_inactive", active=False)
+        inactive.image = SimpleUploadedFile(name='test_image_other.png',
+                                            content=make_png((1, 2, 3)),
+                                            content_type='image/png')
+        inactive.save()
+        c = Client()
+
+        for _ in range(10):
+            response = c.get('/kiosk/random')
+            self.assertEqual(item.screen_url().encode("utf-8"), response.content)
+
+    def test_random_invalidated_on_save(self):
+        item = self.create_item("test_image_saved")
+        c = Client()
+        c.get('/kiosk/random')
+
+        item.active = False
+        item.save()
+
+        self.assertEqual(404, c.get('/kiosk/random').status_code)
+
+    def test_random_invalidated_by_admin_actions(self):
+        self.create_item("test_image_toggled")
+        c = Client()
+        c.get('/kiosk/random')
+
+        admin.set_inactive_kiosk_item(None, None, KioskItem.objects.all())
+        self.assertEqual(404, c.get('/kiosk/random').status_code)
+
+        admin.set_active_kiosk_item(None, None, KioskItem.objects.all())
+        self.assertEqual(200, c.get('/kiosk/random').status_code)
+
+
+class KioskPlaylistTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def create_item(self, name, ordering, active=True):
+        image = SimpleUploadedFile(name='{}.png'.format(name),
+                                   content=open("media/kiosk/test_image.png", 'rb').read(),
+                                   content_type='image/png')
+        return KioskItem.objects.create(name=name, image=image, active=active, ordering=ordering)
+
+    def test_playlist(self):
+        second = self.create_item("test_image_second", 2)
+        first = self.create_item("test_image_first", 1)
+        self.create_item("test_image_inactive", 0, active=False)
+
+        response = Client().get('/kiosk/playlist')
+
+        data = response.json()
+        self.assertEqual(10, data["duration"])
+        self.assertEqual(0, data["epoch"])
+        self.assertEqual([first.id, second.id], [item["id"] for item in data["items"]])
+        self.assertEqual(first.screen_url(), data["items"][0]["url"])
+        self.assertIn("X-Server-Time", response)
+
+    def test_playlist_not_modified(self):
+        self.create_item("test_image_unchanged", 1)
+        c = Client()
+        version = c.get('/kiosk/playlist').json()["version"]
+
+        with self.assertNumQueries(0):
+            response = c.get('/kiosk/playlist', HTTP_IF_NONE_MATCH='"{}"'.format(version))
+
+        self.assertEqual(304, response.status_code)
+        self.assertIn("X-Server-Time", response)
+
+    def test_playlist_version_changes(self):
+        item = self.create_item("test_image_changed", 1)
+        c = Client()
+        version = c.get('/kiosk/playlist').json()["version"]
+
+        item.ordering = 5
+        item.save()
+        self.create_item("test_image_new", 2)
+        response = c.get('/kiosk/playlist', HTTP_IF_NONE_MATCH='"{}"'.format(version))
+
+        self.assertEqual(200, response.status_code)
+        self.assertNotEqual(version, response.json()["version"])
+
+    def test_next_follows_playlist(self):
+        self.create_item("test_image_first", 1)
+        self.create_item("test_image_second", 2)
+        c = Client()
+        items = c.get('/kiosk/playlist').json()["items"]
+
+        # 25 seconds into a cycle of two items, showing 10 seconds each
+        with patch("kiosk.views.time.mktime", return_value=25.0):
+            response = c.get('/kiosk/next')
+
+        self.assertEqual(items[0]["url"].encode("utf-8"), response.content)
+
+
+class KioskScreenImageTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def create_item(self, content, name="test_image_screen.png"):
+        image = SimpleUploadedFile(name=name, content=content, content_type='image/png')
+        return KioskItem.objects.create(name="screen", image=image)
+
+    def open_screen_image(self, item):
+        item.screen_image.open('rb')
+        try:
+            image = Image.open(item.screen_image)
+            image.load()
+        finally:
+            item.screen_image.close()
+        return image
+
+    def test_large_image_covers_screen(self):
+        item = self.create_item(make_png((10, 20, 30), size=(4000, 3000)))
+
+        image = self.open_screen_image(item)
+        self.assertEqual("JPEG", image.format)
+        self.assertEqual((1920, 1440), image.size)
+
+    def test_small_image_not_enlarged(self):
+        item = self.create_item(make_png((10, 20, 30), size=(640, 480)))
+
+        self.assertEqual((640, 480), self.open_screen_image(item).size)
+
+    def test_transparent_image_on_white(self):
+        item = self.create_item(make_png((0, 0, 0, 0), mode="RGBA"))
+
+        image = self.open_screen_image(item)
+        self.assertEqual("RGB", image.mode)
+        self.assertEqual((255, 255, 255), image.getpixel((0, 0)))
+
+    def test_name_follows_content(self):
+        first = self.create_item(make_png((1, 1, 1)))
+        same = self.create_item(make_png((1, 1, 1)))
+        other = self.create_item(make_png((200, 1, 1)))
+
+        self.assertEqual(first.screen_image.name, same.screen_image.name)
+        self.assertNotEqual(first.screen_image.name, other.screen_image.name)
+
+    def test_served_with_long_cache(self):
+        item = self.create_item(make_png((10, 20, 30)))
+
+        response = Client().get(item.screen_url())
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual("image/jpeg", response["Content-Type"])
+        self.assertIn("max-age=31536000", response["Cache-Control"])
+        response.close()
+
+    def test_missing_served_as_404(self):
+        response = Client().get('/kiosk/screen/{}.jpg'.format("0" * 40))
+        self.assertEqual(404, response.status_code)
+
+    def test_unreadable_image_uses_original(self):
+        item = self.create_item(b"not an image", name="test_image_broken.png")
+
+        self.assertFalse(item.screen_image)
+        self.assertEqual(item.image.url, item.screen_url())
+
+    def test_backfill_command(self):
+        item = self.create_item(make_png((10, 20, 30)))
+        name = item.screen_image.name
+        KioskItem.objects.filter(pk=item.pk).update(screen_image=None)
+
+        out = StringIO()
+        call_command("make_kiosk_screen_images", stdout=out)
+
+        self.assertEqual(name, KioskItem.objects.get(pk=item.pk).screen_image.name)
+        self.assertIn("Made 1 screen images", out.getvalue())
@@ -6,4 +6,6 @@ urlpatterns = [
     url(r'^$', views.kiosk),
     url(r'^random$', views.find_random_image),
     url(r'^next$', views.find_next_image),
+    url(r'^playlist$', views.playlist),
+    url(r'^screen/(?P<name>[0-9a-f]{40}\.jpg)$', views.screen_image, name="kiosk_screen_image"),
 ]
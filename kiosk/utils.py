@@ -0,0 +1,84 @@
+import hashlib
+from io import BytesIO
+
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from PIL import Image
+
+# Invalidation is done with signals, which only reach the cache of other
+# processes if the cache backend is shared, so don't let a stale list live
+# forever.
+KIOSK_ITEMS_CACHE_TIMEOUT = 5 * 60
+_KIOSK_ITEMS_KEY = "kiosk.active_items"
+
+
+def active_kiosk_items():
+    """
+    The (id, image url) of every active kiosk item, in the order they are
+    shown. Cached until invalidate_kiosk_items is called.
+
+    The url is the one of the screen sized image when there is one.
+    """
+    from .models import KioskItem
+
+    items = cache.get(_KIOSK_ITEMS_KEY)
+    if items is None:
+        items = [
+            (item.id, item.screen_url())
+            for item in (KioskItem.objects
+                         .filter(active=True)
+                         .order_by('ordering', 'name')
+                         .only('id', 'image', 'screen_image'))
+        ]
+        cache.set(_KIOSK_ITEMS_KEY, items, KIOSK_ITEMS_CACHE_TIMEOUT)
+    return items
+
+
+def invalidate_kiosk_items():
+    cache.delete(_KIOSK_ITEMS_KEY)
+
+
+# The size of the kiosk screens. The images are shown covering the whole
+# screen, so there's no reason to send anything larger.
+SCREEN_SIZE = (1920, 1080)
+SCREEN_IMAGE_QUALITY = 85
+
+
+def make_screen_image(image_file, upload_to):
+    """
+    Re-encode image_file as a JPEG just large enough to cover the screen, and
+    store it in upload_to under a name made from its content, so the name
+    changes when the image does. Returns the name of the stored file.
+    """
+    image_file.open('rb')
+    try:
+        image = Image.open(image_file)
+        image.load()
+    finally:
+        image_file.close()
+
+    if image.mode in ("RGBA", "LA") or "transparency" in image.info:
+        # JPEG has no transparency, so put it on the white of the page
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.split()[-1])
+        image = background
+    else:
+        image = image.convert("RGB")
+
+    width, height = image.size
+    ratio = max(SCREEN_SIZE[0] / float(width), SCREEN_SIZE[1] / float(height))
+    if ratio < 1:
+        image = image.resize(
+            (int(round(width * ratio)), int(round(height * ratio))),
+            Image.LANCZOS)
+
+    output = BytesIO()
+    image.save(output, "JPEG", quality=SCREEN_IMAGE_QUALITY, optimize=True,
+               progressive=True)
+    content = output.getvalue()
+
+    name = "{}/{}.jpg".format(upload_to, hashlib.sha1(content).hexdigest())
+    if not image_file.storage.exists(name):
+        image_file.storage.save(name, ContentFile(content))
+    return name
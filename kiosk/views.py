@@ -1,11 +1,20 @@
+import hashlib
+import json
+import random
 import time
 from datetime import datetime
 
 from django.http import Http404
-from django.http import HttpResponse
+from django.http import FileResponse, HttpResponse, JsonResponse
 from django.shortcuts import render
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
 
 from .models import KioskItem
+from .utils import active_kiosk_items
+
+# How many seconds each kiosk item is shown
+SLIDE_DURATION = 10
 
 
 def kiosk(request):
@@ -16,11 +25,12 @@ def find_random_image(request):
     """
     Randomly get an image and return the relative url
     """
-    item = KioskItem.objects.filter(active=True).order_by('?').first()
-    if item is None:
+    items = active_kiosk_items()
+    if not items:
         raise Http404("No active kiosk items found")
 
-    return HttpResponse(item.image.url, content_type="text/plain")
+    _, url = random.choice(items)
+    return HttpResponse(url, content_type="text/plain")
 
 
 def find_next_image(request):
@@ -32,20 +42,64 @@ def find_next_image(request):
     :param request: Django request obj
     :return: The request or 404 if no active kiosk items was found.
     """
-    item_count = KioskItem.objects.filter(active=True).count()
-    if item_count == 0:
+    items = active_kiosk_items()
+    if not items:
         raise Http404("No active kiosk items found")
 
-    # The duration for each item
-    # TODO: Make this a variable for someone to adjust (Where?)
-    duration = 10
     # The total cycle time
-    complete_cycle_time = duration * item_count
+    complete_cycle_time = SLIDE_DURATION * len(items)
     # Get a unit timestamp
     seconds_since_epoch = time.mktime(datetime.now().timetuple())
     # Find the next index, by getting a number in the range [0;complete_cycle_time[
     # and divide it by the duration of each
-    next_index = int((seconds_since_epoch % complete_cycle_time) / duration)
-    # Get the item at the index, trust that Django does this smartly.
-    next_item = KioskItem.objects.filter(active=True).order_by('ordering', 'name')[next_index]
-    return HttpResponse(next_item.image.url, content_type="text/plain")
+    next_index = int((seconds_since_epoch % complete_cycle_time) / SLIDE_DURATION)
+    _, url = items[next_index]
+    return HttpResponse(url, content_type="text/plain")
+
+
+def playlist(request):
+    """
+    The active kiosk items in the order they are shown, for the screens to
+    work out the current item themselves. Item i of n is shown while
+    ((time - epoch) % (n * duration)) // duration is i, the same as
+    find_next_image.
+
+    The version only changes when the items do, and is sent as the ETag, so
+    polling for changes is cheap. The server time is also sent in the
+    X-Server-Time header, for the screens to correct their clocks.
+    """
+    items = [{"id": item_id, "url": url} for item_id, url in active_kiosk_items()]
+    version = hashlib.md5(
+        json.dumps([SLIDE_DURATION, items]).encode("utf-8")).hexdigest()
+
+    response = JsonResponse({
+        "version": version,
+        "duration": SLIDE_DURATION,
+        "epoch": 0,
+        "server_time": time.time(),
+        "items": items,
+    })
+    response["ETag"] = quote_etag(version)
+    # The screens keep the playlist themselves, and send If-None-Match
+    response["Cache-Control"] = "no-store"
+    response = get_conditional_response(request, etag=version, response=response)
+    # The screens set their clocks by this, so it's sent even when the
+    # playlist hasn't changed
+    response["X-Server-Time"] = "{:.3f}".format(time.time())
+    return response
+
+
+def screen_image(request, name):
+    """
+    A screen sized kiosk image. The name is made from the content, so the
+    screens may keep it for as long as they like.
+    """
+    field = KioskItem._meta.get_field('screen_image')
+    try:
+        image = field.storage.open("{}/{}".format(field.upload_to, name))
+    except (IOError, OSError):
+        raise Http404("No such kiosk image")
+
+    response = FileResponse(image, content_type="image/jpeg")
+    response["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response
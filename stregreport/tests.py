@@ -1,7 +1,36 @@
+import datetime
+import json
+import random
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import Count, Sum
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
+from freezegun import freeze_time
 
 from stregreport import views
+from stregsystem.models import (
+    Category,
+    Member,
+    Order,
+    Payment,
+    Product,
+    RankGroup,
+    RankSnapshot,
+    Sale,
+    SaleRollup,
+    SalesSeriesChange
+)
+from stregsystem.utils import publish_sale_event
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
 
 
 class ParseIdStringTests(TestCase):
@@ -76,3 +105,490 @@ class SalesReportTests(TestCase):
 
         self.assertEqual(response.status_code, 200)
         self.assertTemplateUsed("admin/stregsystem/report/sales.html")
+
+
+class RollupReportTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        rng = random.Random(1)
+        self.members = [
+            Member.objects.create(username="member{}".format(i), active=i != 0)
+            for i in range(4)
+        ]
+        self.products = [
+            Product.objects.create(name="product{}".format(i), price=100 + i, active=True)
+            for i in range(3)
+        ]
+        start = datetime.datetime(2017, 3, 1, tzinfo=timezone.utc)
+        for _ in range(200):
+            timestamp = start + datetime.timedelta(seconds=rng.randrange(10 * 24 * 60 * 60))
+            with patch('django.utils.timezone.now', return_value=timestamp):
+                Sale.objects.create(
+                    member=rng.choice(self.members),
+                    product=rng.choice(self.products),
+                    price=rng.randrange(50, 150),
+                )
+
+    def raw_totals(self, from_time, to_time, field, **filters):
+        rows = (
+            Sale.objects
+            .filter(timestamp__gt=from_time, timestamp__lte=to_time, **filters)
+            .values(field)
+            .annotate(c=Count("id"), s=Sum("price"))
+        )
+        return {(row[field],): (row["c"], row["s"]) for row in rows}
+
+    def test_sales_in_period_matches_sales(self):
+        periods = [
+            (datetime.datetime(2017, 3, 2, 13, 30), datetime.datetime(2017, 3, 8, 9, 15)),
+            (datetime.datetime(2017, 3, 2, 0, 0), datetime.datetime(2017, 3, 9, 0, 0)),
+            (datetime.datetime(2017, 3, 4, 1, 0), datetime.datetime(2017, 3, 4, 22, 0)),
+            (datetime.datetime(2017, 3, 4, 22, 0), datetime.datetime(2017, 3, 5, 3, 0)),
+            (datetime.datetime(2017, 2, 1, 0, 0), datetime.datetime(2017, 4, 1, 0, 0)),
+        ]
+        for from_time, to_time in periods:
+            from_time = timezone.make_aware(from_time)
+            to_time = timezone.make_aware(to_time)
+            self.assertEqual(
+                self.raw_totals(from_time, to_time, "member"),
+                views._sales_in_period(from_time, to_time, ["member"]))
+            ids = [self.products[0].id, self.products[2].id]
+            self.assertEqual(
+                self.raw_totals(from_time, to_time, "product", product__in=ids),
+                views._sales_in_period(from_time, to_time, ["product"], product__in=ids))
+
+    def test_sales_in_period_until_now(self):
+        # There are no sales after now
+        now = Sale.objects.latest("timestamp").timestamp
+        from_time = now - datetime.timedelta(days=3)
+        with patch('django.utils.timezone.now', return_value=now):
+            totals = views._sales_in_period(from_time, now, [])
+
+        count, price_sum = 0, 0
+        for c, s in self.raw_totals(from_time, now, "product").values():
+            count += c
+            price_sum += s
+        self.assertEqual({(): (count, price_sum)}, totals)
+
+    def test_sale_product_rank(self):
+        from_time = datetime.datetime(2017, 3, 2, 10)
+        to_time = datetime.datetime(2017, 3, 9, 10)
+        ids = [self.products[1].id]
+        counts = self.raw_totals(timezone.make_aware(from_time), timezone.make_aware(to_time),
+                                 "member", product__in=ids)
+
+        stat_list = views.sale_product_rank(ids, from_time, to_time, rank_limit=2)
+
+        expected = sorted(counts.items(), key=lambda i: (-i[1][0], Member.objects.get(pk=i[0][0]).username))[:2]
+        self.assertEqual(
+            [(member_id, count) for (member_id,), (count, _) in expected],
+            [(member.id, member.sale__count) for member in stat_list])
+
+    def test_sale_money_rank_only_active(self):
+        from_time = datetime.datetime(2017, 3, 2, 10)
+        to_time = datetime.datetime(2017, 3, 9, 10)
+
+        stat_list = views.sale_money_rank(from_time, to_time)
+
+        self.assertNotIn(self.members[0], stat_list)
+        sums = self.raw_totals(timezone.make_aware(from_time), timezone.make_aware(to_time),
+                               "member", member__active=True)
+        for member in stat_list:
+            self.assertEqual(sums[(member.id,)][1], member.sale__price__sum)
+
+    @freeze_time("2017-03-11 12:00:00")
+    def test_sales_api(self):
+        response = self.client.get("/admin/stregsystem/report/sales_api")
+
+        data = response.json()
+        start = timezone.now() - datetime.timedelta(days=30)
+        self.assertEqual(Sale.objects.filter(timestamp__gt=start).count(), sum(data["sales"]))
+        day = data["day"].index("2017-03-04")
+        self.assertEqual(
+            Sale.objects.filter(timestamp__date=datetime.date(2017, 3, 4)).count(),
+            data["sales"][day])
+
+    def test_daily(self):
+        User.objects.create_superuser("staff", "staff@example.com", "password")
+        self.client.login(username="staff", password="password")
+        with freeze_time("2017-03-11 10:00:00"):
+            for _ in range(3):
+                Sale.objects.create(member=self.members[1], product=self.products[2], price=10)
+            Sale.objects.create(member=self.members[1], product=self.products[1], price=10)
+
+            response = self.client.get("/admin/stregsystem/report/daily/")
+
+        self.assertEqual(
+            [(self.products[2], 3), (self.products[1], 1)],
+            [(product, product.sale__count) for product in response.context["top_today"]])
+        self.assertEqual(
+            Sale.objects.aggregate(Sum("price"))["price__sum"],
+            response.context["revenue_month"])
+
+
+class RanksTests(TestCase):
+    def setUp(self):
+        # Leave out the groups made by the migrations
+        RankGroup.objects.all().delete()
+        self.alan = Member.objects.create(username="alan")
+        self.bob = Member.objects.create(username="bob")
+        self.beer = Product.objects.create(name="beer", price=100, active=True)
+        self.cola = Product.objects.create(name="cola", price=50, active=True)
+        self.beer_group = RankGroup.objects.create(name="Beer", position=1)
+        self.beer_group.products.add(self.beer)
+        self.cola_group = RankGroup.objects.create(name="Cola", position=2)
+        self.cola_group.products.add(self.cola)
+
+        with freeze_time("2017-03-03 12:00:00"):
+            for _ in range(3):
+                Sale.objects.create(member=self.alan, product=self.beer, price=100)
+            Sale.objects.create(member=self.bob, product=self.beer, price=100)
+            self.refunded = Sale.objects.create(member=self.bob, product=self.cola, price=50)
+
+        User.objects.create_superuser("staff", "staff@example.com", "password")
+        self.client.login(username="staff", password="password")
+
+    def ranks(self, year=2017):
+        response = self.client.get("/admin/stregsystem/report/ranks/{}".format(year))
+        return {
+            group.name: [(member.username, member.sale__count) for member in stat_list]
+            for group, stat_list in response.context["stat_lists"]
+        }, [(member.username, member.sale__price__sum) for member in response.context["kr_stat_list"]]
+
+    def test_ranks_use_rank_groups(self):
+        groups, kr = self.ranks()
+
+        self.assertEqual({
+            "Beer": [("alan", 3), ("bob", 1)],
+            "Cola": [("bob", 1)],
+        }, groups)
+        self.assertEqual([("alan", 300), ("bob", 150)], kr)
+
+    def test_finished_year_is_frozen(self):
+        live = self.ranks()
+
+        self.assertTrue(RankSnapshot.objects.filter(year=2017).exists())
+        with CaptureQueriesContext(connection) as queries:
+            frozen = self.ranks()
+        self.assertEqual(live, frozen)
+        self.assertFalse(any("stregsystem_sale" in query["sql"] for query in queries))
+
+    def test_refund_unfreezes_year(self):
+        self.ranks()
+
+        self.refunded.delete()
+
+        self.assertFalse(RankSnapshot.objects.exists())
+        groups, kr = self.ranks()
+        self.assertEqual([], groups["Cola"])
+        self.assertEqual([("alan", 300), ("bob", 100)], kr)
+
+    def test_rank_group_change_unfreezes_years(self):
+        self.ranks()
+
+        self.cola_group.products.add(self.beer)
+
+        self.assertFalse(RankSnapshot.objects.exists())
+        groups, kr = self.ranks()
+        self.assertEqual([("alan", 3), ("bob", 2)], groups["Cola"])
+
+    @freeze_time("2017-06-01 12:00:00")
+    def test_ongoing_year_is_not_frozen(self):
+        groups, kr = self.ranks()
+
+        self.assertEqual([("alan", 3), ("bob", 1)], groups["Beer"])
+        self.assertFalse(RankSnapshot.objects.exists())
+
+
+class CategoryPivotTests(TestCase):
+    def setUp(self):
+        self.alan = Member.objects.create(username="alan")
+        self.bob = Member.objects.create(username="bob")
+        self.carl = Member.objects.create(username="carl")
+        self.soda = Category.objects.create(name="Soda")
+        self.beer = Category.objects.create(name="Beer")
+        self.snacks = Category.objects.create(name="Snacks")
+        self.cola = Product.objects.create(name="cola", price=50, active=True)
+        self.cola.categories.add(self.soda)
+        self.shandy = Product.objects.create(name="shandy", price=80, active=True)
+        self.shandy.categories.add(self.soda, self.beer)
+        self.chips = Product.objects.create(name="chips", price=80, active=True)
+        self.chips.categories.add(self.snacks)
+
+        for member, product, count in [(self.alan, self.cola, 2),
+                                       (self.alan, self.shandy, 1),
+                                       (self.bob, self.shandy, 4),
+                                       (self.carl, self.chips, 5)]:
+            for _ in range(count):
+                Sale.objects.create(member=member, product=product, price=product.price)
+
+        User.objects.create_superuser("staff", "staff@example.com", "password")
+        self.client.login(username="staff", password="password")
+
+    def test_category_pivot(self):
+        rows = list(views.category_pivot([self.beer.id, self.soda.id]))
+
+        self.assertEqual([
+            (self.alan.id, "alan", 4, [1, 3]),
+            (self.bob.id, "bob", 8, [4, 4]),
+        ], rows)
+
+    def test_category_pivot_skips_refunded(self):
+        self.carl.sale_set.all().delete()
+
+        self.assertEqual([], list(views.category_pivot([self.snacks.id])))
+
+    def test_user_purchases_in_categories(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(
+                "/admin/stregsystem/report/categories/",
+                {"categories": [self.soda.id, self.beer.id]})
+
+        self.assertEqual(["Soda", "Beer"], list(response.context["header"]))
+        self.assertEqual([
+            ("bob", 8, [4, 4]),
+            ("alan", 4, [3, 1]),
+        ], response.context["data"])
+        # One query for the pivot, no matter how many categories
+        pivot_queries = [q for q in queries if "stregsystem_salerollup" in q["sql"]]
+        self.assertEqual(1, len(pivot_queries))
+
+
+class ExportTests(TestCase):
+    def setUp(self):
+        self.alan = Member.objects.create(username="alan")
+        self.bob = Member.objects.create(username="bob, \"b\"")
+        self.beer = Product.objects.create(name="beer", price=100, active=True)
+        self.cola = Product.objects.create(name="cola", price=50, active=True)
+        with freeze_time("2017-03-03 12:00:00"):
+            Sale.objects.create(member=self.alan, product=self.beer, price=100)
+            Payment.objects.create(member=self.alan, amount=5000)
+        with freeze_time("2017-03-04 12:00:00"):
+            Sale.objects.create(member=self.bob, product=self.cola, price=50)
+            Sale.objects.create(member=self.alan, product=self.cola, price=50)
+            Payment.objects.create(member=self.bob, amount=2000)
+
+        User.objects.create_superuser("staff", "staff@example.com", "password")
+        self.client.login(username="staff", password="password")
+
+    def content(self, response):
+        return b"".join(response.streaming_content).decode("utf-8")
+
+    def test_export_needs_staff(self):
+        self.client.logout()
+
+        response = self.client.get(reverse("export_sales", args=("csv",)))
+
+        self.assertEqual(302, response.status_code)
+
+    def test_export_sales_csv(self):
+        response = self.client.get(reverse("export_sales", args=("csv",)))
+
+        self.assertEqual("text/csv; charset=utf-8", response["Content-Type"])
+        lines = self.content(response).split("\r\n")
+        self.assertEqual("id,timestamp,member_id,username,product_id,product,room_id,price", lines[0])
+        self.assertEqual(5, len(lines))
+        self.assertIn(u'"bob, ""b""",{},cola,,50'.format(self.cola.id), lines[2])
+
+    def test_export_sales_json_period(self):
+        response = self.client.get(
+            reverse("export_sales", args=("json",)),
+            {"from_date": "2017-03-04", "to_date": "2017-03-04", "products": str(self.cola.id)})
+
+        rows = json.loads(self.content(response))
+        self.assertEqual(["bob, \"b\"", "alan"], [row["username"] for row in rows])
+        self.assertEqual([50, 50], [row["price"] for row in rows])
+
+    def test_export_sales_bad_date(self):
+        response = self.client.get(reverse("export_sales", args=("csv",)), {"from_date": "04-03-2017"})
+
+        self.assertEqual(400, response.status_code)
+
+    def test_export_sales_in_chunks(self):
+        rows = list(views._chunked(Sale.objects.all(), ["id", "price"], chunk_size=2))
+
+        self.assertEqual(list(Sale.objects.order_by("id").values_list("id", "price")), rows)
+
+    def test_export_payments(self):
+        response = self.client.get(reverse("export_payments", args=("json",)), {"to_date": "2017-03-03"})
+
+        rows = json.loads(self.content(response))
+        self.assertEqual([("alan", 5000)], [(row["username"], row["amount"]) for row in rows])
+
+    def test_export_categories(self):
+        soda = Category.objects.create(name="Soda")
+        self.cola.categories.add(soda)
+
+        response = self.client.get(reverse("export_categories", args=("csv",)), {"categories": [soda.id]})
+
+        self.assertEqual([
+            "member_id,username,total,Soda",
+            "{},alan,1,1".format(self.alan.id),
+            '{},"bob, ""b""",1,1'.format(self.bob.id),
+            "",
+        ], self.content(response).split("\r\n"))
+
+
+class SalesApiTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.alan = Member.objects.create(username="alan")
+        self.beer = Product.objects.create(name="beer", price=100, active=True)
+        self.sales = []
+        for day, hour, count in [(1, 10, 2), (2, 13, 1), (6, 9, 3), (6, 23, 1), (10, 11, 4)]:
+            with freeze_time(datetime.datetime(2017, 3, day, hour)):
+                for _ in range(count):
+                    self.sales.append(
+                        Sale.objects.create(member=self.alan, product=self.beer, price=100))
+
+    def get(self, **params):
+        with freeze_time("2017-03-10 12:00:00"):
+            return self.client.get("/admin/stregsystem/report/sales_api", params)
+
+    def series(self, **params):
+        data = self.get(**params).json()
+        return list(zip(data["day"], data["sales"]))
+
+    def test_days(self):
+        self.assertEqual([
+            ("2017-03-10", 4),
+            ("2017-03-09", 0),
+            ("2017-03-08", 0),
+            ("2017-03-07", 0),
+            ("2017-03-06", 4),
+        ], self.series(days=5))
+
+    def test_weeks(self):
+        # 2017-03-06 is a monday
+        self.assertEqual([
+            ("2017-03-06", 8),
+            ("2017-02-27", 3),
+        ], self.series(days=10, granularity="week"))
+
+    def test_hours(self):
+        series = self.series(days=5, granularity="hour")
+
+        self.assertEqual("2017-03-10T12:00:00Z", series[0][0])
+        self.assertEqual(4 * 24 + 13, len(series))
+        self.assertEqual(
+            [("2017-03-10T11:00:00Z", 4), ("2017-03-06T23:00:00Z", 1), ("2017-03-06T09:00:00Z", 3)],
+            [(hour, count) for hour, count in series if count])
+
+    def test_bad_parameters(self):
+        self.assertEqual(400, self.get(granularity="month").status_code)
+        self.assertEqual(400, self.get(days="many").status_code)
+
+    def test_past_days_cached(self):
+        self.get(days=30)
+        with CaptureQueriesContext(connection) as queries:
+            self.get(days=30)
+
+        rollup_queries = [q["sql"] for q in queries if "stregsystem_salerollup" in q["sql"]]
+        self.assertEqual(1, len(rollup_queries))
+        self.assertIn("2017-03-10", rollup_queries[0])
+        self.assertNotIn("2017-03-09", rollup_queries[0])
+
+    def test_refund_invalidates_cache(self):
+        self.assertEqual(("2017-03-06", 4), self.series(days=5)[-1])
+
+        self.sales[3].delete()
+
+        self.assertEqual(("2017-03-06", 3), self.series(days=5)[-1])
+
+    def test_change_in_other_process_invalidates_cache(self):
+        self.assertEqual(("2017-03-06", 4), self.series(days=5)[-1])
+
+        # Another process only shares the database, not the cache
+        SaleRollup.objects.filter(day=datetime.date(2017, 3, 6)).update(count=3)
+        SalesSeriesChange.record()
+
+        self.assertEqual(("2017-03-06", 3), self.series(days=5)[-1])
+
+    def test_conditional_get(self):
+        response = self.get()
+        self.assertEqual(200, response.status_code)
+        self.assertIn("Last-Modified", response)
+
+        with freeze_time("2017-03-10 12:00:00"):
+            not_modified = self.client.get(
+                "/admin/stregsystem/report/sales_api",
+                HTTP_IF_NONE_MATCH=response["ETag"],
+                HTTP_IF_MODIFIED_SINCE=response["Last-Modified"])
+        self.assertEqual(304, not_modified.status_code)
+
+        with freeze_time("2017-03-10 12:00:00"):
+            Sale.objects.create(member=self.alan, product=self.beer, price=100)
+            modified = self.client.get(
+                "/admin/stregsystem/report/sales_api",
+                HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(200, modified.status_code)
+
+    def test_conditional_get_new_day(self):
+        response = self.get()
+
+        with freeze_time("2017-03-11 00:30:00"):
+            next_day = self.client.get(
+                "/admin/stregsystem/report/sales_api",
+                HTTP_IF_MODIFIED_SINCE=response["Last-Modified"])
+        self.assertEqual(200, next_day.status_code)
+        self.assertEqual("2017-03-11", next_day.json()["day"][0])
+
+
+class DailyUpdatesTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        User.objects.create_superuser("staff", "staff@example.com", "password")
+        self.client.login(username="staff", password="password")
+        self.alan = Member.objects.create(username="alan")
+        self.beer = Product.objects.create(name="beer", price=100, active=True)
+
+    def updates(self, after):
+        return self.client.get(reverse("daily_updates"), {"after": after}).json()
+
+    def test_daily_starts_at_current_sequence(self):
+        publish_sale_event({"type": "sale"})
+
+        response = self.client.get("/admin/stregsystem/report/daily/")
+
+        self.assertEqual(1, response.context["sequence"])
+
+    def test_updates_sales(self):
+        with patch('django.db.transaction.on_commit', lambda f: f()):
+            Sale.objects.create(member=self.alan, product=self.beer, price=100)
+
+        with CaptureQueriesContext(connection) as queries:
+            data = self.updates(0)
+
+        self.assertEqual(1, data["sequence"])
+        self.assertFalse(data["reset"])
+        self.assertEqual("beer", data["events"][0]["products"][0]["name"])
+        self.assertFalse(any("stregsystem_" in q["sql"] for q in queries))
+
+    def test_empty_order_publishes_nothing(self):
+        with patch('django.db.transaction.on_commit', lambda f: f()):
+            Order(self.alan, None).execute()
+
+        self.assertEqual(0, self.updates(0)["sequence"])
+
+    def test_updates_nothing_new(self):
+        data = self.updates(0)
+
+        self.assertEqual({"sequence": 0, "reset": False, "events": [], "pending": False}, data)
+
+    def test_updates_lost_event(self):
+        publish_sale_event({"type": "sale"})
+        cache.delete("stregsystem.sale_events.1")
+
+        data = self.updates(0)
+
+        self.assertEqual({"sequence": 0, "reset": False, "events": [], "pending": True}, data)
+
+    def test_updates_started_over(self):
+        publish_sale_event({"type": "sale"})
+
+        self.assertEqual({"sequence": 1, "reset": True}, self.updates(5))
+
+    def test_updates_needs_sequence(self):
+        response = self.client.get(reverse("daily_updates"))
+
+        self.assertEqual(400, response.status_code)
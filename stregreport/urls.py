@@ -24,8 +24,15 @@ urlpatterns = [
     url(r'^admin/stregsystem/report/sales/$', views.sales, name="salesreporting"),
     url(r'^admin/stregsystem/report/ranks/$', views.ranks),
     url(r'^admin/stregsystem/report/daily/$', views.daily),
+    url(r'^admin/stregsystem/report/daily/updates$', views.daily_updates, name="daily_updates"),
     url(r'^admin/stregsystem/report/ranks/(?P<year>\d+)$', views.ranks),
     url(r'^admin/stregsystem/report/$', views.reports),
     url(r'^admin/stregsystem/report/sales_api$', views.sales_api),
     url(r'^admin/stregsystem/report/categories/$', views.user_purchases_in_categories),
+    url(r'^admin/stregsystem/report/export/sales\.(?P<export_format>csv|json)$', views.export_sales,
+        name="export_sales"),
+    url(r'^admin/stregsystem/report/export/payments\.(?P<export_format>csv|json)$', views.export_payments,
+        name="export_payments"),
+    url(r'^admin/stregsystem/report/export/categories\.(?P<export_format>csv|json)$', views.export_categories,
+        name="export_categories"),
 ]
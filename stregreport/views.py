@@ -1,17 +1,47 @@
+import calendar
 import datetime
+import hashlib
+import json
 from functools import reduce
+from itertools import groupby
 
 from django.contrib.admin.views.decorators import staff_member_required
-from django.db.models import Count, Q, Sum
-from django.db.models.functions import TruncDay
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import IntegrityError, transaction
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncHour
 from django.forms import extras, fields
-from django.http import JsonResponse
+from django.http import (
+    HttpResponseBadRequest,
+    JsonResponse,
+    StreamingHttpResponse
+)
 from django.shortcuts import redirect, render
 from django.urls import reverse
 from django.utils import dateparse, timezone
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
 
 from stregreport.forms import CategoryReportForm
-from stregsystem.models import Category, Member, Product, Sale
+from stregsystem.models import (
+    Category,
+    Member,
+    Payment,
+    Product,
+    RankGroup,
+    RankSnapshot,
+    RankSnapshotEntry,
+    Sale,
+    SaleRollup,
+    SalesSeriesChange
+)
+from stregsystem.utils import (
+    SALES_SERIES_CACHE_TIMEOUT,
+    sale_event_sequence,
+    sale_events_after,
+    sales_series_cache_key
+)
 
 
 def reports(request):
@@ -182,17 +212,18 @@ def sales_product(request, ids, from_time, to_time, error=None):
     sales = []
     if ids is not None and len(ids) > 0:
         products = reduce(lambda a, b: a + str(b) + ' ', ids, '')
-        query = reduce(lambda x, y: x | y, [Q(id=z) for z in ids])
-        query &= Q(sale__timestamp__gt=from_date_time)
-        query &= Q(sale__timestamp__lte=to_date_time)
-        result = Product.objects.filter(query).annotate(Count('sale'), Sum('sale__price'))
+        totals = _sales_in_period(from_date_time, to_date_time, ["product"], product__in=ids)
+        product_names = dict(
+            Product.objects
+            .filter(id__in=[product_id for (product_id,) in totals])
+            .values_list("id", "name"))
 
         count = 0
         sum = 0
-        for r in result:
-            sales.append((r.pk, r.name, r.sale__count, money(r.sale__price__sum)))
-            count = count + r.sale__count
-            sum = sum + r.sale__price__sum
+        for (product_id,), (sale_count, sale_sum) in sorted(totals.items()):
+            sales.append((product_id, product_names[product_id], sale_count, money(sale_sum)))
+            count = count + sale_count
+            sum = sum + sale_sum
 
         sales.append(('', 'TOTAL', count, money(sum)))
 
@@ -204,23 +235,17 @@ def sales_product(request, ids, from_time, to_time, error=None):
 def ranks_for_year(request, year):
     if (year <= 1900 or year > 9999):
         return render(request, 'admin/stregsystem/report/error_ranksnotfound.html', locals())
-    milk = [2, 3, 4, 5, 6, 7, 8, 9, 10, 16, 17, 18, 19, 20, 24, 25, 43, 44, 45, 1865]
-    caffeine = [11, 12, 30, 34, 37, 1787, 1790, 1791, 1795, 1799, 1800, 1803, 1804, 1837, 1864]
-    beer = [13, 14, 29, 42, 47, 54, 65, 66, 1773, 1776, 1777, 1779, 1780, 1783, 1793, 1794, 1807, 1808, 1809, 1820,
-            1822, 1840, 1844, 1846, 1847, 1853, 1855, 1856, 1858, 1859]
-    coffee = [32, 35, 36, 39]
-    vitamin = [1850, 1851, 1852, 1863]
 
     FORMAT = '%d/%m/%Y kl. %H:%M'
     last_year = year - 1
     from_time = fjule_party(year - 1)
     to_time = fjule_party(year)
-    kr_stat_list = sale_money_rank(from_time, to_time)
-    beer_stat_list = sale_product_rank(beer, from_time, to_time)
-    caffeine_stat_list = sale_product_rank(caffeine, from_time, to_time)
-    milk_stat_list = sale_product_rank(milk, from_time, to_time)
-    coffee_stat_list = sale_product_rank(coffee, from_time, to_time)
-    vitamin_stat_list = sale_product_rank(vitamin, from_time, to_time)
+    rank_groups = list(RankGroup.objects.all())
+    if to_time < datetime.datetime.now():
+        group_stat_lists, kr_stat_list = frozen_ranks(year, from_time, to_time, rank_groups)
+    else:
+        group_stat_lists, kr_stat_list = year_ranks(from_time, to_time, rank_groups)
+    stat_lists = [(group, group_stat_lists[group.id]) for group in rank_groups]
     from_time_string = from_time.strftime(FORMAT)
     to_time_string = to_time.strftime(FORMAT)
     current_date = datetime.datetime.now()
@@ -228,24 +253,170 @@ def ranks_for_year(request, year):
     return render(request, 'admin/stregsystem/report/ranks.html', locals())
 
 
+def _aware(moment):
+    if timezone.is_naive(moment):
+        return timezone.make_aware(moment)
+    return moment
+
+
+def _start_of_day(day):
+    return timezone.make_aware(datetime.datetime.combine(day, datetime.time.min))
+
+
+def _sales_in_period(from_time, to_time, fields, **filters):
+    """
+    Count and sum the sales after from_time, up to and including to_time,
+    grouped by fields. Returns a dict from a tuple of the values of fields to
+    a (count, price sum) pair.
+
+    The whole days of the period are read from the sales rollup, only the
+    partial days at the ends are counted from the sales themselves.
+    """
+    from_time = _aware(from_time)
+    to_time = _aware(to_time)
+    totals = {}
+
+    def add(rows):
+        for row in rows:
+            key = tuple(row[field] for field in fields)
+            count, price_sum = totals.get(key, (0, 0))
+            totals[key] = (count + (row["sales"] or 0),
+                           price_sum + (row["revenue"] or 0))
+
+    def group(queryset, sales, revenue):
+        if not fields:
+            return [queryset.aggregate(sales=sales, revenue=revenue)]
+        return (queryset
+                .values(*fields)
+                .annotate(sales=sales, revenue=revenue)
+                .order_by())
+
+    def add_sales(**timestamp_filters):
+        add(group(Sale.objects.filter(**filters).filter(**timestamp_filters),
+                  Count("id"), Sum("price")))
+
+    first_whole_day = timezone.localtime(from_time).date() + datetime.timedelta(days=1)
+    to_day = timezone.localtime(to_time).date()
+    if to_time >= timezone.now():
+        # There are no sales in the future, so the rest of today is whole
+        last_whole_day = to_day
+    else:
+        last_whole_day = to_day - datetime.timedelta(days=1)
+
+    if first_whole_day > last_whole_day:
+        add_sales(timestamp__gt=from_time, timestamp__lte=to_time)
+    else:
+        add_sales(timestamp__gt=from_time,
+                  timestamp__lt=_start_of_day(first_whole_day))
+        add(group(SaleRollup.objects.filter(day__gte=first_whole_day,
+                                            day__lte=last_whole_day,
+                                            **filters),
+                  Sum("count"), Sum("price_sum")))
+        if last_whole_day < to_day:
+            add_sales(timestamp__gte=_start_of_day(to_day),
+                      timestamp__lte=to_time)
+
+    # Refunds leave rollups with nothing in them behind
+    return {key: total for key, total in totals.items()
+            if total[0] > 0 or not fields}
+
+
+def _rank_members(totals, attribute, rank_limit):
+    """
+    The members with the highest totals, ties broken by username. The total
+    of each member is stored in the attribute of the same name.
+    """
+    ranked = sorted(totals.values(), reverse=True)
+    if len(ranked) > rank_limit:
+        # Members tied with the last place might still make it on username
+        cutoff = ranked[rank_limit - 1]
+        totals = {k: v for k, v in totals.items() if v >= cutoff}
+    stat_list = list(Member.objects.filter(id__in=list(totals.keys())))
+    for member in stat_list:
+        setattr(member, attribute, totals[member.id])
+    stat_list.sort(key=lambda member: (-totals[member.id], member.username))
+    return stat_list[:rank_limit]
+
+
 # gives a list of member objects, with the additional field sale__count, with the number of sales which are in the parameter id
 def sale_product_rank(ids, from_time, to_time, rank_limit=10):
-    stat_list = Member.objects.filter(sale__timestamp__gt=from_time, sale__timestamp__lte=to_time,
-                                      sale__product__in=ids).annotate(Count('sale')).order_by('-sale__count',
-                                                                                              'username')[:rank_limit]
-    return stat_list
+    totals = _sales_in_period(from_time, to_time, ["member"], product__in=ids)
+    return _rank_members(
+        {member_id: count for (member_id,), (count, _) in totals.items()},
+        "sale__count",
+        rank_limit)
 
 
 # gives a list of member object, with the additional field sale__price__sum__formatted which is the number of money spent in the period given.
 def sale_money_rank(from_time, to_time, rank_limit=10):
-    stat_list = Member.objects.filter(active=True, sale__timestamp__gt=from_time,
-                                      sale__timestamp__lte=to_time).annotate(Sum('sale__price')).order_by(
-        '-sale__price__sum', 'username')[:rank_limit]
+    totals = _sales_in_period(from_time, to_time, ["member"], member__active=True)
+    stat_list = _rank_members(
+        {member_id: price_sum for (member_id,), (_, price_sum) in totals.items()},
+        "sale__price__sum",
+        rank_limit)
     for member in stat_list:
         member.sale__price__sum__formatted = money(member.sale__price__sum)
     return stat_list
 
 
+# works out the ranks of every rank group, and the money rank, in the period given.
+def year_ranks(from_time, to_time, rank_groups):
+    group_product_ids = {group.id: [] for group in rank_groups}
+    for group_id, product_id in (RankGroup.products.through.objects
+                                 .filter(rankgroup__in=rank_groups)
+                                 .values_list("rankgroup_id", "product_id")):
+        group_product_ids[group_id].append(product_id)
+
+    group_stat_lists = {
+        group.id: sale_product_rank(group_product_ids[group.id], from_time, to_time)
+        for group in rank_groups
+    }
+    return group_stat_lists, sale_money_rank(from_time, to_time)
+
+
+# the ranks of a year that has ended, worked out once and then stored.
+def frozen_ranks(year, from_time, to_time, rank_groups):
+    snapshot = RankSnapshot.objects.filter(year=year).first()
+    if snapshot is None:
+        group_stat_lists, kr_stat_list = year_ranks(from_time, to_time, rank_groups)
+        try:
+            with transaction.atomic():
+                _freeze_ranks(year, from_time, to_time, group_stat_lists, kr_stat_list)
+        except IntegrityError:
+            # Someone else froze the year while we were working it out
+            pass
+        return group_stat_lists, kr_stat_list
+
+    group_stat_lists = {group.id: [] for group in rank_groups}
+    kr_stat_list = []
+    for entry in snapshot.entries.select_related("member"):
+        member = entry.member
+        if entry.rank_group_id is None:
+            member.sale__price__sum = entry.value
+            member.sale__price__sum__formatted = money(entry.value)
+            kr_stat_list.append(member)
+        elif entry.rank_group_id in group_stat_lists:
+            member.sale__count = entry.value
+            group_stat_lists[entry.rank_group_id].append(member)
+    return group_stat_lists, kr_stat_list
+
+
+def _freeze_ranks(year, from_time, to_time, group_stat_lists, kr_stat_list):
+    snapshot = RankSnapshot.objects.create(
+        year=year, from_time=_aware(from_time), to_time=_aware(to_time))
+    entries = [
+        RankSnapshotEntry(snapshot=snapshot, rank_group_id=group_id, member=member,
+                          position=position, value=member.sale__count)
+        for group_id, stat_list in group_stat_lists.items()
+        for position, member in enumerate(stat_list)
+    ]
+    entries.extend(
+        RankSnapshotEntry(snapshot=snapshot, member=member,
+                          position=position, value=member.sale__price__sum)
+        for position, member in enumerate(kr_stat_list))
+    RankSnapshotEntry.objects.bulk_create(entries)
+
+
 # year of the last fjuleparty
 def last_fjule_party_year():
     current_date = datetime.datetime.now()
@@ -293,14 +464,23 @@ def first_of_month(date):
 
 
 def daily(request):
-    current_date = datetime.datetime.now().replace(hour=0, minute=0, second=0)
+    # The page picks up the sales after this from daily_updates
+    sequence = sale_event_sequence()
     latest_sales = (Sale.objects
                     .prefetch_related('product', 'member')
                     .order_by('-timestamp')[:7])
-    top_today = (Product.objects
-                 .filter(sale__timestamp__gt=current_date)
-                 .annotate(Count('sale'))
-                 .order_by('-sale__count')[:7])
+    today = timezone.localtime(timezone.now()).date()
+    top_today_counts = (SaleRollup.objects
+                        .filter(day=today)
+                        .values('product')
+                        .annotate(sales=Sum('count'))
+                        .order_by('-sales')[:7])
+    top_today_products = Product.objects.in_bulk([c['product'] for c in top_today_counts])
+    top_today = []
+    for c in top_today_counts:
+        product = top_today_products[c['product']]
+        product.sale__count = c['sales']
+        top_today.append(product)
 
     startTime_day = timezone.now() - datetime.timedelta(hours=24)
     revenue_day = (Sale.objects
@@ -308,109 +488,225 @@ def daily(request):
                    .aggregate(Sum("price"))
                    ["price__sum"]) or 0.0
     startTime_month = timezone.now() - datetime.timedelta(days=30)
-    revenue_month = (Sale.objects
-                     .filter(timestamp__gt=startTime_month)
-                     .aggregate(Sum("price"))
-                     ["price__sum"]) or 0.0
-    top_month_category = (Category.objects
-                          .filter(product__sale__timestamp__gt=startTime_month)
-                          .annotate(sale=Count("product__sale"))
-                          .order_by("-sale")[:7])
+    month = _sales_in_period(startTime_month, timezone.now(), [])
+    revenue_month = month[()][1] or 0.0
+    category_sales = _sales_in_period(startTime_month, timezone.now(), ["product__categories"])
+    categories = Category.objects.in_bulk(
+        [category_id for (category_id,) in category_sales if category_id is not None])
+    for category in categories.values():
+        category.sale = category_sales[(category.id,)][0]
+    top_month_category = sorted(categories.values(), key=lambda c: (-c.sale, c.id))[:7]
 
     return render(request, 'admin/stregsystem/report/daily.html', locals())
 
 
+SALES_API_GRANULARITIES = ("hour", "day", "week")
+SALES_API_MAX_DAYS = {"hour": 31, "day": 366, "week": 5 * 366}
+
+
+def _today():
+    return timezone.localtime(timezone.now()).date()
+
+
+def _cached_series(name, days, compute, changed):
+    """
+    The value of the named series for each of the days. The days before
+    today are read from the cache, and the ones missing are worked out, with
+    compute(first day, last day), and cached. changed is when the sales last
+    changed.
+    """
+    today = _today()
+    keys = {day: sales_series_cache_key(name, day, changed) for day in days if day < today}
+    cached = cache.get_many(list(keys.values()))
+    values = {day: cached[key] for day, key in keys.items() if key in cached}
+
+    missing = [day for day in days if day not in values]
+    if missing:
+        computed = compute(min(missing), max(missing))
+        values.update((day, computed[day]) for day in missing)
+        cache.set_many({keys[day]: values[day] for day in missing if day in keys},
+                       SALES_SERIES_CACHE_TIMEOUT)
+    return values
+
+
+def _day_sales(first_day, last_day):
+    rows = (SaleRollup.objects
+            .filter(day__gte=first_day, day__lte=last_day)
+            .values('day')
+            .annotate(c=Sum('count'))
+            .annotate(r=Sum('price_sum'))
+            .order_by())
+    totals = {row["day"]: (row["c"], row["r"] or 0) for row in rows}
+    return {day: totals.get(day, (0, 0)) for day in _days(first_day, last_day)}
+
+
+def _hour_sales(first_day, last_day):
+    # The rollup doesn't know about hours, so this has to count the sales
+    # themselves. Each day is only counted once, after that it's cached.
+    rows = (Sale.objects
+            .filter(timestamp__gte=_start_of_day(first_day),
+                    timestamp__lt=_start_of_day(last_day + datetime.timedelta(days=1)))
+            .annotate(hour=TruncHour('timestamp'))
+            .values('hour')
+            .annotate(c=Count('id'))
+            .annotate(r=Sum('price'))
+            .order_by())
+    hours = {day: [(0, 0)] * 24 for day in _days(first_day, last_day)}
+    for row in rows:
+        hour = timezone.localtime(row["hour"])
+        hours[hour.date()][hour.hour] = (row["c"], row["r"] or 0)
+    return hours
+
+
+def _days(first_day, last_day):
+    return [first_day + datetime.timedelta(days=x) for x in range((last_day - first_day).days + 1)]
+
+
+def _sales_series(granularity, days, changed):
+    """
+    A list of (bucket, sales, revenue) in the last days, newest first
+    """
+    today = _today()
+    first_day = today - datetime.timedelta(days=days - 1)
+    if granularity == "hour":
+        hours = _cached_series("hour", _days(first_day, today), _hour_sales, changed)
+        now = timezone.localtime(timezone.now())
+        series = []
+        for day in _days(first_day, today):
+            for hour, (count, revenue) in enumerate(hours[day]):
+                bucket = _start_of_day(day) + datetime.timedelta(hours=hour)
+                if bucket <= now:
+                    series.append((bucket, count, revenue))
+        return series[::-1]
+
+    if granularity == "week":
+        first_day -= datetime.timedelta(days=first_day.weekday())
+    totals = _cached_series("day", _days(first_day, today), _day_sales, changed)
+    if granularity == "day":
+        return [(day, count, revenue) for day, (count, revenue) in sorted(totals.items(), reverse=True)]
+
+    weeks = {}
+    for day, (count, revenue) in totals.items():
+        week = day - datetime.timedelta(days=day.weekday())
+        week_count, week_revenue = weeks.get(week, (0, 0))
+        weeks[week] = (week_count + count, week_revenue + revenue)
+    return [(week, count, revenue) for week, (count, revenue) in sorted(weeks.items(), reverse=True)]
+
+
 def sales_api(request):
-    startTime_month = timezone.now() - datetime.timedelta(days=30)
-    qs = (Sale.objects
-          .filter(timestamp__gt=startTime_month)
-          .annotate(day=TruncDay('timestamp'))
-          .values('day')
-          .annotate(c=Count('*'))
-          .annotate(r=Sum('price'))
-          )
-    db_sales = {i["day"].date(): (i["c"], money(i["r"])) for i in qs}
-    base = timezone.now().date()
-    date_list = [base - datetime.timedelta(days=x) for x in range(0, 30)]
-
-    sales_list = []
-    revenue_list = []
-    for date in date_list:
-        if date in db_sales:
-            sales, revenue = db_sales[date]
-            sales_list.append(sales)
-            revenue_list.append(revenue)
-        else:
-            sales_list.append(0)
-            revenue_list.append(0)
+    granularity = request.GET.get("granularity", "day")
+    if granularity not in SALES_API_GRANULARITIES:
+        return HttpResponseBadRequest("granularity must be one of {}".format(", ".join(SALES_API_GRANULARITIES)))
+    try:
+        days = int(request.GET.get("days", 30))
+    except ValueError:
+        return HttpResponseBadRequest("days must be a number")
+    days = max(1, min(days, SALES_API_MAX_DAYS[granularity]))
 
+    changed = SalesSeriesChange.last()
+    series = _sales_series(granularity, days, changed)
     items = {
-        "day": date_list,
-        "sales": sales_list,
-        "revenue": revenue_list,
+        "granularity": granularity,
+        "day": [bucket for bucket, _, _ in series],
+        "sales": [count for _, count, _ in series],
+        "revenue": [money(revenue) for _, _, revenue in series],
     }
-    return JsonResponse(items)
+    response = JsonResponse(items)
+
+    # The series changes with every new sale, with every refund, and when a
+    # new bucket starts, sales or not
+    etag = hashlib.md5(response.content).hexdigest()
+    last_sale = Sale.objects.order_by('-timestamp').values_list('timestamp', flat=True).first()
+    now = timezone.localtime(timezone.now())
+    if granularity == "hour":
+        newest_bucket = now.replace(minute=0, second=0, microsecond=0)
+    else:
+        newest_bucket = _start_of_day(now.date())
+    changes = [moment for moment in (last_sale, changed, newest_bucket) if moment is not None]
+    last_modified = calendar.timegm(max(changes).utctimetuple())
+    response["ETag"] = quote_etag(etag)
+    response["Last-Modified"] = http_date(last_modified)
+    return get_conditional_response(request, etag=etag, last_modified=last_modified, response=response)
 
 
 daily = staff_member_required(daily)
 
 
+def daily_updates(request):
+    """
+    The sales after the sequence number in ?after=, for the dashboard to
+    poll. The sales are read from the cache rather than the sales table, but
+    like any admin page the session and user are loaded on every poll. The
+    cache has to be shared by every process, see the [cache] section of
+    local.cfg.
+
+    Answers with the new sequence number and the sales, or reset if the
+    dashboard has fallen too far behind, or the events have started over.
+    pending means there is a newer event that isn't there, either because
+    it's being written or because it's lost.
+    """
+    try:
+        after = int(request.GET["after"])
+    except (KeyError, ValueError):
+        return HttpResponseBadRequest("after must be a sequence number")
+
+    sequence, events = sale_events_after(after)
+    if events is None:
+        return JsonResponse({"sequence": sequence, "reset": True})
+    return JsonResponse({
+        "sequence": sequence,
+        "reset": False,
+        "events": events,
+        "pending": sale_event_sequence() > sequence,
+    })
+
+
+daily_updates = staff_member_required(daily_updates)
+
+
+def category_pivot(category_ids):
+    """
+    Yield the id, username, total sales and sales per category, in the order
+    of category_ids, of every member who has bought something in the
+    categories, ordered by member id.
+
+    A sale of a product in more than one of the categories counts once in
+    each.
+    """
+    rows = (
+        SaleRollup.objects
+        .filter(product__categories__in=category_ids)
+        .values_list("member", "member__username", "product__categories")
+        .annotate(sales=Sum("count"))
+        .order_by("member")
+    )
+    columns = {category_id: i for i, category_id in enumerate(category_ids)}
+    for (member_id, username), member_rows in groupby(rows.iterator(), key=lambda row: row[:2]):
+        category_sales = [0] * len(category_ids)
+        for _, _, category_id, sales in member_rows:
+            category_sales[columns[category_id]] += sales
+        total_sales = sum(category_sales)
+        if total_sales > 0:
+            yield member_id, username, total_sales, category_sales
+
+
 def user_purchases_in_categories(request):
     form = CategoryReportForm()
     data = None
     header = None
+    export_query = None
     if request.method == 'POST':
         form = CategoryReportForm(request.POST)
         if form.is_valid():
             categories = form.cleaned_data['categories']
 
-            # @SPEED: This is not a good solution for maximum speed,
-            # however neither is using MySQL. Django doesn't want to
-            # group by category_id correctly.
-            # -- Troels 2017-10-04
-
-            user_sales_per_category = {}
-            for c in categories:
-                user_sales_per_category_q = (
-                    Member.objects
-                    .filter(sale__product__categories=c)
-                    .annotate(sales=Count("*"))
-                    .order_by("sale__product__categories")
-                    .values_list(
-                        "id",
-                        "sales",
-                        "sale__product__categories__name",
-                    )
-                )
-
-                for user_id, sale_count, category_name in user_sales_per_category_q:
-                    if user_id not in user_sales_per_category:
-                        user_sales_per_category[user_id] = {}
-                    user_sales_per_category[user_id][category_name] = sale_count
-
-            users = (
-                Member.objects
-                .filter(sale__product__categories__in=categories)
-                .annotate(total_sales=Count("*"))
-                .order_by("-total_sales")
-                .values_list(
-                    "id",
-                    "username",
-                    "total_sales",
-                )
-            )
-
-            header = categories.values_list("name", flat=True)
-            data = []
-            for user_id, username, total_sales in users:
-                category_assoc = []
-                for h in header:
-                    this_sales = user_sales_per_category[user_id]
-                    if h in this_sales:
-                        category_assoc.append(this_sales[h])
-                    else:
-                        category_assoc.append(0)
-                data.append((username, total_sales, category_assoc))
+            category_ids, header = zip(*categories.values_list("id", "name"))
+            data = [
+                (username, total_sales, category_sales)
+                for _, username, total_sales, category_sales in category_pivot(category_ids)
+            ]
+            data.sort(key=lambda row: (-row[1], row[0]))
+            export_query = "&".join("categories={}".format(c) for c in category_ids)
 
     return render(
         request,
@@ -419,5 +715,144 @@ def user_purchases_in_categories(request):
             "form": form,
             "data": data,
             "header": header,
+            "export_query": export_query,
         }
     )
+
+
+# How many rows an export reads from the database at a time
+EXPORT_CHUNK_SIZE = 2000
+
+
+def _chunked(queryset, fields, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Yield the values of fields, which must start with the id, of every row
+    of queryset in id order, reading chunk_size rows at a time.
+
+    Django can't use server side cursors with MySQL, and the driver reads the
+    whole result into memory, so .iterator() alone won't keep the memory use
+    down. Instead we page through the rows by id.
+    """
+    last_id = None
+    while True:
+        chunk = queryset.order_by("id")
+        if last_id is not None:
+            chunk = chunk.filter(id__gt=last_id)
+        rows = list(chunk.values_list(*fields)[:chunk_size])
+        for row in rows:
+            yield row
+        if len(rows) < chunk_size:
+            return
+        last_id = rows[-1][0]
+
+
+def _csv_field(value):
+    if value is None:
+        return ""
+    if isinstance(value, datetime.datetime):
+        value = value.isoformat()
+    value = u"{}".format(value)
+    if any(c in value for c in u',"\r\n'):
+        value = u'"{}"'.format(value.replace(u'"', u'""'))
+    return value
+
+
+def _csv_line(values):
+    return u",".join(_csv_field(value) for value in values) + u"\r\n"
+
+
+def _csv_lines(header, rows):
+    yield _csv_line(header)
+    for row in rows:
+        yield _csv_line(row)
+
+
+def _json_lines(header, rows):
+    yield u"["
+    separator = u""
+    for row in rows:
+        yield separator + json.dumps(dict(zip(header, row)), cls=DjangoJSONEncoder)
+        separator = u",\n"
+    yield u"]"
+
+
+def _export_response(export_format, filename, header, rows):
+    if export_format == "json":
+        content = _json_lines(header, rows)
+        content_type = "application/json"
+    else:
+        content = _csv_lines(header, rows)
+        content_type = "text/csv; charset=utf-8"
+    response = StreamingHttpResponse(content, content_type=content_type)
+    response["Content-Disposition"] = 'attachment; filename="{}.{}"'.format(filename, export_format)
+    return response
+
+
+def _export_period(request, queryset):
+    """
+    Limit queryset to the whole days from the from_date to the to_date of the
+    request, both optional and formatted YYYY-MM-DD
+    """
+    from_date = request.GET.get("from_date")
+    to_date = request.GET.get("to_date")
+    try:
+        if from_date:
+            queryset = queryset.filter(
+                timestamp__gte=_start_of_day(dateparse.parse_date(from_date)))
+        if to_date:
+            queryset = queryset.filter(
+                timestamp__lt=_start_of_day(dateparse.parse_date(to_date) + datetime.timedelta(days=1)))
+    except (ValueError, TypeError):
+        # parse_date gives None for something that isn't a date at all
+        raise RuntimeError("Dates must be formatted YYYY-MM-DD")
+    return queryset
+
+
+def export_sales(request, export_format):
+    try:
+        sales = _export_period(request, Sale.objects.all())
+        if request.GET.get("products"):
+            sales = sales.filter(product__in=parse_id_string(request.GET["products"].strip()))
+    except RuntimeError as ex:
+        return HttpResponseBadRequest(ex.__str__())
+
+    header = ["id", "timestamp", "member_id", "username", "product_id", "product", "room_id", "price"]
+    rows = _chunked(sales, ["id", "timestamp", "member_id", "member__username", "product_id", "product__name",
+                            "room_id", "price"])
+    return _export_response(export_format, "sales", header, rows)
+
+
+export_sales = staff_member_required(export_sales)
+
+
+def export_payments(request, export_format):
+    try:
+        payments = _export_period(request, Payment.objects.all())
+    except RuntimeError as ex:
+        return HttpResponseBadRequest(ex.__str__())
+
+    header = ["id", "timestamp", "member_id", "username", "amount"]
+    rows = _chunked(payments, ["id", "timestamp", "member_id", "member__username", "amount"])
+    return _export_response(export_format, "payments", header, rows)
+
+
+export_payments = staff_member_required(export_payments)
+
+
+def export_categories(request, export_format):
+    try:
+        category_ids = [int(c) for c in request.GET.getlist("categories")]
+    except ValueError:
+        return HttpResponseBadRequest("Categories must be given by id")
+    names = dict(Category.objects.filter(id__in=category_ids).values_list("id", "name"))
+    category_ids = [c for c in category_ids if c in names]
+
+    header = ["member_id", "username", "total"] + [names[c] for c in category_ids]
+    rows = (
+        [member_id, username, total_sales] + category_sales
+        for member_id, username, total_sales, category_sales in category_pivot(category_ids)
+    )
+    return _export_response(export_format, "categories", header, rows)
+
+
+export_categories = staff_member_required(export_categories)
@@ -1,4 +1,5 @@
 from django.contrib import admin
+from django.db import transaction as db_transaction
 from django.db.models import Q
 from django.utils import timezone
 
@@ -6,9 +7,11 @@ from stregsystem.models import (
     Category,
     Member,
     News,
+    OfflineSale,
     Payment,
     PayTransaction,
     Product,
+    RankGroup,
     Room,
     Sale
 )
@@ -46,7 +49,6 @@ class SaleAdmin(admin.ModelAdmin):
     def delete_model(self, request, obj):
         transaction = PayTransaction(obj.price)
         obj.member.rollback(transaction)
-        obj.member.save()
         super(SaleAdmin, self).delete_model(request, obj)
 
     def save_model(self, request, obj, form, change):
@@ -54,7 +56,6 @@ class SaleAdmin(admin.ModelAdmin):
             return
         transaction = PayTransaction(obj.price)
         obj.member.fulfill(transaction)
-        obj.member.save()
         super(SaleAdmin, self).save_model(request, obj, form, change)
 
     def get_price_display(self, obj):
@@ -65,11 +66,11 @@ class SaleAdmin(admin.ModelAdmin):
     get_price_display.short_description = "Price"
     get_price_display.admin_order_field = "price"
 
+    @db_transaction.atomic
     def refund(modeladmin, request, queryset):
         for obj in queryset:
             transaction = PayTransaction(obj.price)
             obj.member.rollback(transaction)
-            obj.member.save()
         queryset.delete()
     refund.short_description = "Refund selected"
 
@@ -138,7 +139,7 @@ class ProductAdmin(admin.ModelAdmin):
     def get_bought(self, obj):
         return obj.bought
     get_bought.short_description = "Bought"
-    get_bought.admin_order_field = "bought"
+    get_bought.admin_order_field = "bought_count"
 
     def activated(self, product):
         return product.is_active()
@@ -152,12 +153,45 @@ class CategoryAdmin(admin.ModelAdmin):
         return obj.product_set.count()
 
 
+class RankGroupAdmin(admin.ModelAdmin):
+    list_display = ('name', 'position')
+    filter_horizontal = ('products',)
+
+
 class MemberAdmin(admin.ModelAdmin):
     list_filter = ('want_spam', )
     search_fields = ('username', 'firstname', 'lastname', 'email')
     list_display = ('username', 'firstname', 'lastname', 'balance', 'email', 'notes')
 
 
+def mark_resolved(modeladmin, request, queryset):
+    queryset.update(resolved=True)
+
+
+mark_resolved.short_description = "Mark selected as resolved"
+
+
+class OfflineSaleAdmin(admin.ModelAdmin):
+    """
+    The queue of offline sales that couldn't be replayed, for someone to sell
+    or write off by hand
+    """
+    list_filter = ('resolved', 'status', 'room')
+    list_display = ('username', 'products', 'get_cost_display', 'bought_on', 'replayed_on', 'status', 'resolved')
+    search_fields = ['username', 'key']
+    readonly_fields = ('key', 'username', 'member', 'room', 'products', 'cost', 'bought_on', 'replayed_on', 'status')
+    actions = [mark_resolved]
+
+    def get_cost_display(self, obj):
+        return "{0:.2f} kr.".format(obj.cost / 100.0)
+
+    get_cost_display.short_description = "Cost"
+    get_cost_display.admin_order_field = "cost"
+
+    def has_add_permission(self, request):
+        return False
+
+
 class PaymentAdmin(admin.ModelAdmin):
     def formfield_for_foreignkey(self, db_field, request, **kwargs):
         if db_field.name == "member":
@@ -191,3 +225,5 @@ admin.site.register(News)
 admin.site.register(Product, ProductAdmin)
 admin.site.register(Category, CategoryAdmin)
 admin.site.register(Room)
+admin.site.register(RankGroup, RankGroupAdmin)
+admin.site.register(OfflineSale, OfflineSaleAdmin)
@@ -83,6 +83,54 @@ def alcohol_bac_timeline(gender, weight, now, alcohol_timeline):
     return current
 
 
+def alcohol_bac_timelines(genders, weight, now, member_indexes, timestamps,
+                          alcohol_ml):
+    """
+    Calculate the BAC at now of many members in one pass.
+
+    The timelines of all the members are given as three flat sequences of
+    equal length, where drink i was alcohol_ml[i] ml drunk by member
+    member_indexes[i] at timestamps[i]. genders[m] is the gender of member m.
+    The drinks don't need to be sorted.
+
+    Returns a list with the BAC of every member in genders, which is the same
+    as calling alcohol_bac_timeline for each of them.
+    """
+    assert len(member_indexes) == len(timestamps) == len(alcohol_ml)
+
+    bacs = [0] * len(genders)
+    last_times = [None] * len(genders)
+    increase_per_ml = [alcohol_bac_increase(gender, weight, 1)
+                       for gender in genders]
+
+    drinks = sorted(range(len(member_indexes)),
+                    key=lambda i: (member_indexes[i], timestamps[i]))
+    for i in drinks:
+        member = member_indexes[i]
+        time = timestamps[i]
+        if last_times[member] is not None:
+            bacs[member] = alcohol_bac_at(bacs[member],
+                                          last_times[member], time)
+        last_times[member] = time
+        bacs[member] += increase_per_ml[member] * alcohol_ml[i]
+
+    return [alcohol_bac_at(bac, last_time, now) if last_time is not None else 0
+            for bac, last_time in zip(bacs, last_times)]
+
+
+def alcohol_bac_at(bac, time, now):
+    """
+    The BAC at now, given that it was bac at time and nothing has been drunk
+    since
+    """
+    current = bac - alcohol_bac_degradation(now - time)
+
+    if current < 0:
+        current = 0
+
+    return current
+
+
 # Ballmer peak: 1.337 +/- 0.05
 BALLMER_PEAK_MEAN = 1.337
 BALLMER_PEAK_LOWER_LIMIT = BALLMER_PEAK_MEAN - 0.05
@@ -108,3 +156,21 @@ def ballmer_peak(bac):
         return False, int(minutes), int(seconds)
     else:
         return False, None, None
+
+
+def ballmer_peaks(bacs):
+    """
+    ballmer_peak for many BACs at once, for example the ones from
+    alcohol_bac_timelines
+    """
+    return [ballmer_peak(bac) for bac in bacs]
+
+
+def ballmer_peakers(bacs):
+    """
+    Get the indexes of the BACs which are at the Ballmer peak, sorted by how
+    long they have left at it, the longest first
+    """
+    peaking = [i for i, bac in enumerate(bacs)
+               if BALLMER_PEAK_LOWER_LIMIT < bac < BALLMER_PEAK_UPPER_LIMIT]
+    return sorted(peaking, key=lambda i: bacs[i], reverse=True)
@@ -0,0 +1,194 @@
+import datetime
+import timeit
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+import stregreport.views
+from stregsystem.models import (
+    Category,
+    Member,
+    OldPrice,
+    Payment,
+    Product,
+    Room,
+    Sale
+)
+from stregsystem.utils import (
+    make_active_productlist_query,
+    make_room_specific_query
+)
+
+
+class Command(BaseCommand):
+    help = ("Time the slow entry points of the system against the current "
+            "database, and count the queries they make")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--runs", type=int, default=5,
+                            help="How many times to run each benchmark")
+        parser.add_argument("--year", type=int, default=None,
+                            help="The year to rank, defaults to the last "
+                                 "finished one")
+        parser.add_argument("--members", type=int, default=50,
+                            help="How many members to calculate the "
+                                 "promille of")
+        parser.add_argument("--only", action="append", default=None,
+                            help="Only run the named benchmark, may be "
+                                 "given more than once")
+        parser.add_argument("--explain", action="store_true", default=False,
+                            help="Also show the query plans of the ways the "
+                                 "sales, payments and prices are looked up")
+
+    def handle(self, *args, **options):
+        benchmarks = self.benchmarks(options)
+        if options["only"]:
+            unknown = set(options["only"]) - set(name for name, _ in benchmarks)
+            if unknown:
+                raise CommandError("Unknown benchmarks: {}".format(
+                    ", ".join(sorted(unknown))))
+            benchmarks = [(name, function) for name, function in benchmarks
+                          if name in options["only"]]
+
+        self.stdout.write("{:<30} {:>10} {:>10} {:>10} {:>8}".format(
+            "benchmark", "min ms", "median ms", "max ms", "queries"))
+        for name, function in benchmarks:
+            timings, queries = self.run(function, options["runs"])
+            self.stdout.write("{:<30} {:>10.1f} {:>10.1f} {:>10.1f} {:>8}".format(
+                name,
+                timings[0] * 1000,
+                timings[len(timings) // 2] * 1000,
+                timings[-1] * 1000,
+                queries))
+
+        if options["explain"]:
+            for name, queryset in self.access_patterns():
+                self.stdout.write("")
+                self.stdout.write(name)
+                for line in self.explain(queryset):
+                    self.stdout.write("    " + line)
+
+    def run(self, function, runs):
+        timings = []
+        queries = 0
+        for _ in range(max(1, runs)):
+            with CaptureQueriesContext(connection) as context:
+                start = timeit.default_timer()
+                function()
+                timings.append(timeit.default_timer() - start)
+            queries = len(context.captured_queries)
+        timings.sort()
+        return timings, queries
+
+    def explain(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        if connection.vendor == "sqlite":
+            sql = "EXPLAIN QUERY PLAN " + sql
+        else:
+            sql = "EXPLAIN " + sql
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return [" ".join(str(column) for column in row)
+                    for row in cursor.fetchall()]
+
+    def access_patterns(self):
+        """
+        The lookups of sales, payments and prices the system makes most
+        """
+        now = timezone.now()
+        member = Member.objects.order_by("id").first()
+        room = Room.objects.order_by("id").first()
+        product = Product.objects.order_by("id").first()
+        return [
+            ("member_recent_sales",
+             Sale.objects.filter(member=member).order_by("-timestamp")[:10]),
+            ("member_sales_since",
+             Sale.objects.filter(
+                 member=member,
+                 timestamp__gt=now - datetime.timedelta(hours=12))),
+            ("sales_since",
+             Sale.objects.filter(
+                 timestamp__gte=now - datetime.timedelta(days=1))),
+            ("room_sales_since",
+             Sale.objects.filter(
+                 room=room, timestamp__gte=now - datetime.timedelta(days=1))),
+            ("member_last_payment",
+             Payment.objects.filter(member=member).order_by("-timestamp")[:1]),
+            ("product_last_price",
+             OldPrice.objects.filter(product=product)
+             .order_by("-changed_on")[:1]),
+        ]
+
+    def benchmarks(self, options):
+        factory = RequestFactory()
+        # The reports check the user, but never save anything about it.
+        staff = User(username="benchmark", is_staff=True, is_active=True)
+
+        def get(path):
+            request = factory.get(path)
+            request.user = staff
+            return request
+
+        room = Room.objects.order_by("id").first()
+        room_id = room.id if room else None
+        year = options["year"] or stregreport.views.last_fjule_party_year()
+        # MySQL can't LIMIT inside an IN subquery, so fetch the ids first.
+        recent_buyers = set(
+            Sale.objects
+            .order_by("-timestamp")
+            .values_list("member", flat=True)[:options["members"] * 10])
+        members = list(
+            Member.objects.filter(id__in=recent_buyers)[:options["members"]])
+        category_ids = list(
+            Category.objects.order_by("id").values_list("id", flat=True)[:5])
+
+        def product_list():
+            list(make_active_productlist_query(Product.objects)
+                 .filter(make_room_specific_query(room_id)))
+
+        def ranks_for_year():
+            response = stregreport.views.ranks_for_year(
+                get("/admin/stregsystem/report/ranks/"), year)
+            response.content
+
+        def daily():
+            response = stregreport.views.daily(
+                get("/admin/stregsystem/report/daily/"))
+            response.content
+
+        def sales_api():
+            response = stregreport.views.sales_api(
+                get("/admin/stregsystem/report/sales_api"))
+            response.content
+
+        def user_purchases_in_categories():
+            request = factory.post(
+                "/admin/stregsystem/report/categories/",
+                {"categories": category_ids})
+            request.user = staff
+            response = stregreport.views.user_purchases_in_categories(request)
+            response.content
+
+        def calculate_alcohol_promille():
+            for member in members:
+                member.calculate_alcohol_promille()
+
+        def member_history():
+            # What menu_userinfo shows
+            for member in members:
+                list(member.sale_set.order_by("-timestamp")[:10])
+                list(member.payment_set.order_by("-timestamp")[:1])
+
+        return [
+            ("product_list", product_list),
+            ("ranks_for_year", ranks_for_year),
+            ("daily", daily),
+            ("sales_api", sales_api),
+            ("user_purchases_in_categories", user_purchases_in_categories),
+            ("calculate_alcohol_promille", calculate_alcohol_promille),
+            ("member_history", member_history),
+        ]
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from stregsystem.models import PurchaseToken
+
+
+class Command(BaseCommand):
+    help = "Delete the purchase tokens that are too old to stop a purchase"
+
+    def handle(self, *args, **options):
+        deleted = PurchaseToken.expire()
+        self.stdout.write("Deleted {} purchase tokens".format(deleted))
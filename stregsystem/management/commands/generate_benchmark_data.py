@@ -0,0 +1,264 @@
+import bisect
+import contextlib
+import datetime
+import random
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from stregsystem.models import (
+    Category,
+    Member,
+    OldPrice,
+    Payment,
+    Product,
+    Room,
+    Sale
+)
+
+# Most sales happen in the afternoon and evening, and hardly any at night.
+HOUR_WEIGHTS = [
+    1, 1, 1, 1, 1, 1, 1, 1,
+    2, 4, 6, 8, 12, 14, 16, 16,
+    14, 12, 10, 9, 8, 6, 3, 2,
+]
+# Fridays are busy, weekends are quiet.
+WEEKDAY_WEIGHTS = [10, 10, 11, 12, 16, 4, 3]
+
+BEER_ALCOHOL_ML = 0.33 * 0.046 * 1000
+
+
+class WeightedChoice(object):
+    """
+    Pick items with a probability proportional to their weight.
+
+    random.choices only exists on Python 3.6+, so do it with bisect.
+    """
+
+    def __init__(self, rng, items, weights):
+        self.rng = rng
+        self.items = items
+        self.cumulative = []
+        total = 0
+        for weight in weights:
+            total += weight
+            self.cumulative.append(total)
+        self.total = total
+
+    def pick(self):
+        index = bisect.bisect(self.cumulative, self.rng.random() * self.total)
+        return self.items[min(index, len(self.items) - 1)]
+
+
+@contextlib.contextmanager
+def explicit_timestamps(*models):
+    """
+    Let bulk_create keep the timestamps we give it, instead of overwriting
+    them with now because of auto_now_add.
+    """
+    fields = [model._meta.get_field("timestamp") for model in models]
+    for field in fields:
+        field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field in fields:
+            field.auto_now_add = True
+
+
+class Command(BaseCommand):
+    help = ("Fill the database with a reproducible, synthetic history of "
+            "members, products and sales, for benchmarking")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--seed", type=int, default=42)
+        parser.add_argument("--members", type=int, default=2000)
+        parser.add_argument("--products", type=int, default=300)
+        parser.add_argument("--rooms", type=int, default=3)
+        parser.add_argument("--categories", type=int, default=15)
+        parser.add_argument("--sales", type=int, default=1000000)
+        parser.add_argument("--payments", type=int, default=None,
+                            help="Defaults to one payment per 20 sales")
+        parser.add_argument("--years", type=int, default=5,
+                            help="How far back the history goes")
+        parser.add_argument("--batch-size", type=int, default=10000)
+
+    def handle(self, *args, **options):
+        if not settings.DEBUG:
+            raise CommandError(
+                "Refusing to generate benchmark data with DEBUG off, "
+                "this is not meant for a production database")
+
+        self.rng = random.Random(options["seed"])
+        self.batch_size = options["batch_size"]
+        self.now = timezone.now()
+        self.start = self.now - datetime.timedelta(days=365 * options["years"])
+
+        with transaction.atomic():
+            rooms = self.make_rooms(options["rooms"])
+            categories = self.make_categories(options["categories"])
+            products = self.make_products(options["products"], rooms, categories)
+            members = self.make_members(options["members"])
+
+        payments = options["payments"]
+        if payments is None:
+            payments = options["sales"] // 20
+
+        with explicit_timestamps(Sale, Payment):
+            self.make_sales(options["sales"], members, products, rooms)
+            self.make_payments(payments, members)
+
+        # bulk_create skips the write path that keeps the counters in sync.
+        call_command("reconcile_bought", stdout=self.stdout)
+        call_command("rebuild_sale_rollup", stdout=self.stdout)
+        drinkers = (
+            Member.objects
+            .filter(sale__timestamp__gt=self.now - datetime.timedelta(hours=12),
+                    sale__product__alcohol_content_ml__gt=0.0)
+            .distinct()
+        )
+        for member in drinkers:
+            member.recalculate_alcohol_promille()
+
+        self.stdout.write(
+            "Generated {} members, {} products, {} sales and {} payments".format(
+                len(members), len(products), options["sales"], payments))
+
+    def make_rooms(self, count):
+        return [
+            Room.objects.create(name="Rum {}".format(i),
+                                description="Benchmark")
+            for i in range(count)
+        ]
+
+    def make_categories(self, count):
+        return [
+            Category.objects.create(name="Kategori {}".format(i))
+            for i in range(count)
+        ]
+
+    def make_products(self, count, rooms, categories):
+        products = []
+        for i in range(count):
+            product = Product(
+                name="Produkt {}".format(i),
+                price=self.rng.randrange(400, 3000, 50),
+                active=self.rng.random() < 0.7,
+            )
+            if self.rng.random() < 0.25:
+                product.alcohol_content_ml = BEER_ALCOHOL_ML * self.rng.uniform(0.8, 2.0)
+            if self.rng.random() < 0.05:
+                product.start_date = (self.start + datetime.timedelta(
+                    days=self.rng.randrange(365))).date()
+                product.quantity = self.rng.randrange(50, 5000)
+            if self.rng.random() < 0.05:
+                product.deactivate_date = self.now + datetime.timedelta(
+                    days=self.rng.randrange(-365, 365))
+            products.append(product)
+        Product.objects.bulk_create(products)
+        products = list(Product.objects.order_by("-id")[:count])[::-1]
+
+        OldPrice.objects.bulk_create(
+            OldPrice(product=product, price=product.price)
+            for product in products)
+
+        room_links = []
+        category_links = []
+        for product in products:
+            # Most products are sold in every room.
+            if rooms and self.rng.random() < 0.2:
+                room = self.rng.choice(rooms)
+                room_links.append(
+                    Product.rooms.through(product=product, room=room))
+            for category in self.rng.sample(categories, self.rng.randint(0, 2)):
+                category_links.append(
+                    Product.categories.through(product=product, category=category))
+        Product.rooms.through.objects.bulk_create(room_links)
+        Product.categories.through.objects.bulk_create(category_links)
+        return products
+
+    def make_members(self, count):
+        members = [
+            Member(
+                username="bench{}".format(i),
+                year=str(self.start.year + self.rng.randrange(6)),
+                firstname="Bench",
+                lastname="Mark {}".format(i),
+                gender=self.rng.choice("MF"),
+                balance=self.rng.randrange(0, 50000),
+                active=self.rng.random() < 0.9,
+            )
+            for i in range(count)
+        ]
+        Member.objects.bulk_create(members, batch_size=self.batch_size)
+        return list(Member.objects.order_by("-id")[:count])[::-1]
+
+    def timestamps(self, count):
+        """
+        Yield count random timestamps between start and now, in order.
+        """
+        # Work through the history a slice at a time, so we never hold all
+        # the timestamps in memory.
+        span = (self.now - self.start).total_seconds()
+        hours = WeightedChoice(self.rng, range(24), HOUR_WEIGHTS)
+        slices = max(1, count // self.batch_size)
+        slice_span = span / slices
+        for s in range(slices):
+            size = count // slices + (1 if s < count % slices else 0)
+            slice_start = self.start + datetime.timedelta(seconds=s * slice_span)
+            batch = []
+            while len(batch) < size:
+                day = slice_start + datetime.timedelta(
+                    seconds=self.rng.random() * slice_span)
+                # Thin out the quiet days.
+                weekday_weight = WEEKDAY_WEIGHTS[day.weekday()]
+                if self.rng.random() * max(WEEKDAY_WEIGHTS) > weekday_weight:
+                    continue
+                timestamp = day.replace(hour=hours.pick(),
+                                        minute=self.rng.randrange(60),
+                                        second=self.rng.randrange(60))
+                if self.start <= timestamp <= self.now:
+                    batch.append(timestamp)
+            batch.sort()
+            for timestamp in batch:
+                yield timestamp
+
+    def make_sales(self, count, members, products, rooms):
+        # A few members and products stand for most of the sales.
+        member_choice = WeightedChoice(
+            self.rng, members,
+            [self.rng.paretovariate(1.2) for _ in members])
+        product_choice = WeightedChoice(
+            self.rng, products,
+            [self.rng.paretovariate(1.0) for _ in products])
+
+        batch = []
+        for timestamp in self.timestamps(count):
+            product = product_choice.pick()
+            batch.append(Sale(
+                member=member_choice.pick(),
+                product=product,
+                room=self.rng.choice(rooms) if rooms else None,
+                timestamp=timestamp,
+                price=product.price,
+            ))
+            if len(batch) >= self.batch_size:
+                Sale.objects.bulk_create(batch)
+                batch = []
+        Sale.objects.bulk_create(batch)
+
+    def make_payments(self, count, members):
+        batch = []
+        for timestamp in self.timestamps(count):
+            batch.append(Payment(
+                member=self.rng.choice(members),
+                timestamp=timestamp,
+                amount=self.rng.randrange(5000, 50000, 500),
+            ))
+            if len(batch) >= self.batch_size:
+                Payment.objects.bulk_create(batch)
+                batch = []
+        Payment.objects.bulk_create(batch)
@@ -0,0 +1,16 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from stregsystem.offline import OfflineJournal, take_snapshot
+
+
+class Command(BaseCommand):
+    help = ("Write the members and products to the offline journal, for the "
+            "terminal to check quickbuys against while the database is down")
+
+    def handle(self, *args, **options):
+        if not settings.OFFLINE_JOURNAL:
+            raise CommandError("There is no offline journal, set JOURNAL in "
+                               "the [offline] section of local.cfg")
+        products = take_snapshot(OfflineJournal(settings.OFFLINE_JOURNAL))
+        self.stdout.write("Wrote a snapshot of {} products".format(products))
@@ -0,0 +1,118 @@
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Count, Min, Sum
+from django.db.models.functions import TruncDay
+from django.utils import dateparse, timezone
+
+from stregsystem.models import (
+    RankSnapshot,
+    Sale,
+    SaleRollup,
+    SalesSeriesChange
+)
+
+
+def start_of_day(day):
+    return timezone.make_aware(
+        datetime.datetime.combine(day, datetime.time.min))
+
+
+class Command(BaseCommand):
+    help = ("Rebuild the daily sales rollup from the sales table, "
+            "a chunk of days at a time. Leaves today alone unless told to, "
+            "don't rebuild days that are being sold on")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--from", dest="from_day", default=None,
+                            help="The first day to rebuild, as YYYY-MM-DD. "
+                                 "Defaults to the first day with sales")
+        parser.add_argument("--to", dest="to_day", default=None,
+                            help="The last day to rebuild, as YYYY-MM-DD. "
+                                 "Defaults to yesterday, as today's sales are "
+                                 "still being made")
+        parser.add_argument("--chunk-days", type=int, default=31,
+                            help="How many days to rebuild per transaction")
+
+    def handle(self, *args, **options):
+        from_day = self.parse_day(options["from_day"])
+        to_day = self.parse_day(options["to_day"])
+        if from_day is None:
+            firsts = [
+                Sale.objects.aggregate(first=Min("timestamp"))["first"],
+                SaleRollup.objects.aggregate(first=Min("day"))["first"],
+            ]
+            firsts = [
+                timezone.localtime(first).date()
+                if isinstance(first, datetime.datetime) else first
+                for first in firsts if first is not None
+            ]
+            if not firsts:
+                self.stdout.write("There are no sales to roll up")
+                return
+            from_day = min(firsts)
+        if to_day is None:
+            to_day = (timezone.localtime(timezone.now()).date()
+                      - datetime.timedelta(days=1))
+
+        chunk = datetime.timedelta(days=max(1, options["chunk_days"]))
+        rows = 0
+        day = from_day
+        while day <= to_day:
+            next_day = min(day + chunk, to_day + datetime.timedelta(days=1))
+            rows += self.rebuild(day, next_day)
+            day = next_day
+
+        # The frozen ranks and cached sales were worked out from the old
+        # rollup
+        RankSnapshot.invalidate()
+        SalesSeriesChange.record()
+
+        self.stdout.write("Rebuilt {} rollup rows from {} to {}".format(
+            rows, from_day, to_day))
+
+    def parse_day(self, value):
+        if value is None:
+            return None
+        try:
+            day = dateparse.parse_date(value)
+        except ValueError:
+            day = None
+        if day is None:
+            raise CommandError("Not a date: {}".format(value))
+        return day
+
+    @transaction.atomic
+    def rebuild(self, from_day, to_day):
+        """
+        Rebuild the rollup of the days from from_day up to, but not
+        including, to_day.
+
+        Nothing stops sales from being added to the rollup of these days
+        between the delete and the sum, and those would be lost. So it must
+        not run on days that are being sold on, or have sales refunded.
+        """
+        SaleRollup.objects.filter(day__gte=from_day, day__lt=to_day).delete()
+        sales = (
+            Sale.objects
+            .filter(timestamp__gte=start_of_day(from_day),
+                    timestamp__lt=start_of_day(to_day))
+            .annotate(sale_day=TruncDay("timestamp"))
+            .values("sale_day", "product_id", "member_id", "room_id")
+            .annotate(sale_count=Count("id"), sale_price_sum=Sum("price"))
+            .order_by()
+        )
+        rollups = [
+            SaleRollup(
+                day=timezone.localtime(row["sale_day"]).date(),
+                product_id=row["product_id"],
+                member_id=row["member_id"],
+                room_id=row["room_id"],
+                count=row["sale_count"],
+                price_sum=row["sale_price_sum"] or 0,
+            )
+            for row in sales.iterator()
+        ]
+        SaleRollup.objects.bulk_create(rollups, batch_size=1000)
+        return len(rollups)
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, F
+
+from stregsystem.models import Product, Sale
+
+
+class Command(BaseCommand):
+    help = "Rebuild the bought counter of every product from the sales table"
+
+    @transaction.atomic
+    def handle(self, *args, **options):
+        counted = dict(
+            Sale.objects
+            .filter(product__start_date__isnull=False,
+                    timestamp__gt=F("product__start_date"))
+            .values_list("product")
+            .annotate(Count("id"))
+        )
+
+        fixed = 0
+        products = (
+            Product.objects
+            .select_for_update()
+            .values_list("id", "start_date", "bought_count")
+        )
+        for product_id, start_date, bought_count in products:
+            bought = counted.get(product_id, 0) if start_date else 0
+            if bought != bought_count:
+                (Product.objects
+                 .filter(pk=product_id)
+                 .update(bought_count=bought))
+                fixed += 1
+
+        self.stdout.write("Fixed the bought counter of {} products".format(fixed))
@@ -0,0 +1,34 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from stregsystem.models import OfflineSale
+from stregsystem.offline import OfflineJournal, replay, take_snapshot
+
+
+class Command(BaseCommand):
+    help = ("Buy the quickbuys journaled while the database was down, and "
+            "take a new snapshot")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=100,
+                            help="How many journal entries to read at a time")
+
+    def handle(self, *args, **options):
+        if not settings.OFFLINE_JOURNAL:
+            raise CommandError("There is no offline journal, set JOURNAL in "
+                               "the [offline] section of local.cfg")
+        journal = OfflineJournal(settings.OFFLINE_JOURNAL)
+        statuses = replay(journal, max(1, options["batch_size"]))
+        # The balances have changed
+        take_snapshot(journal)
+
+        self.stdout.write("Replayed {} entries".format(
+            statuses[OfflineSale.REPLAYED]))
+        if statuses[None]:
+            self.stdout.write("Skipped {} entries replayed before".format(
+                statuses[None]))
+        conflicts = sum(count for status, count in statuses.items()
+                        if status not in (OfflineSale.REPLAYED, None))
+        if conflicts:
+            self.stdout.write("{} entries could not be bought, see the "
+                              "offline sales in the admin".format(conflicts))
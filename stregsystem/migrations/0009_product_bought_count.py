@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-16 19:08
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def count_bought(apps, schema_editor):
+    Product = apps.get_model('stregsystem', 'Product')
+    Sale = apps.get_model('stregsystem', 'Sale')
+    for product in Product.objects.filter(start_date__isnull=False):
+        bought = (Sale.objects
+                  .filter(product=product, timestamp__gt=product.start_date)
+                  .count())
+        Product.objects.filter(pk=product.pk).update(bought_count=bought)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stregsystem', '0008_add_sale_products_id_timestamp_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='bought_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(count_bought, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-16 19:31
+from __future__ import unicode_literals
+
+from datetime import timedelta
+
+from django.db import migrations, models
+from django.utils import timezone
+
+from stregsystem.booze import Gender, alcohol_bac_timeline
+
+
+def calculate_bac(apps, schema_editor):
+    Member = apps.get_model('stregsystem', 'Member')
+    Sale = apps.get_model('stregsystem', 'Sale')
+    now = timezone.now()
+    # Only the members who have been drinking within the last 12 hours can
+    # have any alcohol left
+    alcohol_sales = (
+        Sale.objects
+        .filter(timestamp__gt=now - timedelta(hours=12),
+                product__alcohol_content_ml__gt=0.0)
+    )
+    genders = {"M": Gender.MALE, "F": Gender.FEMALE}
+    drinkers = Member.objects.filter(
+        id__in=alcohol_sales.values("member_id"))
+    for member in drinkers:
+        alcohol_timeline = list(
+            alcohol_sales
+            .filter(member=member)
+            .order_by('timestamp')
+            .values_list('timestamp', 'product__alcohol_content_ml'))
+        bac = alcohol_bac_timeline(
+            genders.get(member.gender, Gender.UNKNOWN),
+            80,
+            now,
+            alcohol_timeline)
+        Member.objects.filter(pk=member.pk).update(bac=bac, bac_as_of=now)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stregsystem', '0009_product_bought_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='member',
+            name='bac',
+            field=models.FloatField(default=0.0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='member',
+            name='bac_as_of',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(calculate_bac, migrations.RunPython.noop),
+    ]
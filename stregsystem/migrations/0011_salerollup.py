@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-16 19:18
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncDay
+from django.utils import timezone
+import django.db.models.deletion
+
+
+def rollup_sales(apps, schema_editor):
+    Sale = apps.get_model('stregsystem', 'Sale')
+    SaleRollup = apps.get_model('stregsystem', 'SaleRollup')
+    rows = (
+        Sale.objects
+        .annotate(sale_day=TruncDay('timestamp'))
+        .values('sale_day', 'product_id', 'member_id', 'room_id')
+        .annotate(sale_count=Count('id'), sale_price_sum=Sum('price'))
+        .order_by()
+    )
+    batch = []
+    for row in rows.iterator():
+        batch.append(SaleRollup(
+            day=timezone.localtime(row['sale_day']).date(),
+            product_id=row['product_id'],
+            member_id=row['member_id'],
+            room_id=row['room_id'],
+            count=row['sale_count'],
+            price_sum=row['sale_price_sum'] or 0,
+        ))
+        if len(batch) >= 1000:
+            SaleRollup.objects.bulk_create(batch)
+            batch = []
+    SaleRollup.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stregsystem', '0010_member_bac'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SaleRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('count', models.IntegerField(default=0)),
+                ('price_sum', models.IntegerField(default=0)),
+                ('member', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='stregsystem.Member')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='stregsystem.Product')),
+                ('room', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='stregsystem.Room')),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='salerollup',
+            index_together=set([('day', 'product'), ('day', 'member')]),
+        ),
+        migrations.RunPython(rollup_sales, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-16 19:22
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+# The groups that used to be hard coded in the ranks view
+RANK_GROUPS = [
+    ("Øl", [13, 14, 29, 42, 47, 54, 65, 66, 1773, 1776, 1777, 1779, 1780, 1783, 1793, 1794, 1807, 1808, 1809,
+            1820, 1822, 1840, 1844, 1846, 1847, 1853, 1855, 1856, 1858, 1859]),
+    ("Koffein", [11, 12, 30, 34, 37, 1787, 1790, 1791, 1795, 1799, 1800, 1803, 1804, 1837, 1864]),
+    ("Mælkeprodukter", [2, 3, 4, 5, 6, 7, 8, 9, 10, 16, 17, 18, 19, 20, 24, 25, 43, 44, 45, 1865]),
+    ("Kaffe", [32, 35, 36, 39]),
+    ("Vitaminvand", [1850, 1851, 1852, 1863]),
+]
+
+
+def create_rank_groups(apps, schema_editor):
+    RankGroup = apps.get_model('stregsystem', 'RankGroup')
+    Product = apps.get_model('stregsystem', 'Product')
+    for position, (name, product_ids) in enumerate(RANK_GROUPS):
+        group = RankGroup.objects.create(name=name, position=position)
+        group.products.set(Product.objects.filter(id__in=product_ids))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stregsystem', '0011_salerollup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RankGroup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=64)),
+                ('position', models.IntegerField(default=0)),
+                ('products', models.ManyToManyField(blank=True, to='stregsystem.Product')),
+            ],
+            options={
+                'ordering': ['position', 'name'],
+            },
+        ),
+        migrations.CreateModel(
+            name='RankSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('year', models.IntegerField(unique=True)),
+                ('from_time', models.DateTimeField()),
+                ('to_time', models.DateTimeField()),
+                ('created_on', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='RankSnapshotEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.IntegerField()),
+                ('value', models.IntegerField()),
+                ('member', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='stregsystem.Member')),
+                ('rank_group', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='stregsystem.RankGroup')),
+                ('snapshot', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='entries', to='stregsystem.RankSnapshot')),
+            ],
+            options={
+                'ordering': ['position'],
+            },
+        ),
+        migrations.RunPython(create_rank_groups, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-16 19:43
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stregsystem', '0012_rank_groups'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OfflineSale',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=32, unique=True)),
+                ('username', models.CharField(max_length=16)),
+                ('products', models.TextField()),
+                ('cost', models.IntegerField()),
+                ('bought_on', models.DateTimeField()),
+                ('replayed_on', models.DateTimeField(auto_now_add=True)),
+                ('status', models.CharField(choices=[('replayed', 'Replayed'), ('stregforbud', 'Stregforbud'), ('out_of_stock', 'Out of stock'), ('invalid', 'Unknown member, room or products')], max_length=16)),
+                ('resolved', models.BooleanField(default=False)),
+                ('member', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='stregsystem.Member')),
+                ('room', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='stregsystem.Room')),
+            ],
+            options={
+                'ordering': ['-bought_on'],
+            },
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-16 19:48
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stregsystem', '0014_purchasetoken'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='member',
+            name='username',
+            field=models.CharField(db_index=True, max_length=16),
+        ),
+    ]
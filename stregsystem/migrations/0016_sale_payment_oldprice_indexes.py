@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-16 19:48
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stregsystem', '0015_member_username_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='sale',
+            name='timestamp',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='oldprice',
+            index_together=set([('product', 'changed_on')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='payment',
+            index_together=set([('member', 'timestamp')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='sale',
+            index_together=set([('product', 'timestamp'), ('member', 'timestamp'), ('room', 'timestamp')]),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-16 21:02
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.db.models import Count, Min, Sum
+
+
+def merge_duplicate_rollups(apps, schema_editor):
+    SaleRollup = apps.get_model('stregsystem', 'SaleRollup')
+    duplicates = (
+        SaleRollup.objects
+        .values('day', 'product_id', 'member_id', 'room_id')
+        .annotate(rows=Count('id'), first_id=Min('id'),
+                  total_count=Sum('count'), total_price_sum=Sum('price_sum'))
+        .filter(rows__gt=1)
+        .order_by()
+    )
+    for row in list(duplicates):
+        SaleRollup.objects.filter(pk=row['first_id']).update(
+            count=row['total_count'],
+            price_sum=row['total_price_sum'],
+        )
+        (SaleRollup.objects
+         .filter(day=row['day'], product_id=row['product_id'],
+                 member_id=row['member_id'], room_id=row['room_id'])
+         .exclude(pk=row['first_id'])
+         .delete())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stregsystem', '0017_member_last_purchase_on'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_rollups, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='salerollup',
+            unique_together=set([('day', 'product', 'member', 'room')]),
+        ),
+    ]
@@ -1,11 +1,19 @@
 from collections import Counter
+from datetime import timedelta
 
-from django.db import models, transaction
-from django.db.models import Count
+from django.db import IntegrityError, models, transaction
+from django.db.models import F, Q
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
 from django.utils import timezone
 
 from stregsystem.deprecated import deprecated
 from stregsystem.templatetags.stregsystem_extras import money
+from stregsystem.utils import (
+    forget_member_id,
+    invalidate_product_lists,
+    publish_sale_event
+)
 
 
 def price_display(value):
@@ -19,6 +27,27 @@ def active_str(a):
         return "-"
 
 
+def publish_sale_on_commit(member, timestamp, lines):
+    """
+    Tell the live dashboards about a sale, of (product, count, price sum)
+    lines, once it's committed
+    """
+    event = {
+        "type": "sale",
+        "timestamp": timestamp,
+        "member": {
+            "username": member.username,
+            "firstname": member.firstname,
+            "lastname": member.lastname,
+        },
+        "products": [
+            {"id": product.id, "name": product.name, "count": count, "price": price_sum}
+            for product, count, price_sum in lines
+        ],
+    }
+    transaction.on_commit(lambda: publish_sale_event(event))
+
+
 # Errors
 class StregForbudError(Exception):
     pass
@@ -78,17 +107,32 @@ class OrderItem(object):
 
 
 class Order(object):
-    def __init__(self, member, room, items=None):
+    def __init__(self, member, room, items=None, token=None):
         self.member = member
         self.room = room
         self.created_on = timezone.now()
         self.items = items or set()  # Set to none because we don't persist
+        # A PurchaseToken from the client, sending the same order again with
+        # the same token doesn't buy it again
+        self.token = token
+        # Whether execute found the order bought already
+        self.replayed = False
+        # When the member bought something before this order, set by execute
+        self.previous_purchase_on = None
 
     @classmethod
-    def from_products(cls, member, room, products):
+    def from_products(cls, member, room, products, token=None):
         counts = Counter(products)
-        order = cls(member, room)
-        for (product, count) in counts.items():
+        return cls.from_product_counts(member, room, counts.items(), token)
+
+    @classmethod
+    def from_product_counts(cls, member, room, product_counts, token=None):
+        """
+        Create an order from (product, count) pairs, each product must only
+        appear once
+        """
+        order = cls(member, room, token=token)
+        for (product, count) in product_counts:
             item = OrderItem(
                 product=product,
                 order=order,
@@ -105,36 +149,68 @@ class Order(object):
 
     @transaction.atomic
     def execute(self):
+        if (self.token is not None
+                and not PurchaseToken.claim(self.token, self.member,
+                                            self.created_on)):
+            # Bought by an earlier request with the same token, so do what
+            # that request did, which is nothing more.
+            self.replayed = True
+            return
+
         transaction = PayTransaction(amount=self.total())
 
-        # Check if we have enough inventory to fulfill the order
+        # Check if we have enough inventory to fulfill the order, and take it
+        # from the stock if we do. If anything below fails the transaction is
+        # rolled back, and the inventory with it.
         for item in self.items:
             if (item.product.start_date is not None
-                    and (item.product.bought + item.count
-                         > item.product.quantity)):
+                    and not item.product.take_inventory(item.count,
+                                                        self.created_on)):
                 raise NoMoreInventoryError()
 
         if not self.member.can_fulfill(transaction):
             raise StregForbudError()
 
-        self.member.fulfill(transaction)
+        self.previous_purchase_on = self.member.last_purchase_on
+        self.member.fulfill(transaction, purchased_on=self.created_on)
+
+        # @HACK Since we want to use the old database layout, we need to
+        # add a sale for every item and every instance of that item. They are
+        # all written with a single multi-row insert, which bypasses
+        # Sale.save, so we don't hit the database once per unit.
+        sales = Sale.objects.bulk_create(
+            Sale(
+                member=self.member,
+                product=item.product,
+                room=self.room,
+                price=item.product.price
+            )
+            for item in self.items
+            for i in range(item.count)
+        )
+        if not sales:
+            # An order of nothing, there is nothing more to write down
+            return
 
         for item in self.items:
-            # @HACK Since we want to use the old database layout, we need to
-            # add a sale for every item and every instance of that item
-            for i in range(item.count):
-                s = Sale(
-                    member=self.member,
-                    product=item.product,
-                    room=self.room,
-                    price=item.product.price
-                )
-                s.save()
-
-            # Bought (used above) is automatically calculated, so we don't need
-            # to update it
-        # We changed the user balance, so save that
-        self.member.save()
+            SaleRollup.add(
+                sales[0].timestamp,
+                item.product,
+                self.member,
+                self.room,
+                item.count,
+                item.product.price * item.count)
+        publish_sale_on_commit(
+            self.member,
+            self.created_on,
+            [(item.product, item.count, item.product.price * item.count)
+             for item in self.items])
+
+        alcohol_ml = sum(
+            (item.product.alcohol_content_ml or 0.0) * item.count
+            for item in self.items)
+        if alcohol_ml > 0:
+            self.member.add_alcohol(alcohol_ml, self.created_on)
 
 
 class GetTransaction(MoneyTransaction):
@@ -154,7 +230,7 @@ class Member(models.Model):  # id automatisk...
         ('F', 'Female'),
     )
     active = models.BooleanField(default=True)
-    username = models.CharField(max_length=16)
+    username = models.CharField(max_length=16, db_index=True)
     year = models.CharField(max_length=4)  # "dato" inkluderer maaned/dag...
     firstname = models.CharField(max_length=20)  # for 'firstname'
     lastname = models.CharField(max_length=30)  # for 'lastname'
@@ -164,6 +240,12 @@ class Member(models.Model):  # id automatisk...
     balance = models.IntegerField(default=0)  # hvor mange oerer vedkommende har til gode
     undo_count = models.IntegerField(default=0)  # for 'undos' i alt
     notes = models.TextField(blank=True)
+    # The blood alcohol content as of bac_as_of. See calculate_alcohol_promille
+    bac = models.FloatField(default=0.0, editable=False)
+    bac_as_of = models.DateTimeField(blank=True, null=True, editable=False)
+    # When the member last bought something through an Order, for the
+    # multibuy hint
+    last_purchase_on = models.DateTimeField(blank=True, null=True, editable=False)
 
     stregforbud_override = False
 
@@ -194,21 +276,54 @@ class Member(models.Model):  # id automatisk...
         >>> jokke.balance
         100
         """
-        self.balance = self.balance + amount
+        self.change_balance(amount)
 
-    def fulfill(self, transaction):
+    def fulfill(self, transaction, purchased_on=None):
         """
-        Fulfill the transaction
+        Fulfill the transaction. If it's a purchase, purchased_on is stored
+        as the time of the last purchase.
         """
         if not self.can_fulfill(transaction):
             raise StregForbudError
-        self.balance += transaction.change()
+        # The check above used the balance we fetched, another terminal might
+        # have spent the money since. The database gets the final say.
+        if not self.change_balance(transaction.change(), minimum=0,
+                                   purchased_on=purchased_on):
+            raise StregForbudError
 
     def rollback(self, transaction):
         """
         Rollback transaction
         """
-        self.balance -= transaction.change()
+        self.change_balance(-transaction.change())
+
+    def change_balance(self, change, minimum=None, purchased_on=None):
+        """
+        Atomically add change to the balance. If minimum is given the balance
+        is only changed if it doesn't go below it. Returns whether the balance
+        was changed. purchased_on is stored as the time of the last purchase
+        along with the balance.
+
+        Only the balance is written, and it is changed relative to what is in
+        the database, so concurrent changes to the same member aren't lost.
+        """
+        if self.pk is None:
+            if minimum is not None and self.balance + change < minimum:
+                return False
+            self.balance += change
+            if purchased_on is not None:
+                self.last_purchase_on = purchased_on
+            return True
+
+        members = Member.objects.filter(pk=self.pk)
+        if minimum is not None:
+            members = members.filter(balance__gte=minimum - change)
+        updates = {"balance": F("balance") + change}
+        if purchased_on is not None:
+            updates["last_purchase_on"] = purchased_on
+        changed = members.update(**updates) > 0
+        self.refresh_from_db(fields=["balance", "last_purchase_on"])
+        return changed
 
     def can_fulfill(self, transaction):
         """
@@ -234,31 +349,76 @@ class Member(models.Model):  # id automatisk...
 
         return self.balance - buy < 0
 
-    # BAC in this method stands for "Blood alcohol content"
-    def calculate_alcohol_promille(self):
-        from stregsystem.booze import alcohol_bac_timeline, Gender
+    def _booze_gender(self):
+        from stregsystem.booze import Gender
+
+        if self.gender == "M":
+            return Gender.MALE
+        elif self.gender == "F":
+            return Gender.FEMALE
+        return Gender.UNKNOWN
+
+    def _save_bac(self, bac, as_of):
+        self.bac = bac
+        self.bac_as_of = as_of
+        Member.objects.filter(pk=self.pk).update(bac=bac, bac_as_of=as_of)
+
+    def add_alcohol(self, alcohol_ml, timestamp):
+        """
+        Update the stored BAC with a drink of alcohol_ml at timestamp
+        """
+        from stregsystem.booze import alcohol_bac_at, alcohol_bac_increase
+
+        # Read the state again under lock, another terminal might have sold
+        # something to this member since we fetched it
+        bac, as_of = (
+            Member.objects
+            .select_for_update()
+            .values_list("bac", "bac_as_of")
+            .get(pk=self.pk))
+
+        if as_of is not None and timestamp < as_of:
+            # Drinks must be added in order, so start over
+            self.recalculate_alcohol_promille()
+            return
+
+        if as_of is not None:
+            bac = alcohol_bac_at(bac, as_of, timestamp)
+        bac += alcohol_bac_increase(self._booze_gender(), 80, alcohol_ml)
+        self._save_bac(bac, timestamp)
+
+    def recalculate_alcohol_promille(self):
+        """
+        Rebuild the stored BAC from the sales, used when sales are removed
+        """
+        from stregsystem.booze import alcohol_bac_timeline
         from datetime import timedelta
 
         now = timezone.now()
         # Lets assume noone is drinking 12 hours straight
         calculation_start = now - timedelta(hours=12)
 
-        alcohol_sales = (
+        alcohol_timeline = (
             self.sale_set
             .filter(timestamp__gt=calculation_start,
                     product__alcohol_content_ml__gt=0.0)
             .order_by('timestamp')
+            .values_list('timestamp', 'product__alcohol_content_ml')
         )
-        alcohol_timeline = [(s.timestamp, s.product.alcohol_content_ml)
-                            for s in alcohol_sales]
 
-        gender = Gender.UNKNOWN
-        if self.gender == "M":
-            gender = Gender.MALE
-        elif self.gender == "F":
-            gender = Gender.FEMALE
+        bac = alcohol_bac_timeline(self._booze_gender(), 80, now,
+                                   list(alcohol_timeline))
+        self._save_bac(bac, now)
+
+    # BAC in this method stands for "Blood alcohol content"
+    def calculate_alcohol_promille(self):
+        from stregsystem.booze import alcohol_bac_at
 
-        bac = alcohol_bac_timeline(gender, 80, now, alcohol_timeline)
+        # The stored BAC is updated when drinks are bought, so all we need to
+        # do is to let it degrade until now
+        bac = 0.0
+        if self.bac_as_of is not None:
+            bac = alcohol_bac_at(self.bac, self.bac_as_of, timezone.now())
 
         # Tihi:
         drunken_bastards = {
@@ -278,6 +438,11 @@ class Payment(models.Model):  # id automatisk...
     timestamp = models.DateTimeField(auto_now_add=True)
     amount = models.IntegerField()  # penge, oere...
 
+    class Meta:
+        index_together = [
+            ["member", "timestamp"],
+        ]
+
     @deprecated
     def amount_display(self):
         return money(self.amount) + " kr."
@@ -294,17 +459,15 @@ class Payment(models.Model):  # id automatisk...
         if self.id:
             return  # update -- should not be allowed
         else:
-            # TODO: Make atomic
-            self.member.make_payment(self.amount)
-            super(Payment, self).save(*args, **kwargs)
-            self.member.save()
+            with transaction.atomic():
+                self.member.make_payment(self.amount)
+                super(Payment, self).save(*args, **kwargs)
 
     def delete(self, *args, **kwargs):
         if self.id:
-            # TODO: Make atomic
-            self.member.make_payment(-self.amount)
-            super(Payment, self).delete(*args, **kwargs)
-            self.member.save()
+            with transaction.atomic():
+                self.member.make_payment(-self.amount)
+                super(Payment, self).delete(*args, **kwargs)
         else:
             super(Payment, self).delete(*args, **kwargs)
 
@@ -339,6 +502,9 @@ class Product(models.Model): # id automatisk...
     categories = models.ManyToManyField(Category, blank=True)
     rooms = models.ManyToManyField(Room, blank=True)
     alcohol_content_ml = models.FloatField(default=0.0, null=True)
+    # Number of sales since start_date. Kept up to date by the sale write
+    # path, rebuild it with the reconcile_bought command if it drifts.
+    bought_count = models.IntegerField(default=0, editable=False)
 
     @deprecated
     def __unicode__(self):
@@ -352,7 +518,29 @@ class Product(models.Model): # id automatisk...
                 price_changed = oldprice != self.price
             except OldPrice.DoesNotExist:  # der findes varer hvor der ikke er nogen "tidligere priser"
                 pass
-        super(Product, self).save(*args, **kwargs)
+        old_start_dates = []
+        if self.id and not kwargs.get("force_insert"):
+            old_start_dates = list(
+                Product.objects
+                .filter(pk=self.pk)
+                .values_list("start_date", flat=True))
+
+        with transaction.atomic():
+            if old_start_dates and "update_fields" not in kwargs:
+                # The bought counter belongs to the sale write path. Writing
+                # the one we fetched could undo a sale made since.
+                kwargs["update_fields"] = [
+                    field.name for field in self._meta.concrete_fields
+                    if not field.primary_key and field.name != "bought_count"
+                ]
+            super(Product, self).save(*args, **kwargs)
+            if old_start_dates and old_start_dates[0] != self.start_date:
+                # What counts as bought has changed. The save above holds the
+                # row, so sales can't slip in between the count and the write.
+                self.bought_count = self.count_bought()
+                (Product.objects
+                 .filter(pk=self.pk)
+                 .update(bought_count=self.bought_count))
         if price_changed:
             OldPrice.objects.create(product=self, price=self.price)
 
@@ -362,10 +550,57 @@ class Product(models.Model): # id automatisk...
         # bought count - Jesper 27/09-2017
         if self.start_date is None:
             return 0
-        return (
-            self.sale_set
-            .filter(timestamp__gt=self.start_date)
-            .aggregate(bought=Count("id"))["bought"])
+        return self.bought_count
+
+    def count_bought(self):
+        """
+        Count the sales since start_date straight from the sales table.
+        """
+        if self.start_date is None or self.id is None:
+            return 0
+        return self.sale_set.filter(timestamp__gt=self.start_date).count()
+
+    def counts_as_bought(self, timestamp):
+        """
+        Does a sale at the given time count towards the limited stock
+        """
+        return (self.start_date is not None
+                and timezone.localtime(timestamp).date() >= self.start_date)
+
+    def add_bought(self, count, timestamp):
+        """
+        Atomically add to the bought counter, if a sale at the given time
+        counts towards the limited stock
+        """
+        if not self.counts_as_bought(timestamp):
+            return
+        (Product.objects
+         .filter(pk=self.pk)
+         .update(bought_count=F("bought_count") + count))
+        self.bought_count += count
+        # The product might just have gone in or out of stock
+        invalidate_product_lists()
+
+    def take_inventory(self, count, timestamp):
+        """
+        Atomically take count items from the limited stock. Returns False,
+        without changing anything, if there isn't enough left.
+        """
+        bought = count if self.counts_as_bought(timestamp) else 0
+        updated = (
+            Product.objects
+            .filter(pk=self.pk, bought_count__lte=F("quantity") - count)
+            .update(bought_count=F("bought_count") + bought))
+        if updated == 0:
+            return False
+        self.bought_count = (
+            Product.objects
+            .values_list("bought_count", flat=True)
+            .get(pk=self.pk))
+        if self.bought_count >= self.quantity:
+            # We just sold the last one, so it shouldn't be listed anymore
+            invalidate_product_lists()
+        return True
 
     def is_active(self):
         expired = (self.deactivate_date is not None
@@ -386,6 +621,11 @@ class OldPrice(models.Model):  # gamle priser, skal huskes; til regnskab/statist
     price = models.IntegerField()  # penge, oere...
     changed_on = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        index_together = [
+            ["product", "changed_on"],
+        ]
+
     @deprecated
     def __unicode__(self):
         return self.product.name + ": " + money(self.price) + " (" + str(self.changed_on) + ")"
@@ -394,12 +634,14 @@ class Sale(models.Model):
     member = models.ForeignKey(Member)
     product = models.ForeignKey(Product)
     room = models.ForeignKey(Room, null=True)
-    timestamp = models.DateTimeField(auto_now_add=True)
+    timestamp = models.DateTimeField(auto_now_add=True, db_index=True)
     price = models.IntegerField()
 
     class Meta:
         index_together = [
             ["product", "timestamp"],
+            ["member", "timestamp"],
+            ["room", "timestamp"],
         ]
 
     def price_display(self):
@@ -416,7 +658,16 @@ class Sale(models.Model):
     def save(self, *args, **kwargs):
         if self.id:
             raise RuntimeError("Updates of sales are not allowed")
-        super(Sale, self).save(*args, **kwargs)
+        with transaction.atomic():
+            super(Sale, self).save(*args, **kwargs)
+            self.product.add_bought(1, self.timestamp)
+            SaleRollup.add(self.timestamp, self.product, self.member,
+                           self.room, 1, self.price)
+            publish_sale_on_commit(self.member, self.timestamp,
+                                   [(self.product, 1, self.price)])
+            if self.product.alcohol_content_ml:
+                self.member.add_alcohol(self.product.alcohol_content_ml,
+                                        self.timestamp)
 
     def delete(self, *args, **kwargs):
         if self.id:
@@ -425,6 +676,229 @@ class Sale(models.Model):
             raise RuntimeError("You can't delete a sale that hasn't happened")
 
 
+# How long a purchase token keeps a purchase from being bought again
+PURCHASE_TOKEN_LIFETIME = timedelta(days=1)
+
+
+class PurchaseToken(models.Model):
+    """
+    A token the client sends along with a purchase, so sending the same
+    purchase again (a reload, a second click, a retry after a timeout) doesn't
+    buy it twice. Only kept for PURCHASE_TOKEN_LIFETIME.
+    """
+    token = models.CharField(max_length=64, unique=True)
+    member = models.ForeignKey(Member)
+    created_on = models.DateTimeField(db_index=True)
+
+    @classmethod
+    def claim(cls, token, member, now):
+        """
+        Record that token is used to buy something now. Returns False if it
+        has been used before. Must be called inside the transaction of the
+        purchase, so the token is released again if the purchase fails.
+
+        The expired tokens of member are thrown away on the way, so they don't
+        pile up. Only those of members who stop buying are left for the
+        expire_purchase_tokens command.
+        """
+        cls.objects.filter(
+            Q(token=token) | Q(member=member),
+            created_on__lt=now - PURCHASE_TOKEN_LIFETIME).delete()
+        try:
+            with transaction.atomic():
+                cls.objects.create(token=token, member=member, created_on=now)
+        except IntegrityError:
+            return False
+        return True
+
+    @classmethod
+    def expire(cls, now=None):
+        """
+        Delete the tokens that are too old to stop anything
+        """
+        now = now or timezone.now()
+        return cls.objects.filter(
+            created_on__lt=now - PURCHASE_TOKEN_LIFETIME).delete()[0]
+
+
+class SaleRollup(models.Model):
+    """
+    The sales of a day, summed up per product, member and room.
+
+    The reports read these instead of the sales table, so they don't have to
+    go through every sale of a year. The rows are kept up to date by the sale
+    write path, rebuild them with the rebuild_sale_rollup command if they
+    drift.
+
+    There is one row per day, product, member and room. The database can't
+    hold that for rows without a room, as NULLs never collide, so sum the rows
+    rather than reading one.
+    """
+    day = models.DateField()
+    product = models.ForeignKey(Product)
+    member = models.ForeignKey(Member)
+    room = models.ForeignKey(Room, null=True)
+    count = models.IntegerField(default=0)
+    price_sum = models.IntegerField(default=0)
+
+    class Meta:
+        index_together = [
+            ["day", "product"],
+            ["day", "member"],
+        ]
+        unique_together = [
+            ["day", "product", "member", "room"],
+        ]
+
+    @classmethod
+    def add(cls, timestamp, product, member, room, count, price_sum):
+        """
+        Atomically add count sales, costing price_sum in total, to the rollup
+        of the day of timestamp
+        """
+        day = timezone.localtime(timestamp).date()
+        rows = cls.objects.filter(day=day, product=product, member=member,
+                                  room=room)
+        rollup_id = rows.values_list("pk", flat=True).first()
+        # Taking sales away from a missing row can only happen when the
+        # member or product is being deleted along with its rollup.
+        if rollup_id is None and count > 0:
+            try:
+                with transaction.atomic():
+                    cls.objects.create(day=day, product=product,
+                                       member=member, room=room,
+                                       count=count, price_sum=price_sum)
+                return
+            except IntegrityError:
+                # Another sale made the row first, add to that one
+                rollup_id = rows.values_list("pk", flat=True).first()
+        # Update a single row, so a doubled row doesn't count the sales twice
+        (cls.objects
+         .filter(pk=rollup_id)
+         .update(count=F("count") + count,
+                 price_sum=F("price_sum") + price_sum))
+
+
+class SalesSeriesChange(models.Model):
+    """
+    When the sales of a day that is over last changed, by a refund or a
+    rebuilt rollup. The reports key their cached sales series on it. It's kept
+    in the database, as the cache of another process wouldn't hear about it.
+    """
+    changed_on = models.DateTimeField()
+
+    @classmethod
+    def last(cls):
+        """
+        When the sales last changed, or None if they never have
+        """
+        return cls.objects.filter(pk=1).values_list(
+            "changed_on", flat=True).first()
+
+    @classmethod
+    def record(cls):
+        """
+        Throw away the cached sales series of every day
+        """
+        cls.objects.update_or_create(
+            pk=1, defaults={"changed_on": timezone.now()})
+
+
+class RankGroup(models.Model):
+    """
+    A group of products whose buyers are ranked against each other on the
+    yearly ranks page
+    """
+    name = models.CharField(max_length=64)
+    products = models.ManyToManyField(Product, blank=True)
+    # Where the group is shown on the ranks page, lowest first
+    position = models.IntegerField(default=0)
+
+    class Meta:
+        ordering = ["position", "name"]
+
+    def __unicode__(self):
+        return self.__str__()
+
+    def __str__(self):
+        return self.name
+
+
+class RankSnapshot(models.Model):
+    """
+    The frozen ranks of a year that has ended. A year's ranks can't change
+    once it's over, so they are only worked out once.
+    """
+    year = models.IntegerField(unique=True)
+    from_time = models.DateTimeField()
+    to_time = models.DateTimeField()
+    created_on = models.DateTimeField(auto_now_add=True)
+
+    @classmethod
+    def invalidate(cls, timestamp=None):
+        """
+        Throw away the snapshots covering timestamp, or all of them
+        """
+        snapshots = cls.objects.all()
+        if timestamp is not None:
+            snapshots = snapshots.filter(from_time__lt=timestamp,
+                                         to_time__gte=timestamp)
+        snapshots.delete()
+
+
+class RankSnapshotEntry(models.Model):
+    snapshot = models.ForeignKey(RankSnapshot, related_name="entries")
+    # The money spent ranking has no group
+    rank_group = models.ForeignKey(RankGroup, null=True)
+    member = models.ForeignKey(Member)
+    position = models.IntegerField()
+    # Number of sales, or money spent in oere
+    value = models.IntegerField()
+
+    class Meta:
+        ordering = ["position"]
+
+
+class OfflineSale(models.Model):
+    """
+    A quickbuy made while a terminal couldn't reach the database, replayed
+    from its offline journal. The key makes sure it's only replayed once, and
+    the ones that couldn't be replayed are kept for someone to sort out.
+    """
+    REPLAYED = "replayed"
+    STREGFORBUD = "stregforbud"
+    OUT_OF_STOCK = "out_of_stock"
+    INVALID = "invalid"
+    STATUS_CHOICES = (
+        (REPLAYED, "Replayed"),
+        (STREGFORBUD, "Stregforbud"),
+        (OUT_OF_STOCK, "Out of stock"),
+        (INVALID, "Unknown member, room or products"),
+    )
+
+    key = models.CharField(max_length=32, unique=True)
+    username = models.CharField(max_length=16)
+    member = models.ForeignKey(Member, null=True, blank=True)
+    room = models.ForeignKey(Room, null=True, blank=True)
+    # The products bought, written like a quickbuy ("1:2 3")
+    products = models.TextField()
+    cost = models.IntegerField()  # penge, oere...
+    # When it was bought at the terminal, the sales are made when replayed
+    bought_on = models.DateTimeField()
+    replayed_on = models.DateTimeField(auto_now_add=True)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES)
+    resolved = models.BooleanField(default=False)
+
+    class Meta:
+        ordering = ["-bought_on"]
+
+    def __unicode__(self):
+        return self.__str__()
+
+    def __str__(self):
+        return "{} {}: {}".format(self.username, self.bought_on, self.products)
+
+
 # XXX
 class News(models.Model):
     title = models.CharField(max_length=64)
@@ -438,3 +912,40 @@ class News(models.Model):
     @deprecated
     def __unicode__(self):
         return self.title + " -- " + str(self.pub_date)
+
+
+@receiver(post_delete, sender=Sale)
+def sale_deleted(sender, instance, **kwargs):
+    # Deleting (or refunding) a sale puts the item back into the stock. This
+    # is a signal so bulk deletes of sales are handled too.
+    instance.product.add_bought(-1, instance.timestamp)
+    SaleRollup.add(instance.timestamp, instance.product, instance.member,
+                   instance.room, -1, -instance.price)
+    if instance.product.alcohol_content_ml:
+        instance.member.recalculate_alcohol_promille()
+    # Refunding a sale from a year that has ended changes its ranks
+    RankSnapshot.invalidate(instance.timestamp)
+    SalesSeriesChange.record()
+    # The dashboards can't take a sale back, they have to start over
+    transaction.on_commit(lambda: publish_sale_event({"type": "refund"}))
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(m2m_changed, sender=Product.rooms.through)
+def product_changed(sender, **kwargs):
+    invalidate_product_lists()
+
+
+@receiver(post_save, sender=RankGroup)
+@receiver(post_delete, sender=RankGroup)
+@receiver(m2m_changed, sender=RankGroup.products.through)
+def rank_group_changed(sender, **kwargs):
+    RankSnapshot.invalidate()
+
+
+@receiver(post_save, sender=Member)
+@receiver(post_delete, sender=Member)
+def member_changed(sender, instance, **kwargs):
+    # The username or active may have changed
+    forget_member_id(instance.id)
@@ -0,0 +1,333 @@
+"""
+The offline terminal mode.
+
+When a terminal can't reach the database the sale view writes the quickbuys to
+a local SQLite journal instead, checked against a snapshot of the members and
+products taken while it could. replay_offline_journal sends them through
+Order.execute once the database is back, and keeps the ones that couldn't be
+bought as OfflineSales for the admin.
+"""
+import json
+import sqlite3
+import uuid
+from collections import Counter, namedtuple
+from contextlib import contextmanager
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count
+from django.utils import dateparse, timezone
+
+from stregsystem.models import (
+    Member,
+    NoMoreInventoryError,
+    OfflineSale,
+    Order,
+    Product,
+    Room,
+    StregForbudError
+)
+from stregsystem.utils import make_active_productlist_query
+
+
+class UnknownMemberError(Exception):
+    pass
+
+
+class UnknownProductsError(Exception):
+    def __init__(self, product_ids):
+        self.product_ids = product_ids
+
+
+JournalEntry = namedtuple(
+    "JournalEntry",
+    ["key", "room_id", "member_id", "username", "product_counts", "cost",
+     "bought_on"])
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    room_id INTEGER NOT NULL,
+    member_id INTEGER NOT NULL,
+    username TEXT NOT NULL,
+    product_counts TEXT NOT NULL,
+    cost INTEGER NOT NULL,
+    bought_on TEXT NOT NULL,
+    replayed INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS entries_pending ON entries (replayed, bought_on);
+CREATE TABLE IF NOT EXISTS members (
+    username TEXT PRIMARY KEY,
+    id INTEGER NOT NULL,
+    balance INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS products (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    price INTEGER NOT NULL,
+    room_ids TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS snapshot (
+    taken_on TEXT NOT NULL
+);
+"""
+
+
+class OfflineJournal(object):
+    def __init__(self, path):
+        self.path = path
+
+    @contextmanager
+    def _transaction(self):
+        connection = sqlite3.connect(self.path, timeout=10,
+                                     isolation_level=None)
+        try:
+            connection.executescript(_SCHEMA)
+            # Take the write lock up front, so two requests can't both spend
+            # the same balance
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield connection
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+        finally:
+            connection.close()
+
+    def write_snapshot(self, members, products, taken_on):
+        """
+        Replace the snapshot with members, as (id, username, balance), and
+        products, as (id, name, price, room ids). No room ids means every
+        room.
+        """
+        with self._transaction() as connection:
+            connection.execute("DELETE FROM members")
+            connection.execute("DELETE FROM products")
+            connection.execute("DELETE FROM snapshot")
+            connection.executemany(
+                "INSERT INTO members (id, username, balance) VALUES (?, ?, ?)",
+                members)
+            connection.executemany(
+                "INSERT INTO products (id, name, price, room_ids) "
+                "VALUES (?, ?, ?, ?)",
+                ((product_id, name, price, json.dumps(sorted(room_ids)))
+                 for product_id, name, price, room_ids in products))
+            connection.execute("INSERT INTO snapshot (taken_on) VALUES (?)",
+                               (taken_on.isoformat(),))
+
+    def snapshot_taken_on(self):
+        with self._transaction() as connection:
+            row = connection.execute("SELECT taken_on FROM snapshot").fetchone()
+        return dateparse.parse_datetime(row[0]) if row else None
+
+    def product_list(self, room_id):
+        """
+        The products of the snapshot that can be bought in room_id
+        """
+        with self._transaction() as connection:
+            rows = connection.execute(
+                "SELECT id, name, price, room_ids FROM products ORDER BY id"
+            ).fetchall()
+        return [
+            {"id": product_id, "name": name, "price": price}
+            for product_id, name, price, room_ids in rows
+            if _in_room(room_ids, room_id)
+        ]
+
+    def record(self, room_id, username, product_counts, now=None):
+        """
+        Check a quickbuy against the snapshot and write it to the journal.
+        Returns the entry and the bought (product, count) pairs.
+
+        Raises UnknownMemberError, UnknownProductsError, or StregForbudError
+        if the balance of the snapshot, less what is waiting in the journal,
+        doesn't cover it.
+        """
+        now = now or timezone.now()
+        product_counts = list(product_counts)
+        with self._transaction() as connection:
+            member = connection.execute(
+                "SELECT id, balance FROM members WHERE username = ?",
+                (username,)).fetchone()
+            if member is None:
+                raise UnknownMemberError()
+
+            products = {}
+            for product_id, count in product_counts:
+                row = connection.execute(
+                    "SELECT id, name, price, room_ids FROM products "
+                    "WHERE id = ?", (product_id,)).fetchone()
+                if row is not None and _in_room(row[3], room_id):
+                    products[product_id] = {
+                        "id": row[0], "name": row[1], "price": row[2]}
+            invalid_product_ids = sorted(
+                set(product_id for product_id, count in product_counts)
+                - set(products))
+            if invalid_product_ids:
+                raise UnknownProductsError(invalid_product_ids)
+
+            cost = sum(products[product_id]["price"] * count
+                       for product_id, count in product_counts)
+            pending, = connection.execute(
+                "SELECT COALESCE(SUM(cost), 0) FROM entries "
+                "WHERE username = ? AND replayed = 0",
+                (username,)).fetchone()
+            if member[1] - pending - cost < 0:
+                raise StregForbudError()
+
+            entry = JournalEntry(
+                key=uuid.uuid4().hex,
+                room_id=int(room_id),
+                member_id=member[0],
+                username=username,
+                product_counts=product_counts,
+                cost=cost,
+                bought_on=now)
+            connection.execute(
+                "INSERT INTO entries (key, room_id, member_id, username, "
+                "product_counts, cost, bought_on) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (entry.key, entry.room_id, entry.member_id, entry.username,
+                 json.dumps(entry.product_counts), entry.cost,
+                 entry.bought_on.isoformat()))
+
+        return entry, [(products[product_id], count)
+                       for product_id, count in product_counts]
+
+    def pending(self, limit):
+        """
+        The oldest entries that haven't been replayed
+        """
+        with self._transaction() as connection:
+            rows = connection.execute(
+                "SELECT key, room_id, member_id, username, product_counts, "
+                "cost, bought_on FROM entries WHERE replayed = 0 "
+                "ORDER BY bought_on, key LIMIT ?", (limit,)).fetchall()
+        return [
+            JournalEntry(
+                key=key,
+                room_id=room_id,
+                member_id=member_id,
+                username=username,
+                product_counts=[tuple(pair) for pair in json.loads(counts)],
+                cost=cost,
+                bought_on=dateparse.parse_datetime(bought_on))
+            for key, room_id, member_id, username, counts, cost, bought_on
+            in rows
+        ]
+
+    def mark_replayed(self, keys):
+        with self._transaction() as connection:
+            connection.executemany(
+                "UPDATE entries SET replayed = 1 WHERE key = ?",
+                ((key,) for key in keys))
+
+
+def _in_room(room_ids, room_id):
+    room_ids = json.loads(room_ids)
+    return not room_ids or int(room_id) in room_ids
+
+
+def take_snapshot(journal):
+    """
+    Write the active members and the products that can be bought now to the
+    snapshot of journal. A username shared by more than one active member
+    can't be told apart, so it is left out.
+    """
+    shared_usernames = (
+        Member.objects
+        .filter(active=True)
+        .values("username")
+        .annotate(members=Count("id"))
+        .filter(members__gt=1)
+        .values_list("username", flat=True)
+        .order_by())
+    members = (
+        Member.objects
+        .filter(active=True)
+        .exclude(username__in=list(shared_usernames))
+        .values_list("id", "username", "balance"))
+    products = list(
+        make_active_productlist_query(Product.objects)
+        .values_list("id", "name", "price"))
+    room_ids = {}
+    for product_id, room_id in (
+            Product.rooms.through.objects
+            .filter(product_id__in=[product[0] for product in products])
+            .values_list("product_id", "room_id")):
+        room_ids.setdefault(product_id, []).append(room_id)
+
+    journal.write_snapshot(
+        members.iterator(),
+        [(product_id, name, price, room_ids.get(product_id, []))
+         for product_id, name, price in products],
+        timezone.now())
+    return len(products)
+
+
+def replay_entry(entry):
+    """
+    Buy entry through Order.execute, returning the status of the OfflineSale
+    recorded for it, or None if it has been replayed before
+    """
+    # The member the snapshot found, even if the username has been taken by
+    # someone else since
+    member = Member.objects.filter(pk=entry.member_id).first()
+    room = Room.objects.filter(pk=entry.room_id).first()
+    # The terminal already let them have the products, so they're bought
+    # even if they have been deactivated since
+    products = Product.objects.in_bulk(
+        [product_id for product_id, count in entry.product_counts])
+
+    status = OfflineSale.REPLAYED
+    if (member is None or room is None
+            or len(products) != len(entry.product_counts)):
+        status = OfflineSale.INVALID
+
+    try:
+        with transaction.atomic():
+            if status == OfflineSale.REPLAYED:
+                order = Order.from_product_counts(
+                    member=member,
+                    room=room,
+                    product_counts=[(products[product_id], count)
+                                    for product_id, count
+                                    in entry.product_counts])
+                try:
+                    order.execute()
+                except StregForbudError:
+                    status = OfflineSale.STREGFORBUD
+                except NoMoreInventoryError:
+                    status = OfflineSale.OUT_OF_STOCK
+
+            OfflineSale.objects.create(
+                key=entry.key,
+                username=entry.username,
+                member=member,
+                room=room,
+                products=" ".join(
+                    "{}:{}".format(product_id, count) if count > 1
+                    else str(product_id)
+                    for product_id, count in entry.product_counts),
+                cost=entry.cost,
+                bought_on=entry.bought_on,
+                status=status,
+                resolved=status == OfflineSale.REPLAYED)
+    except IntegrityError:
+        # Replayed before, and the order went with this transaction
+        return None
+    return status
+
+
+def replay(journal, batch_size=100):
+    """
+    Replay the journal a batch at a time, returning how many entries ended
+    up with each status
+    """
+    statuses = Counter()
+    while True:
+        entries = journal.pending(batch_size)
+        if not entries:
+            return statuses
+        for entry in entries:
+            statuses[replay_entry(entry)] += 1
+        journal.mark_replayed([entry.key for entry in entries])
@@ -1,3 +1,5 @@
+from collections import OrderedDict
+
 import regex
 
 
@@ -32,17 +34,43 @@ def get_token_indexes(string, start_index):
         end = i + 1
     return start, end
 
+
 def parse(buy_string):
     return username(buy_string, 0)
 
+
+def parse_counts(buy_string, max_count=None):
+    """
+    Parse a quickbuy, returning the username and a list of (productId, count)
+    pairs. Every productId appears only once, in the order it was first
+    bought, and products bought zero times are left out.
+
+    Unlike parse, nothing here grows with the quantifiers. A quantifier larger
+    than max_count is a parse error, None means no limit.
+    """
+    username, items = _parse_items(buy_string, 0, max_count)
+    counts = OrderedDict()
+    for product_id, count in items:
+        if count > 0:
+            counts[product_id] = counts.get(product_id, 0) + count
+    return username, list(counts.items())
+
+
 def username(buy_string, start_index):
+    username, items = _parse_items(buy_string, start_index, None)
+    return username, [product_id
+                      for product_id, count in items
+                      for i in range(count)]
+
+
+def _parse_items(buy_string, start_index, max_count):
     start, end = get_token_indexes(buy_string, start_index)
     if start == -1:
         raise QuickBuyError(buy_string[0: start_index], buy_string[start_index: len(buy_string)])
     username = buy_string[start: end]
 
     # Parse items
-    product_lists = []
+    items = []
     while end != len(buy_string):
         prev_start, prev_end = start, end
         start, end = get_token_indexes(buy_string, end)
@@ -50,16 +78,24 @@ def username(buy_string, start_index):
             raise QuickBuyError(buy_string[0: prev_end],
                                 buy_string[prev_end: len(buy_string)])
         try:
-            product_lists.append(item(buy_string[start: end]))
+            items.append(item_count(buy_string[start: end], max_count))
         except QuickBuyParseError:
             raise QuickBuyError(buy_string[0: start], buy_string[start: len(buy_string)])
 
-    return username, [product for product_list in product_lists for product in product_list]
+    return username, items
+
 
 def item(token):
+    product_id, count = item_count(token)
+    return [product_id] * count
+
+
+def item_count(token, max_count=None):
     match = _item_matcher.fullmatch(token)
     if match:
-        return [int(match.group('productId'))] * (
-            int(match.group('count') or 1))
+        count = int(match.group('count') or 1)
+        if max_count is not None and count > max_count:
+            raise QuickBuyParseError
+        return int(match.group('productId')), count
     else:
         raise QuickBuyParseError
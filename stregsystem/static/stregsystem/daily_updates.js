@@ -0,0 +1,114 @@
+// Keeps the daily stats up to date with the sales pushed from the server,
+// instead of reloading the whole page.
+(function ($) {
+	var container = $("#statscontainer");
+	var updatesUrl = container.data("updates-url");
+	var sequence = container.data("sequence");
+	var revenueDay = Number(container.data("revenue-day"));
+	var revenueMonth = Number(container.data("revenue-month"));
+	var rowsShown = 7;
+
+	function money(oere) {
+		return (oere / 100).toFixed(2) + " kr";
+	}
+
+	function cell(text) {
+		return $("<td>").text(text);
+	}
+
+	function addLatestSale(event, line) {
+		var member = event.member;
+		for (var i = 0; i < Math.min(line.count, rowsShown); i++) {
+			$("<tr>")
+				.append(cell("now"))
+				.append(cell(line.id))
+				.append(cell(line.name))
+				.append(cell(member.username))
+				.append(cell(member.firstname + " " + member.lastname))
+				.insertAfter($("#latest_sales tr").first());
+		}
+		$("#latest_sales tr").slice(rowsShown + 1).remove();
+	}
+
+	function addTopToday(line) {
+		var table = $("#top_today");
+		var row = table.find("tr[data-product-id='" + line.id + "']");
+		if (row.length === 0) {
+			row = $("<tr>")
+				.attr("data-product-id", line.id)
+				.append(cell(line.id))
+				.append(cell(line.name))
+				.append(cell(0))
+				.appendTo(table);
+		}
+		var count = row.children().eq(2);
+		count.text(Number(count.text()) + line.count);
+
+		var rows = table.find("tr[data-product-id]").detach().get();
+		rows.sort(function (a, b) {
+			return Number($(b).children().eq(2).text()) - Number($(a).children().eq(2).text());
+		});
+		table.append(rows.slice(0, rowsShown));
+	}
+
+	function addSale(event) {
+		event.products.forEach(function (line) {
+			revenueDay += line.price;
+			revenueMonth += line.price;
+			addLatestSale(event, line);
+			addTopToday(line);
+		});
+		$("#revenue_day").text(money(revenueDay));
+		$("#revenue_month").text(money(revenueMonth));
+	}
+
+	// How often to ask for new sales
+	var pollInterval = 5000;
+	// Polls in a row that found a newer sale missing. It's most likely being
+	// written, but after a while it must be lost.
+	var stalled = 0;
+
+	function poll() {
+		$.getJSON(updatesUrl, {after: sequence})
+			.done(function (data) {
+				if (data.reset) {
+					if (data.sequence < sequence) {
+						// The sales started over, the cache was emptied. Go on
+						// from there, the reload below picks up what we missed.
+						sequence = data.sequence;
+						setTimeout(poll, pollInterval);
+						return;
+					}
+					// Too far behind to catch up
+					location.reload();
+					return;
+				}
+				sequence = data.sequence;
+				for (var i = 0; i < data.events.length; i++) {
+					if (data.events[i].type !== "sale") {
+						// Refunds can't be taken back here
+						location.reload();
+						return;
+					}
+					addSale(data.events[i]);
+				}
+				stalled = data.pending && data.events.length === 0 ? stalled + 1 : 0;
+				if (stalled >= 4) {
+					location.reload();
+					return;
+				}
+				setTimeout(poll, pollInterval);
+			})
+			.fail(function () {
+				setTimeout(poll, pollInterval);
+			});
+	}
+
+	poll();
+
+	// Old sales leaving the 24 hour and 30 day windows, and the categories,
+	// aren't pushed, so start over now and then.
+	setTimeout(function () {
+		location.reload();
+	}, 15 * 60 * 1000);
+})(jQuery);
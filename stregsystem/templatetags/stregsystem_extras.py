@@ -1,3 +1,5 @@
+import uuid
+
 from django import template
 
 register = template.Library()
@@ -10,3 +12,11 @@ def money(value):
 
 
 register.filter('money', money)
+
+
+@register.simple_tag
+def purchase_token():
+    """
+    A new token to send along with a purchase, see PurchaseToken
+    """
+    return uuid.uuid4().hex
@@ -1,8 +1,18 @@
 # -*- coding: utf-8 -*-
 import datetime
+import json
+import os
+import random
+import tempfile
 from collections import Counter
 
-from django.test import TestCase
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import OperationalError, connection
+from django.db.models import Count, F, Q, Sum
+from django.db.models.functions import TruncDay
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.utils import timezone
 from freezegun import freeze_time
@@ -12,28 +22,64 @@ from stregreport import views
 from stregsystem import admin
 from stregsystem import views as stregsystem_views
 from stregsystem.admin import CategoryAdmin, ProductAdmin
-from stregsystem.booze import ballmer_peak
+from stregsystem.booze import (
+    Gender,
+    alcohol_bac_timeline,
+    alcohol_bac_timelines,
+    ballmer_peak,
+    ballmer_peakers,
+    ballmer_peaks
+)
 from stregsystem.models import (
+    PURCHASE_TOKEN_LIFETIME,
     Category,
     GetTransaction,
     Member,
     NoMoreInventoryError,
+    OfflineSale,
     Order,
     OrderItem,
     Payment,
     PayTransaction,
     Product,
+    PurchaseToken,
     Room,
     Sale,
+    SaleRollup,
     StregForbudError,
     active_str,
     price_display
 )
+from stregsystem.offline import (
+    OfflineJournal,
+    UnknownMemberError,
+    UnknownProductsError,
+    replay,
+    replay_entry,
+    take_snapshot
+)
+from stregsystem.utils import (
+    SALE_EVENTS_KEPT,
+    cached_member_id,
+    cached_product_list,
+    forget_member_id,
+    make_active_productlist_query,
+    make_inactive_productlist_query,
+    publish_sale_event,
+    remember_member_id,
+    sale_event_sequence,
+    sale_events_after
+)
+
+try:
+    from unittest.mock import ANY, patch
+except ImportError:
+    from mock import ANY, patch
 
 try:
-    from unittest.mock import patch
+    from io import StringIO
 except ImportError:
-    from mock import patch
+    from StringIO import StringIO
 
 
 def assertCountEqual(case, *args, **kwargs):
@@ -80,6 +126,16 @@ class SaleViewTests(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertTemplateUsed("stregsystem/error_invalidquickbuy.html")
 
+    def test_make_sale_quickbuy_max_count(self):
+        Member.objects.filter(username="jokke").update(balance=1000 * 900)
+
+        most = self.client.post(reverse('quickbuy', args=(1,)), {"quickbuy": "jokke 1:1000"})
+        too_many = self.client.post(reverse('quickbuy', args=(1,)), {"quickbuy": "jokke 1:1001"})
+
+        self.assertTemplateUsed(most, "stregsystem/index_sale.html")
+        self.assertEqual(0, Member.objects.get(username="jokke").balance)
+        self.assertTemplateUsed(too_many, "stregsystem/error_invalidquickbuy.html")
+
     @patch('stregsystem.models.Member.can_fulfill')
     @patch('stregsystem.models.Member.fulfill')
     def test_make_sale_quickbuy_success(self, fulfill, can_fulfill):
@@ -99,7 +155,7 @@ class SaleViewTests(TestCase):
         self.assertEqual(response.context["member"],
                          Member.objects.get(username="jokke"))
 
-        fulfill.assert_called_once_with(PayTransaction(900))
+        fulfill.assert_called_once_with(PayTransaction(900), purchased_on=ANY)
 
     def test_make_sale_quickbuy_fail(self):
         member_username = 'jan'
@@ -155,7 +211,7 @@ class SaleViewTests(TestCase):
         self.assertEqual(response.context["bought"], Product.objects.get(id=1))
         self.assertEqual(response.context["member"], Member.objects.get(id=1))
 
-        fulfill.assert_called_once_with(PayTransaction(900))
+        fulfill.assert_called_once_with(PayTransaction(900), purchased_on=ANY)
 
     def test_quicksale_has_status_line(self):
         response = self.client.post(
@@ -170,6 +226,20 @@ class SaleViewTests(TestCase):
             html=True
         )
 
+    def test_quicksale_has_status_line_with_count(self):
+        Member.objects.filter(username="jokke").update(balance=10000)
+        response = self.client.post(
+            reverse('quickbuy', args=(1,)),
+            {"quickbuy": "jokke 1:3"}
+        )
+
+        self.assertContains(
+            response,
+            "<b>jokke har lige købt 3 x Limfjordsporter for tilsammen "
+            "27.00 kr.</b>",
+            html=True
+        )
+
     def test_usermenu(self):
         response = self.client.post(
             reverse('quickbuy', args=(1,)),
@@ -295,6 +365,44 @@ class SaleViewTests(TestCase):
         self.assertEqual(before_product.bought, after_product.bought)
         self.assertEqual(before_member.balance, after_member.balance)
 
+    def test_quicksale_reports_invalid_products(self):
+        before_member = Member.objects.get(username="jokke")
+
+        response = self.client.post(
+            reverse('quickbuy', args=(1,)),
+            {"quickbuy": "jokke 1 99 4 99"}
+        )
+
+        after_member = Member.objects.get(username="jokke")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTemplateUsed(response, "stregsystem/menu.html")
+        self.assertEqual([4, 99], response.context["invalid_product_ids"])
+        self.assertEqual(before_member.balance, after_member.balance)
+
+    def test_quicksale_queries_independent_of_count(self):
+        Member.objects.filter(username="jokke").update(balance=10000)
+        # The first sale of the day also has to create the rollup of the day
+        self.client.post(
+            reverse('quickbuy', args=(1,)),
+            {"quickbuy": "jokke 1"}
+        )
+        cache.clear()
+        with CaptureQueriesContext(connection) as single:
+            self.client.post(
+                reverse('quickbuy', args=(1,)),
+                {"quickbuy": "jokke 1"}
+            )
+        cache.clear()
+        with CaptureQueriesContext(connection) as multi:
+            response = self.client.post(
+                reverse('quickbuy', args=(1,)),
+                {"quickbuy": "jokke 1:5"}
+            )
+
+        self.assertTemplateUsed(response, "stregsystem/index_sale.html")
+        self.assertEqual(len(single), len(multi))
+
     def test_quicksale_product_available_all_rooms(self):
         before_product = Product.objects.get(id=1)
         before_member = Member.objects.get(username="jokke")
@@ -328,39 +436,477 @@ class SaleViewTests(TestCase):
         self.assertEqual(before_member.balance, after_member.balance)
 
     def test_multibuy_hint_not_applicable(self):
-        member = Member.objects.get(username="jokke")
-        self.assertFalse(stregsystem_views._multibuy_hint(timezone.now(), member))
+        self.assertFalse(stregsystem_views._multibuy_hint(timezone.now(), None))
 
     def test_multibuy_hint_one_buy_not_applicable(self):
-        member = Member.objects.get(username="jokke")
-        coke = Product.objects.create(
-            name="coke",
-            price=100,
-            active=True
-        )
-        Sale.objects.create(
-            member=member,
-            product=coke,
-            price=100,
-        )
-        self.assertFalse(stregsystem_views._multibuy_hint(timezone.now(), member))
+        now = timezone.now()
+        self.assertFalse(stregsystem_views._multibuy_hint(
+            now, now - datetime.timedelta(seconds=61)))
 
     def test_multibuy_hint_two_buys_applicable(self):
+        now = timezone.now()
+        self.assertTrue(stregsystem_views._multibuy_hint(
+            now, now - datetime.timedelta(seconds=30)))
+
+    def test_quicksale_multibuy_hint(self):
+        first = self.client.post(reverse('quickbuy', args=(1,)), {"quickbuy": "jokke 1"})
+        with CaptureQueriesContext(connection) as context:
+            second = self.client.post(reverse('quickbuy', args=(1,)), {"quickbuy": "jokke 1"})
+
+        self.assertFalse(first.context["give_multibuy_hint"])
+        self.assertTrue(second.context["give_multibuy_hint"])
+        self.assertFalse(any("DISTINCT" in query["sql"] for query in context.captured_queries))
+
+    def test_menusale_multibuy_hint(self):
+        Member.objects.filter(id=1).update(last_purchase_on=timezone.now() - datetime.timedelta(seconds=10))
+
+        response = self.client.get(reverse('menu_sale', args=(1, 1, 1)))
+
+        self.assertTrue(response.context["give_multibuy_hint"])
+        self.assertIsNotNone(Member.objects.get(id=1).last_purchase_on)
+
+
+class ApiSaleTests(TestCase):
+    fixtures = ["initial_data"]
+
+    def post_json(self, data):
+        return self.client.post(reverse('api_sale', args=(1,)),
+                                json.dumps(data),
+                                content_type="application/json")
+
+    def test_quickbuy(self):
+        before_member = Member.objects.get(username="jokke")
+
+        response = self.client.post(reverse('api_sale', args=(1,)),
+                                    {"quickbuy": "jokke 1"})
+
+        after_member = Member.objects.get(username="jokke")
+        data = response.json()
+        self.assertEqual(200, response.status_code)
+        self.assertEqual("ok", data["status"])
+        self.assertEqual(900, data["cost"])
+        self.assertEqual(after_member.balance, data["member"]["balance"])
+        self.assertEqual(before_member.balance - 900, after_member.balance)
+        self.assertEqual([{"id": 1, "name": "Limfjordsporter", "count": 1, "price": 900}],
+                         data["products"])
+        self.assertIn("promille", data["member"])
+
+    def test_structured_order(self):
+        before_member = Member.objects.get(username="jokke")
+
+        response = self.post_json({"member": "jokke", "products": [{"id": 1, "count": 2}]})
+
+        after_member = Member.objects.get(username="jokke")
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(1800, response.json()["cost"])
+        self.assertEqual(before_member.balance - 1800, after_member.balance)
+
+    def test_quickbuy_in_json(self):
+        response = self.post_json({"quickbuy": "jokke 1"})
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(900, response.json()["cost"])
+
+    def test_no_products_looks_up_member(self):
+        before_member = Member.objects.get(username="jokke")
+        sales_before = Sale.objects.count()
+
+        response = self.post_json({"quickbuy": "jokke"})
+
+        data = response.json()
+        self.assertEqual(0, data["cost"])
+        self.assertEqual(before_member.balance, data["member"]["balance"])
+        self.assertEqual(sales_before, Sale.objects.count())
+
+    def test_invalid_quickbuy(self):
+        response = self.post_json({"quickbuy": "jokke a"})
+
+        data = response.json()
+        self.assertEqual(400, response.status_code)
+        self.assertEqual("invalid_quickbuy", data["error"])
+        self.assertEqual("jokke ", data["parsed_part"])
+        self.assertEqual("a", data["failed_part"])
+
+    def test_invalid_order(self):
+        for order in ([1], {"member": "jokke", "products": [{"count": 1}]},
+                      {"member": "jokke", "products": [{"id": 1, "count": 1001}]},
+                      {"member": "jokke", "products": None},
+                      {"member": "jokke", "products": 5},
+                      {"member": "jokke", "products": [1]}):
+            response = self.post_json(order)
+            self.assertEqual(400, response.status_code)
+            self.assertEqual("invalid_order", response.json()["error"])
+
+    def test_member_not_found(self):
+        response = self.post_json({"quickbuy": "nobody 1"})
+
+        self.assertEqual(404, response.status_code)
+        self.assertEqual("member_not_found", response.json()["error"])
+
+    def test_invalid_products(self):
+        before_member = Member.objects.get(username="jokke")
+
+        response = self.post_json({"quickbuy": "jokke 1 99 4"})
+
+        self.assertEqual(400, response.status_code)
+        self.assertEqual([4, 99], response.json()["product_ids"])
+        self.assertEqual(before_member.balance,
+                         Member.objects.get(username="jokke").balance)
+
+    def test_stregforbud(self):
+        before_member = Member.objects.get(username="jan")
+
+        response = self.post_json({"quickbuy": "jan 1"})
+
+        self.assertEqual(402, response.status_code)
+        self.assertEqual("stregforbud", response.json()["error"])
+        self.assertEqual(before_member.balance,
+                         Member.objects.get(username="jan").balance)
+
+    def test_out_of_stock(self):
+        response = self.post_json({"quickbuy": "jokke 3"})
+
+        self.assertEqual(409, response.status_code)
+        self.assertEqual("out_of_stock", response.json()["error"])
+
+    def test_get_not_allowed(self):
+        response = self.client.get(reverse('api_sale', args=(1,)))
+        self.assertEqual(405, response.status_code)
+
+    def test_fewer_queries_than_page(self):
+        Member.objects.filter(username="jokke").update(balance=10000)
+        # The first sale of the day also has to create the rollup of the day
+        self.post_json({"quickbuy": "jokke 1"})
+        cache.clear()
+        with CaptureQueriesContext(connection) as api:
+            self.post_json({"quickbuy": "jokke 1"})
+        cache.clear()
+        with CaptureQueriesContext(connection) as page:
+            self.client.post(reverse('quickbuy', args=(1,)), {"quickbuy": "jokke 1"})
+
+        self.assertLess(len(api), len(page))
+
+
+class OfflineJournalTests(TestCase):
+    fixtures = ["initial_data"]
+
+    def setUp(self):
+        cache.clear()
+        handle, self.path = tempfile.mkstemp(suffix=".sqlite3")
+        os.close(handle)
+        self.addCleanup(os.remove, self.path)
+        self.journal = OfflineJournal(self.path)
+        take_snapshot(self.journal)
+
+    def test_snapshot(self):
+        self.assertIsNotNone(self.journal.snapshot_taken_on())
+        self.assertEqual([1, 2], [product["id"] for product in self.journal.product_list(1)])
+        self.assertEqual([1, 2, 4], [product["id"] for product in self.journal.product_list(2)])
+
+    def test_record(self):
+        entry, bought = self.journal.record(1, "jokke", [(1, 2)])
+
+        self.assertEqual(1800, entry.cost)
+        self.assertEqual([("Limfjordsporter", 2)], [(product["name"], count) for product, count in bought])
+        self.assertEqual([entry.key], [pending.key for pending in self.journal.pending(10)])
+
+    def test_record_unknown_member(self):
+        with self.assertRaises(UnknownMemberError):
+            self.journal.record(1, "nobody", [(1, 1)])
+
+    def test_record_unknown_products(self):
+        with self.assertRaises(UnknownProductsError) as context:
+            self.journal.record(1, "jokke", [(1, 1), (99, 1), (4, 1)])
+        self.assertEqual([4, 99], context.exception.product_ids)
+
+    def test_record_counts_pending_against_balance(self):
+        self.journal.record(1, "jokke", [(1, 1)])
+        self.journal.record(1, "jokke", [(1, 1)])
+
+        with self.assertRaises(StregForbudError):
+            self.journal.record(1, "jokke", [(1, 1)])
+        self.assertEqual(2, len(self.journal.pending(10)))
+
+    def test_replay(self):
+        self.journal.record(1, "jokke", [(1, 2)])
+        sales_before = Sale.objects.count()
+
+        statuses = replay(self.journal, batch_size=1)
+
+        self.assertEqual(1, statuses[OfflineSale.REPLAYED])
+        self.assertEqual(sales_before + 2, Sale.objects.count())
+        self.assertEqual(0, Member.objects.get(username="jokke").balance)
+        offline_sale = OfflineSale.objects.get()
+        self.assertEqual("1:2", offline_sale.products)
+        self.assertTrue(offline_sale.resolved)
+        self.assertEqual([], self.journal.pending(10))
+
+    def test_replay_charges_snapshot_member(self):
+        jokke = Member.objects.get(username="jokke")
+        entry, bought = self.journal.record(1, "jokke", [(1, 1)])
+        Member.objects.filter(pk=jokke.pk).update(username="jokke_old")
+        namesake = Member.objects.create(username="jokke", balance=100000)
+
+        self.assertEqual(OfflineSale.REPLAYED, replay_entry(entry))
+
+        self.assertEqual(jokke.balance - 900, Member.objects.get(pk=jokke.pk).balance)
+        self.assertEqual(100000, Member.objects.get(pk=namesake.pk).balance)
+
+    def test_snapshot_leaves_out_shared_usernames(self):
+        Member.objects.create(username="jokke", balance=100000)
+        take_snapshot(self.journal)
+
+        with self.assertRaises(UnknownMemberError):
+            self.journal.record(1, "jokke", [(1, 1)])
+
+    def test_replay_entry_only_once(self):
+        entry, bought = self.journal.record(1, "jokke", [(1, 1)])
+
+        self.assertEqual(OfflineSale.REPLAYED, replay_entry(entry))
+        self.assertIsNone(replay_entry(entry))
+
+        self.assertEqual(900, Member.objects.get(username="jokke").balance)
+
+    def test_replay_conflicts(self):
+        self.journal.record(1, "jokke", [(1, 1)])
+        self.journal.record(1, "jokke", [(2, 1)])
+        Member.objects.filter(username="jokke").update(balance=900)
+        Product.objects.filter(id=2).update(quantity=0)
+
+        statuses = replay(self.journal)
+
+        self.assertEqual(1, statuses[OfflineSale.REPLAYED])
+        self.assertEqual(1, statuses[OfflineSale.OUT_OF_STOCK])
+        self.assertEqual(0, Member.objects.get(username="jokke").balance)
+        conflict = OfflineSale.objects.get(resolved=False)
+        self.assertEqual(OfflineSale.OUT_OF_STOCK, conflict.status)
+
+    def test_replay_stregforbud(self):
+        self.journal.record(1, "jokke", [(1, 1)])
+        Member.objects.filter(username="jokke").update(balance=0)
+
+        replay(self.journal)
+
+        self.assertEqual(OfflineSale.STREGFORBUD, OfflineSale.objects.get().status)
+        self.assertEqual(0, Member.objects.get(username="jokke").balance)
+
+    def test_sale_falls_back_to_journal(self):
+        with self.settings(OFFLINE_JOURNAL=self.path), \
+                patch('stregsystem.views.get_object_or_404', side_effect=OperationalError):
+            response = self.client.post(reverse('quickbuy', args=(1,)), {"quickbuy": "jokke 1"})
+
+        self.assertTemplateUsed(response, "stregsystem/offline_sale.html")
+        self.assertEqual(900, response.context["cost"])
+        self.assertEqual(1, len(self.journal.pending(10)))
+
+    def test_sale_falls_back_when_order_fails(self):
+        balance_before = Member.objects.get(username="jokke").balance
+        with self.settings(OFFLINE_JOURNAL=self.path), \
+                patch('stregsystem.views.Order.execute', side_effect=OperationalError):
+            response = self.client.post(reverse('quickbuy', args=(1,)), {"quickbuy": "jokke 1"})
+
+        self.assertTemplateUsed(response, "stregsystem/offline_sale.html")
+        self.assertEqual(1, len(self.journal.pending(10)))
+        self.assertEqual(balance_before, Member.objects.get(username="jokke").balance)
+
+    def test_sale_offline_stregforbud(self):
+        with self.settings(OFFLINE_JOURNAL=self.path), \
+                patch('stregsystem.views.get_object_or_404', side_effect=OperationalError):
+            response = self.client.post(reverse('quickbuy', args=(1,)), {"quickbuy": "jan 1"})
+
+        self.assertEqual("stregforbud", response.context["error"])
+        self.assertEqual([], self.journal.pending(10))
+
+    def test_sale_offline_invalid_quickbuy(self):
+        with self.settings(OFFLINE_JOURNAL=self.path), \
+                patch('stregsystem.views.get_object_or_404', side_effect=OperationalError):
+            response = self.client.post(reverse('quickbuy', args=(1,)), {"quickbuy": "jokke 1a"})
+
+        self.assertEqual("invalid_quickbuy", response.context["error"])
+        self.assertContains(response, '<span style="color: red;">1a</span>')
+
+    def test_sale_without_journal_fails(self):
+        with self.settings(OFFLINE_JOURNAL=None), \
+                patch('stregsystem.views.get_object_or_404', side_effect=OperationalError):
+            with self.assertRaises(OperationalError):
+                self.client.post(reverse('quickbuy', args=(1,)), {"quickbuy": "jokke 1"})
+
+    def test_replay_command(self):
+        self.journal.record(1, "jokke", [(1, 1)])
+        out = StringIO()
+
+        with self.settings(OFFLINE_JOURNAL=self.path):
+            call_command("replay_offline_journal", stdout=out)
+
+        self.assertIn("Replayed 1 entries", out.getvalue())
+        self.assertEqual(900, self.journal.record(1, "jokke", [(1, 1)])[0].cost)
+        with self.assertRaises(StregForbudError):
+            self.journal.record(1, "jokke", [(1, 1)])
+
+
+class PurchaseTokenTests(TestCase):
+    fixtures = ["initial_data"]
+
+    def setUp(self):
+        cache.clear()
+
+    def buy(self, token, member="jokke"):
+        order = Order.from_products(
+            member=Member.objects.get(username=member),
+            room=Room.objects.get(id=1),
+            products=(Product.objects.get(id=1),),
+            token=token)
+        order.execute()
+        return order
+
+    def test_token_bought_once(self):
+        sales_before = Sale.objects.count()
+
+        first = self.buy("abc")
+        second = self.buy("abc")
+
+        self.assertFalse(first.replayed)
+        self.assertTrue(second.replayed)
+        self.assertEqual(sales_before + 1, Sale.objects.count())
+        self.assertEqual(900, Member.objects.get(username="jokke").balance)
+
+    def test_without_token_bought_again(self):
+        self.buy(None)
+        self.buy(None)
+        self.assertEqual(0, Member.objects.get(username="jokke").balance)
+
+    def test_failed_purchase_releases_token(self):
+        with self.assertRaises(StregForbudError):
+            self.buy("abc", member="jan")
+        Member.objects.filter(username="jan").update(balance=900)
+
+        self.assertFalse(self.buy("abc", member="jan").replayed)
+        self.assertEqual(0, Member.objects.get(username="jan").balance)
+
+    def test_expired_token_bought_again(self):
+        with freeze_time(timezone.now() - PURCHASE_TOKEN_LIFETIME - datetime.timedelta(minutes=1)):
+            self.buy("abc")
+
+        self.assertFalse(self.buy("abc").replayed)
+        self.assertEqual(0, Member.objects.get(username="jokke").balance)
+
+    def test_purchase_expires_old_tokens_of_member(self):
+        Member.objects.filter(username="jan").update(balance=900)
+        with freeze_time(timezone.now() - PURCHASE_TOKEN_LIFETIME - datetime.timedelta(minutes=1)):
+            self.buy("old")
+            self.buy("other", member="jan")
+
+        self.buy("new")
+
+        self.assertEqual(["new", "other"],
+                         sorted(PurchaseToken.objects.values_list("token", flat=True)))
+
+    def test_quickbuy_resubmitted(self):
+        for _ in range(2):
+            response = self.client.post(reverse('quickbuy', args=(1,)),
+                                        {"quickbuy": "jokke 1", "token": "abc"})
+            self.assertTemplateUsed(response, "stregsystem/index_sale.html")
+
+        self.assertEqual(900, Member.objects.get(username="jokke").balance)
+
+    def test_quickbuy_form_has_new_token(self):
+        first = self.client.get(reverse('menu_index', args=(1,)))
+        second = self.client.get(reverse('menu_index', args=(1,)))
+
+        self.assertContains(first, 'name="token"')
+        self.assertNotEqual(first.content, second.content)
+
+    def test_menu_sale_reloaded(self):
+        url = reverse('menu_sale', args=(1, 1, 1)) + "?token=abc"
+        for _ in range(2):
+            response = self.client.get(url)
+            self.assertTemplateUsed(response, "stregsystem/menu.html")
+
+        self.assertEqual(900, Member.objects.get(username="jokke").balance)
+        self.assertContains(response, "/?token=")
+
+    def test_api_retried(self):
+        for replayed in (False, True):
+            response = self.client.post(reverse('api_sale', args=(1,)),
+                                        json.dumps({"quickbuy": "jokke 1", "token": "abc"}),
+                                        content_type="application/json")
+            self.assertEqual(replayed, response.json()["replayed"])
+            self.assertEqual(900, response.json()["cost"])
+
+        self.assertEqual(900, Member.objects.get(username="jokke").balance)
+
+    def test_bad_token_ignored(self):
+        for _ in range(2):
+            self.client.post(reverse('quickbuy', args=(1,)),
+                             {"quickbuy": "jokke 1", "token": "not a token"})
+
+        self.assertEqual(0, Member.objects.get(username="jokke").balance)
+
+    def test_expire_command(self):
+        Member.objects.filter(username="jan").update(balance=900)
+        with freeze_time(timezone.now() - PURCHASE_TOKEN_LIFETIME - datetime.timedelta(minutes=1)):
+            self.buy("old")
+        # Another member, so the purchase doesn't expire the old token itself
+        self.buy("new", member="jan")
+        out = StringIO()
+
+        call_command("expire_purchase_tokens", stdout=out)
+
+        self.assertEqual(["new"], list(PurchaseToken.objects.values_list("token", flat=True)))
+        self.assertIn("Deleted 1 purchase tokens", out.getvalue())
+
+
+class MemberLookupTests(TestCase):
+    fixtures = ["initial_data"]
+
+    def setUp(self):
+        forget_member_id()
+
+    def test_remembered(self):
+        stregsystem_views._active_member("jokke")
+
+        self.assertEqual(1, cached_member_id("jokke"))
+        with CaptureQueriesContext(connection) as context:
+            member = stregsystem_views._active_member("jokke")
+        self.assertEqual(1, member.id)
+        self.assertEqual(1, len(context))
+        self.assertIn('"stregsystem_member"."id" = 1', context.captured_queries[0]["sql"])
+
+    def test_balance_read_fresh(self):
+        stregsystem_views._active_member("jokke")
+        Member.objects.filter(username="jokke").update(balance=42)
+
+        self.assertEqual(42, stregsystem_views._active_member("jokke").balance)
+
+    def test_forgotten_on_save(self):
+        stregsystem_views._active_member("jokke")
         member = Member.objects.get(username="jokke")
-        coke = Product.objects.create(
-            name="coke",
-            price=100,
-            active=True
-        )
-        with freeze_time(datetime.datetime(2000, 1, 1)) as frozen_time:
-            for i in range(1, 2):
-                Sale.objects.create(
-                    member=member,
-                    product=coke,
-                    price=100,
-                )
-                frozen_time.tick()
-        self.assertTrue(stregsystem_views._multibuy_hint(datetime.datetime(2000, 1, 1), member))
+        member.username = "jokke2"
+        member.save()
+
+        self.assertIsNone(cached_member_id("jokke"))
+        with self.assertRaises(Member.DoesNotExist):
+            stregsystem_views._active_member("jokke")
+
+    def test_changed_elsewhere(self):
+        # Another process deactivates the member, this one doesn't hear of it
+        stregsystem_views._active_member("jokke")
+        Member.objects.filter(username="jokke").update(active=False)
+
+        with self.assertRaises(Member.DoesNotExist):
+            stregsystem_views._active_member("jokke")
+        self.assertIsNone(cached_member_id("jokke"))
+
+    def test_least_recently_used_dropped(self):
+        with patch('stregsystem.utils.MEMBER_IDS_KEPT', 2):
+            remember_member_id("a", 1)
+            remember_member_id("b", 2)
+            cached_member_id("a")
+            remember_member_id("c", 3)
+
+        self.assertEqual(1, cached_member_id("a"))
+        self.assertIsNone(cached_member_id("b"))
+        self.assertEqual(3, cached_member_id("c"))
 
 
 class UserInfoViewTests(TestCase):
@@ -503,7 +1049,7 @@ class OrderTest(TestCase):
 
         order.execute()
 
-        fulfill.assert_called_once_with(PayTransaction(10))
+        fulfill.assert_called_once_with(PayTransaction(10), purchased_on=order.created_on)
 
     @patch('stregsystem.models.Member.fulfill')
     def test_order_execute_multi_transaction(self, fulfill):
@@ -514,16 +1060,56 @@ class OrderTest(TestCase):
 
         order.execute()
 
-        fulfill.assert_called_once_with(PayTransaction(20))
+        fulfill.assert_called_once_with(PayTransaction(20), purchased_on=order.created_on)
+
+    def test_order_execute_creates_sale_per_unit(self):
+        order = Order(self.member, self.room)
+
+        item = OrderItem(self.product, order, 3)
+        order.items.add(item)
+
+        order.execute()
+
+        sales = Sale.objects.filter(member=self.member, product=self.product)
+        self.assertEqual(sales.count(), 3)
+        for sale in sales:
+            self.assertEqual(sale.price, 10)
+            self.assertEqual(sale.room, self.room)
+            self.assertIsNotNone(sale.timestamp)
+
+    def test_order_execute_nothing(self):
+        for counts in ([], [0]):
+            order = Order(self.member, self.room)
+            for count in counts:
+                order.items.add(OrderItem(self.product, order, count))
+
+            order.execute()
+
+        self.assertEqual(100, Member.objects.get(pk=self.member.pk).balance)
+        self.assertFalse(Sale.objects.exists())
+        self.assertFalse(SaleRollup.objects.exists())
+
+    @patch('stregsystem.models.Sale.save')
+    def test_order_execute_bulk_inserts_sales(self, save):
+        order = Order(self.member, self.room)
+
+        item = OrderItem(self.product, order, 5)
+        order.items.add(item)
+
+        order.execute()
+
+        save.assert_not_called()
+        self.assertEqual(Sale.objects.filter(member=self.member).count(), 5)
 
     @patch('stregsystem.models.Member.fulfill')
     def test_order_execute_single_no_remaining(self, fulfill):
+        self.product.start_date = datetime.date(year=2017, month=1, day=1)
+        self.product.quantity = 1
+        self.product.save()
         self.product.sale_set.create(
             price=100,
             member=self.member
         )
-        self.product.start_date = datetime.date(year=2017, month=1, day=1)
-        self.product.quantity = 1
         order = Order(self.member, self.room)
 
         item = OrderItem(self.product, order, 1)
@@ -536,12 +1122,13 @@ class OrderTest(TestCase):
 
     @patch('stregsystem.models.Member.fulfill')
     def test_order_execute_multi_some_remaining(self, fulfill):
+        self.product.start_date = datetime.date(year=2017, month=1, day=1)
+        self.product.quantity = 2
+        self.product.save()
         self.product.sale_set.create(
             price=100,
             member=self.member
         )
-        self.product.start_date = datetime.date(year=2017, month=1, day=1)
-        self.product.quantity = 2
         order = Order(self.member, self.room)
 
         item = OrderItem(self.product, order, 2)
@@ -730,6 +1317,162 @@ class ProductTests(TestCase):
 
         self.assertFalse(product.is_active())
 
+    def test_bought_counts_sales(self):
+        product = Product.objects.create(
+            active=True,
+            price=100,
+            quantity=5,
+            start_date=datetime.date(year=2017, month=1, day=1)
+        )
+        product.sale_set.create(
+            price=100,
+            member=self.jeff
+        )
+        product.sale_set.create(
+            price=100,
+            member=self.jeff
+        )
+
+        self.assertEqual(2, Product.objects.get(pk=product.pk).bought)
+
+    def test_bought_ignores_sales_before_start_date(self):
+        product = Product.objects.create(
+            active=True,
+            price=100,
+            quantity=5,
+            start_date=datetime.date(year=2017, month=1, day=1)
+        )
+        with freeze_time(datetime.datetime(2016, 12, 31)):
+            product.sale_set.create(
+                price=100,
+                member=self.jeff
+            )
+
+        self.assertEqual(0, Product.objects.get(pk=product.pk).bought)
+
+    def test_bought_decreases_on_delete(self):
+        product = Product.objects.create(
+            active=True,
+            price=100,
+            quantity=5,
+            start_date=datetime.date(year=2017, month=1, day=1)
+        )
+        sale = product.sale_set.create(
+            price=100,
+            member=self.jeff
+        )
+
+        sale.delete()
+
+        self.assertEqual(0, Product.objects.get(pk=product.pk).bought)
+
+    def test_bought_decreases_on_bulk_delete(self):
+        product = Product.objects.create(
+            active=True,
+            price=100,
+            quantity=5,
+            start_date=datetime.date(year=2017, month=1, day=1)
+        )
+        for i in range(3):
+            product.sale_set.create(
+                price=100,
+                member=self.jeff
+            )
+
+        Sale.objects.filter(
+            pk__in=product.sale_set.values_list("pk", flat=True)[:2]
+        ).delete()
+
+        self.assertEqual(1, Product.objects.get(pk=product.pk).bought)
+
+    def test_bought_recounted_when_start_date_changes(self):
+        product = Product.objects.create(
+            active=True,
+            price=100,
+            quantity=5,
+        )
+        with freeze_time(datetime.datetime(2017, 1, 5)):
+            product.sale_set.create(
+                price=100,
+                member=self.jeff
+            )
+
+        product.start_date = datetime.date(year=2017, month=1, day=1)
+        product.save()
+        self.assertEqual(1, Product.objects.get(pk=product.pk).bought)
+
+        product.start_date = datetime.date(year=2017, month=2, day=1)
+        product.save()
+        self.assertEqual(0, Product.objects.get(pk=product.pk).bought)
+
+    def test_take_inventory(self):
+        product = Product.objects.create(
+            active=True,
+            price=100,
+            quantity=3,
+            start_date=datetime.date(year=2017, month=1, day=1)
+        )
+
+        self.assertTrue(product.take_inventory(2, timezone.now()))
+        self.assertFalse(product.take_inventory(2, timezone.now()))
+        self.assertTrue(product.take_inventory(1, timezone.now()))
+
+        self.assertEqual(3, Product.objects.get(pk=product.pk).bought)
+
+    def test_reconcile_bought(self):
+        product = Product.objects.create(
+            active=True,
+            price=100,
+            quantity=3,
+            start_date=datetime.date(year=2017, month=1, day=1)
+        )
+        product.sale_set.create(
+            price=100,
+            member=self.jeff
+        )
+        Product.objects.filter(pk=product.pk).update(bought_count=42)
+
+        call_command("reconcile_bought", stdout=StringIO())
+
+        self.assertEqual(1, Product.objects.get(pk=product.pk).bought)
+
+    def test_save_keeps_sales_made_since_fetch(self):
+        product = Product.objects.create(
+            active=True,
+            price=100,
+            quantity=5,
+            start_date=datetime.date(year=2017, month=1, day=1)
+        )
+        stale = Product.objects.get(pk=product.pk)
+        product.take_inventory(2, timezone.now())
+
+        stale.name = "Renamed"
+        stale.save()
+
+        product.refresh_from_db()
+        self.assertEqual("Renamed", product.name)
+        self.assertEqual(2, product.bought_count)
+
+    def test_save_recounts_when_start_date_changes(self):
+        product = Product.objects.create(
+            active=True,
+            price=100,
+            quantity=5,
+            start_date=datetime.date(year=2017, month=1, day=1)
+        )
+        with freeze_time(datetime.date(year=2017, month=1, day=5)):
+            product.sale_set.create(
+                price=100,
+                member=self.jeff
+            )
+        Product.objects.filter(pk=product.pk).update(bought_count=1)
+
+        product.start_date = datetime.date(year=2017, month=1, day=10)
+        product.save()
+
+        self.assertEqual(0, product.bought_count)
+        self.assertEqual(0, Product.objects.get(pk=product.pk).bought_count)
+
 
 class SaleTests(TestCase):
     def setUp(self):
@@ -788,6 +1531,189 @@ class SaleTests(TestCase):
         self.assertIsNone(sale.id)
 
 
+class SaleRollupTests(TestCase):
+    def setUp(self):
+        self.member = Member.objects.create(
+            username="jon",
+            balance=10000
+        )
+        self.product = Product.objects.create(
+            name="beer",
+            price=100,
+            active=True,
+        )
+        self.room = Room.objects.create(name="room", description="room")
+
+    def rollup(self):
+        return list(
+            SaleRollup.objects
+            .values("day", "product", "member", "room")
+            .annotate(count=Sum("count"), price_sum=Sum("price_sum"))
+            .order_by("day", "product", "member", "room"))
+
+    def rolled_up_sales(self):
+        return list(
+            Sale.objects
+            .annotate(day=TruncDay("timestamp"))
+            .values("day", "product", "member", "room")
+            .annotate(count=Count("id"), price_sum=Sum("price"))
+            .order_by("day", "product", "member", "room"))
+
+    def assertRollupMatchesSales(self):
+        expected = [dict(row, day=row["day"].date())
+                    for row in self.rolled_up_sales()]
+        self.assertEqual(expected, self.rollup())
+
+    @freeze_time("2017-03-03 12:00:00")
+    def test_sale_save_adds_to_rollup(self):
+        Sale.objects.create(member=self.member, product=self.product,
+                            room=self.room, price=100)
+        Sale.objects.create(member=self.member, product=self.product,
+                            room=self.room, price=50)
+
+        rollup = SaleRollup.objects.get()
+        self.assertEqual(datetime.date(2017, 3, 3), rollup.day)
+        self.assertEqual(2, rollup.count)
+        self.assertEqual(150, rollup.price_sum)
+
+    def test_order_execute_adds_to_rollup(self):
+        other = Product.objects.create(name="cola", price=75, active=True)
+        order = Order.from_product_counts(
+            self.member, self.room, [(self.product, 3), (other, 2)])
+
+        order.execute()
+
+        self.assertRollupMatchesSales()
+
+    def test_sale_delete_removes_from_rollup(self):
+        sale = Sale.objects.create(member=self.member, product=self.product,
+                                   room=self.room, price=100)
+        Sale.objects.create(member=self.member, product=self.product,
+                            room=self.room, price=100)
+
+        sale.delete()
+
+        self.assertRollupMatchesSales()
+
+    @freeze_time("2017-03-03 12:00:00")
+    def test_sale_adds_to_one_of_doubled_rows(self):
+        Sale.objects.create(member=self.member, product=self.product,
+                            price=100)
+        # Rows without a room aren't held unique by the database
+        SaleRollup.objects.create(day=datetime.date(2017, 3, 3),
+                                  product=self.product, member=self.member)
+
+        Sale.objects.create(member=self.member, product=self.product,
+                            price=100)
+
+        self.assertRollupMatchesSales()
+
+    def test_rollup_split_by_day(self):
+        with freeze_time("2017-03-03 23:59:59"):
+            Sale.objects.create(member=self.member, product=self.product,
+                                price=100)
+        with freeze_time("2017-03-04 00:00:00"):
+            Sale.objects.create(member=self.member, product=self.product,
+                                price=100)
+
+        self.assertEqual(
+            [datetime.date(2017, 3, 3), datetime.date(2017, 3, 4)],
+            list(SaleRollup.objects.order_by("day").values_list("day", flat=True)))
+
+    def test_rebuild_sale_rollup(self):
+        for day in range(1, 5):
+            with freeze_time(datetime.datetime(2017, 3, day, 12)):
+                Sale.objects.create(member=self.member, product=self.product,
+                                    room=self.room, price=100)
+                Sale.objects.create(member=self.member, product=self.product,
+                                    price=100)
+        SaleRollup.objects.filter(day=datetime.date(2017, 3, 2)).update(count=42)
+        SaleRollup.objects.filter(day=datetime.date(2017, 3, 3)).delete()
+        SaleRollup.objects.create(day=datetime.date(2017, 3, 8),
+                                  product=self.product, member=self.member,
+                                  count=1, price_sum=100)
+
+        call_command("rebuild_sale_rollup", chunk_days=2, stdout=StringIO())
+
+        self.assertRollupMatchesSales()
+
+    def test_rebuild_sale_rollup_leaves_today(self):
+        with freeze_time("2017-03-03 12:00:00"):
+            Sale.objects.create(member=self.member, product=self.product,
+                                price=100)
+            SaleRollup.objects.update(count=42)
+
+            call_command("rebuild_sale_rollup", stdout=StringIO())
+
+        self.assertEqual(42, SaleRollup.objects.get().count)
+
+    def test_rebuild_sale_rollup_bad_date(self):
+        with self.assertRaises(CommandError):
+            call_command("rebuild_sale_rollup", from_day="03-03-2017", stdout=StringIO())
+
+
+class SaleEventTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.member = Member.objects.create(
+            username="jon", firstname="Jon", lastname="Snow", balance=10000)
+        self.product = Product.objects.create(name="beer", price=100, active=True)
+
+    def test_sale_events_after(self):
+        publish_sale_event({"n": 1})
+        publish_sale_event({"n": 2})
+        publish_sale_event({"n": 3})
+
+        self.assertEqual((3, [{"n": 2}, {"n": 3}]), sale_events_after(1))
+        self.assertEqual((3, []), sale_events_after(3))
+
+    def test_sale_events_after_too_far_behind(self):
+        for i in range(SALE_EVENTS_KEPT + 2):
+            publish_sale_event({"n": i})
+
+        self.assertEqual((SALE_EVENTS_KEPT + 2, None), sale_events_after(0))
+
+    def test_sale_events_after_missing_event(self):
+        publish_sale_event({"n": 1})
+        publish_sale_event({"n": 2})
+        cache.delete("stregsystem.sale_events.2")
+
+        self.assertEqual((1, [{"n": 1}]), sale_events_after(0))
+
+    def test_sale_events_after_cache_cleared(self):
+        publish_sale_event({"n": 1})
+        cache.clear()
+
+        self.assertEqual((0, None), sale_events_after(1))
+
+    def test_order_publishes_sale(self):
+        order = Order.from_product_counts(self.member, None, [(self.product, 3)])
+
+        with patch('django.db.transaction.on_commit', lambda f: f()):
+            order.execute()
+
+        sequence, events = sale_events_after(0)
+        self.assertEqual(1, sequence)
+        self.assertEqual("jon", events[0]["member"]["username"])
+        self.assertEqual(
+            [{"id": self.product.id, "name": "beer", "count": 3, "price": 300}],
+            events[0]["products"])
+
+    def test_sale_not_published_before_commit(self):
+        Sale.objects.create(member=self.member, product=self.product, price=100)
+
+        # The test case never commits
+        self.assertEqual(0, sale_event_sequence())
+
+    def test_refund_published(self):
+        sale = Sale.objects.create(member=self.member, product=self.product, price=100)
+
+        with patch('django.db.transaction.on_commit', lambda f: f()):
+            sale.delete()
+
+        self.assertEqual([{"type": "refund"}], sale_events_after(0)[1])
+
+
 class MemberTests(TestCase):
     def test_fulfill_pay_transaction(self):
         member = Member(
@@ -856,6 +1782,53 @@ class MemberTests(TestCase):
 
         self.assertEqual(member.balance, 90)
 
+    def test_fulfill_stale_member(self):
+        member = Member.objects.create(username="jon", balance=100)
+        terminal_a = Member.objects.get(pk=member.pk)
+        terminal_b = Member.objects.get(pk=member.pk)
+
+        terminal_a.fulfill(PayTransaction(60))
+        with self.assertRaises(StregForbudError):
+            terminal_b.fulfill(PayTransaction(60))
+
+        self.assertEqual(40, Member.objects.get(pk=member.pk).balance)
+        self.assertEqual(40, terminal_b.balance)
+
+    def test_make_payment_stale_member(self):
+        member = Member.objects.create(username="jon", balance=100)
+        terminal_a = Member.objects.get(pk=member.pk)
+        terminal_b = Member.objects.get(pk=member.pk)
+
+        terminal_a.make_payment(100)
+        terminal_b.make_payment(50)
+
+        self.assertEqual(250, Member.objects.get(pk=member.pk).balance)
+        self.assertEqual(250, terminal_b.balance)
+
+    def test_order_only_writes_balance(self):
+        member = Member.objects.create(username="jon", balance=100)
+        room = Room.objects.create(name="room")
+        product = Product.objects.create(name="øl", price=10, active=True)
+        stale = Member.objects.get(pk=member.pk)
+        Member.objects.filter(pk=member.pk).update(firstname="Jon")
+
+        Order.from_products(stale, room, [product]).execute()
+
+        member = Member.objects.get(pk=member.pk)
+        self.assertEqual(90, member.balance)
+        self.assertEqual("Jon", member.firstname)
+
+    def test_refund_sales(self):
+        member = Member.objects.create(username="jon", balance=100)
+        room = Room.objects.create(name="room")
+        product = Product.objects.create(name="øl", price=10, active=True)
+        Order.from_products(member, room, [product, product]).execute()
+
+        admin.SaleAdmin(Sale, None).refund(None, Sale.objects.filter(member=member))
+
+        self.assertEqual(100, Member.objects.get(pk=member.pk).balance)
+        self.assertFalse(Sale.objects.filter(member=member).exists())
+
     def test_promille_no_drinks(self):
         user = Member.objects.create(username="test", gender='M')
         non_alcoholic = (
@@ -973,6 +1946,65 @@ class MemberTests(TestCase):
                 places=2
             )
 
+    def test_promille_reads_no_sales(self):
+        user = Member.objects.create(username="test", gender='M')
+        alcoholic_drink = (
+            Product.objects.create(
+                name="øl",
+                price=2.0,
+                alcohol_content_ml=15.18,
+                active=True))
+        user.sale_set.create(
+            product=alcoholic_drink,
+            price=alcoholic_drink.price)
+
+        user = Member.objects.get(pk=user.pk)
+        with self.assertNumQueries(0):
+            promille = user.calculate_alcohol_promille()
+
+        self.assertAlmostEqual(0.21, promille, places=2)
+
+    def test_promille_from_order(self):
+        user = Member.objects.create(username="test", gender='F', balance=100)
+        room = Room.objects.create(name="room")
+        alcoholic_drink = (
+            Product.objects.create(
+                name="øl",
+                price=2.0,
+                alcohol_content_ml=15.18,
+                active=True))
+        order = Order.from_products(
+            user, room, [alcoholic_drink, alcoholic_drink])
+
+        order.execute()
+
+        self.assertAlmostEqual(
+            0.50,
+            Member.objects.get(pk=user.pk).calculate_alcohol_promille(),
+            places=2)
+
+    def test_promille_recalculated_on_refund(self):
+        user = Member.objects.create(username="test", gender='M')
+        alcoholic_drink = (
+            Product.objects.create(
+                name="øl",
+                price=2.0,
+                alcohol_content_ml=15.18,
+                active=True))
+        user.sale_set.create(
+            product=alcoholic_drink,
+            price=alcoholic_drink.price)
+        refunded = user.sale_set.create(
+            product=alcoholic_drink,
+            price=alcoholic_drink.price)
+
+        refunded.delete()
+
+        self.assertAlmostEqual(
+            0.21,
+            Member.objects.get(pk=user.pk).calculate_alcohol_promille(),
+            places=2)
+
 
 class BallmerPeakTests(TestCase):
     def test_close_to_maximum(self):
@@ -1010,6 +2042,61 @@ class BallmerPeakTests(TestCase):
         self.assertFalse(is_balmer_peaking)
 
 
+class BatchBacTests(TestCase):
+    def setUp(self):
+        self.now = datetime.datetime(2000, 1, 1, 2, 0)
+        self.genders = [Gender.MALE, Gender.FEMALE, Gender.UNKNOWN, Gender.MALE]
+        rng = random.Random(1337)
+        self.timelines = [[] for gender in self.genders]
+        # The last member doesn't drink anything
+        for member in range(len(self.genders) - 1):
+            for i in range(rng.randint(1, 8)):
+                self.timelines[member].append((
+                    self.now - datetime.timedelta(minutes=rng.randint(0, 300)),
+                    rng.choice([15.18, 20.0, 6.0]),
+                ))
+
+    def test_same_as_single_timelines(self):
+        member_indexes = []
+        timestamps = []
+        alcohol_ml = []
+        # Interleave the members, since the batch shouldn't care about order
+        drinks = [(member, time, ml)
+                  for member, timeline in enumerate(self.timelines)
+                  for time, ml in timeline]
+        random.Random(42).shuffle(drinks)
+        for member, time, ml in drinks:
+            member_indexes.append(member)
+            timestamps.append(time)
+            alcohol_ml.append(ml)
+
+        bacs = alcohol_bac_timelines(self.genders, 80, self.now,
+                                     member_indexes, timestamps, alcohol_ml)
+
+        self.assertEqual(len(self.genders), len(bacs))
+        for gender, timeline, bac in zip(self.genders, self.timelines, bacs):
+            self.assertAlmostEqual(
+                alcohol_bac_timeline(gender, 80, self.now, sorted(timeline)),
+                bac)
+        self.assertEqual(0, bacs[-1])
+
+    def test_no_drinks(self):
+        bacs = alcohol_bac_timelines(self.genders, 80, self.now, [], [], [])
+
+        self.assertEqual([0, 0, 0, 0], bacs)
+
+    def test_ballmer_peaks(self):
+        bacs = [0.0, 1.337 + 0.049, 1.337 + 0.1, 1.337 - 0.049]
+
+        self.assertEqual([ballmer_peak(bac) for bac in bacs],
+                         ballmer_peaks(bacs))
+
+    def test_ballmer_peakers(self):
+        bacs = [0.0, 1.337 - 0.049, 1.337 + 0.1, 1.337 + 0.049]
+
+        self.assertEqual([3, 1], ballmer_peakers(bacs))
+
+
 class ProductActivatedListFilterTests(TestCase):
     def setUp(self):
         jeff = Member.objects.create(
@@ -1237,6 +2324,120 @@ class ProductActivatedListFilterTests(TestCase):
         self.assertIn(Product.objects.get(name="active_some_left"), qy)
         self.assertNotIn(Product.objects.get(name="active_some_left"), qn)
 
+
+def legacy_make_active_productlist_query(queryset):
+    # The implementation from before the bought counter, kept around to check
+    # that the current one selects the same products.
+    now = datetime.datetime.now()
+    active_candidates = (
+        queryset
+        .filter(
+            Q(active=True)
+            & (Q(deactivate_date=None) | Q(deactivate_date__gte=now)))
+    )
+    candidates_out_of_stock = (
+        active_candidates
+        .filter(sale__timestamp__gt=F("start_date"))
+        .annotate(c=Count("sale__id"))
+        .filter(c__gte=F("quantity"))
+        .values("id")
+    )
+    return (
+        active_candidates
+        .exclude(
+            Q(start_date__isnull=False)
+            & Q(id__in=candidates_out_of_stock)))
+
+
+def legacy_make_inactive_productlist_query(queryset):
+    now = datetime.datetime.now()
+    inactive_candidates = (
+        queryset
+        .exclude(
+            Q(active=True)
+            & (Q(deactivate_date=None) | Q(deactivate_date__gte=now)))
+        .values("id")
+    )
+    inactive_out_of_stock = (
+        queryset
+        .filter(sale__timestamp__gt=F("start_date"))
+        .annotate(c=Count("sale__id"))
+        .filter(c__gte=F("quantity"))
+        .values("id")
+    )
+    return (
+        queryset
+        .filter(
+            Q(id__in=inactive_candidates)
+            | Q(id__in=inactive_out_of_stock))
+    )
+
+
+class ProductListQueryPropertyTests(TestCase):
+    seeds = range(10)
+    products_per_seed = 30
+
+    def setUp(self):
+        self.member = Member.objects.create(username="jeff")
+
+    def random_datetime(self, rng):
+        return timezone.make_aware(
+            datetime.datetime(2016, 12, 1)
+            + datetime.timedelta(days=rng.randint(0, 60),
+                                 seconds=rng.randint(1, 86399)))
+
+    def generate_products(self, rng):
+        now = timezone.now()
+        for i in range(self.products_per_seed):
+            deactivate_date = rng.choice([
+                None,
+                now - datetime.timedelta(hours=rng.randint(1, 100)),
+                now + datetime.timedelta(hours=rng.randint(1, 100)),
+            ])
+            start_date = rng.choice([
+                None,
+                datetime.date(2017, 1, 1)
+                + datetime.timedelta(days=rng.randint(-20, 20)),
+            ])
+            product = Product.objects.create(
+                name="product {}".format(i),
+                price=100,
+                active=rng.random() < 0.8,
+                deactivate_date=deactivate_date,
+                start_date=start_date,
+                quantity=rng.randint(0, 4),
+            )
+            for j in range(rng.randint(0, 5)):
+                # freeze_time is too slow to do this many times
+                with patch('django.utils.timezone.now',
+                           return_value=self.random_datetime(rng)):
+                    product.sale_set.create(member=self.member, price=100)
+            if rng.random() < 0.2:
+                # Move the start date after the sales happened
+                product.start_date = datetime.date(2017, 1, rng.randint(1, 31))
+                product.save()
+            if rng.random() < 0.2 and product.sale_set.exists():
+                product.sale_set.order_by("?").first().delete()
+
+    def assertSameProducts(self, expected, actual):
+        self.assertEqual(
+            sorted(expected.values_list("id", flat=True)),
+            sorted(actual.values_list("id", flat=True)))
+
+    def test_same_products_as_legacy_implementation(self):
+        for seed in self.seeds:
+            rng = random.Random(seed)
+            Product.objects.all().delete()
+            self.generate_products(rng)
+
+            self.assertSameProducts(
+                legacy_make_active_productlist_query(Product.objects.all()),
+                make_active_productlist_query(Product.objects.all()))
+            self.assertSameProducts(
+                legacy_make_inactive_productlist_query(Product.objects.all()),
+                make_inactive_productlist_query(Product.objects.all()))
+
+
 class ProductRoomFilterTests(TestCase):
     fixtures = ["test_room_products"]
 
@@ -1258,6 +2459,76 @@ class ProductRoomFilterTests(TestCase):
         self.assertEqual(len(products), len(Product.objects.all()))
 
 
+class ProductListCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.room = Room.objects.create(name="room", description="room")
+        self.other_room = Room.objects.create(name="other", description="other")
+        self.member = Member.objects.create(username="jokke", balance=1000)
+        self.coke = Product.objects.create(
+            name="coke",
+            price=100,
+            active=True
+        )
+
+    def get_product_list(self, room):
+        response = self.client.get(reverse('menu_index', args=(room.id, )))
+        return response.context['product_list']
+
+    def test_product_list_is_cached(self):
+        self.get_product_list(self.room)
+
+        with self.assertNumQueries(0):
+            product_list = cached_product_list(self.room.id, Product.objects.none)
+
+        self.assertEqual([self.coke], product_list)
+
+    def test_product_save_invalidates(self):
+        self.get_product_list(self.room)
+
+        self.coke.active = False
+        self.coke.save()
+
+        self.assertNotIn(self.coke, self.get_product_list(self.room))
+
+    def test_product_rooms_change_invalidates(self):
+        self.get_product_list(self.room)
+
+        self.coke.rooms.add(self.other_room)
+
+        self.assertNotIn(self.coke, self.get_product_list(self.room))
+        self.assertIn(self.coke, self.get_product_list(self.other_room))
+
+    def test_sold_out_invalidates(self):
+        flan = Product.objects.create(
+            name="flan",
+            price=100,
+            active=True,
+            quantity=1,
+            start_date=datetime.date(year=2017, month=1, day=1)
+        )
+        self.assertIn(flan, self.get_product_list(self.room))
+
+        Order.from_products(self.member, self.room, [flan]).execute()
+
+        self.assertNotIn(flan, self.get_product_list(self.room))
+
+    def test_expires_at_deactivate_date(self):
+        with freeze_time(datetime.datetime(2017, 1, 1, 12, 0)):
+            Product.objects.create(
+                name="julebryg",
+                price=100,
+                active=True,
+                deactivate_date=timezone.make_aware(
+                    datetime.datetime(2017, 1, 1, 12, 2))
+            )
+            with patch('stregsystem.utils.cache.set') as cache_set:
+                self.get_product_list(self.room)
+
+        _, _, timeout = cache_set.call_args[0]
+        self.assertEqual(2 * 60 + 1, timeout)
+
+
 class CategoryAdminTests(TestCase):
     fixtures = ["test_category"]
 
@@ -1352,6 +2623,41 @@ class QuickbuyParserTests(TestCase):
         with self.assertRaises(parser.QuickBuyError):
             parser.parse(buy_string)
 
+    def test_counts_aggregated(self):
+        buy_string = self.test_username + " 42:2 1337 42 7:0"
+
+        username, products = parser.parse_counts(buy_string)
+
+        self.assertEqual(username, self.test_username)
+        self.assertEqual([(42, 3), (1337, 1)], products)
+
+    def test_counts_username_only(self):
+        username, products = parser.parse_counts(self.test_username)
+
+        self.assertEqual(username, self.test_username)
+        self.assertEqual([], products)
+
+    def test_counts_max_count(self):
+        buy_string = self.test_username + " 42:100"
+
+        username, products = parser.parse_counts(buy_string, max_count=100)
+
+        self.assertEqual([(42, 100)], products)
+
+    def test_counts_above_max_count(self):
+        buy_string = self.test_username + " 42:2 1337:101"
+
+        with self.assertRaises(parser.QuickBuyError) as c:
+            parser.parse_counts(buy_string, max_count=100)
+
+        self.assertEqual(c.exception.failed_part, "1337:101")
+
+    def test_counts_no_max_count(self):
+        buy_string = self.test_username + " 42:99999999"
+
+        username, products = parser.parse_counts(buy_string, max_count=None)
+
+        self.assertEqual([(42, 99999999)], products)
 
 
 class RazziaTests(TestCase):
@@ -1400,3 +2706,97 @@ class RazziaTests(TestCase):
 
         self.assertEqual(0, res[self.flan.name])
         self.assertEqual(0, res[self.flanmad.name])
+
+
+class BenchmarkCommandTests(TestCase):
+    def generate(self, **options):
+        with override_settings(DEBUG=True):
+            call_command(
+                "generate_benchmark_data",
+                members=20,
+                products=15,
+                rooms=2,
+                categories=3,
+                sales=300,
+                payments=30,
+                years=1,
+                batch_size=100,
+                stdout=StringIO(),
+                **options
+            )
+
+    def test_refuses_without_debug(self):
+        with self.assertRaises(CommandError):
+            call_command("generate_benchmark_data", sales=10, stdout=StringIO())
+
+        self.assertFalse(Sale.objects.exists())
+
+    def test_generates_history(self):
+        self.generate()
+
+        self.assertEqual(20, Member.objects.filter(username__startswith="bench").count())
+        self.assertEqual(300, Sale.objects.count())
+        self.assertEqual(30, Payment.objects.count())
+        timestamps = list(Sale.objects.order_by("id").values_list("timestamp", flat=True))
+        self.assertEqual(sorted(timestamps), timestamps)
+        self.assertLess(timestamps[-1], timezone.now())
+        self.assertGreater(timestamps[0], timezone.now() - datetime.timedelta(days=366))
+
+    def test_generates_consistent_counters(self):
+        self.generate()
+
+        for product in Product.objects.all():
+            self.assertEqual(product.count_bought(), product.bought)
+
+    def test_same_seed_same_history(self):
+        self.generate(seed=7)
+        first = list(Sale.objects.order_by("id").values_list(
+            "member__username", "product__name", "price"))
+        Sale.objects.all().delete()
+        Member.objects.all().delete()
+        Product.objects.all().delete()
+
+        self.generate(seed=7)
+        second = list(Sale.objects.order_by("id").values_list(
+            "member__username", "product__name", "price"))
+
+        self.assertEqual(first, second)
+
+    def test_benchmark_reports_every_entry_point(self):
+        self.generate()
+        out = StringIO()
+
+        call_command("benchmark", runs=1, members=5, stdout=out)
+
+        for name in ["product_list", "ranks_for_year", "daily", "sales_api",
+                     "user_purchases_in_categories",
+                     "calculate_alcohol_promille", "member_history"]:
+            self.assertIn(name, out.getvalue())
+
+    def test_benchmark_explain_uses_indexes(self):
+        self.generate()
+        out = StringIO()
+
+        call_command("benchmark", runs=1, only=["product_list"], explain=True, stdout=out)
+
+        plans = dict(block.split("\n", 1) for block in out.getvalue().strip().split("\n\n")[1:])
+        self.assertEqual(
+            ["member_last_payment", "member_recent_sales", "member_sales_since",
+             "product_last_price", "room_sales_since", "sales_since"],
+            sorted(plans))
+        if connection.vendor == "sqlite":
+            for name, plan in plans.items():
+                self.assertIn("USING INDEX", plan, name)
+                self.assertNotIn("TEMP B-TREE", plan, name)
+
+    def test_benchmark_only(self):
+        out = StringIO()
+
+        call_command("benchmark", runs=1, only=["sales_api"], stdout=out)
+
+        self.assertIn("sales_api", out.getvalue())
+        self.assertNotIn("daily", out.getvalue())
+
+    def test_benchmark_unknown(self):
+        with self.assertRaises(CommandError):
+            call_command("benchmark", only=["nope"], stdout=StringIO())
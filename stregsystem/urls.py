@@ -21,6 +21,7 @@ urlpatterns = [
     url(r'^$', views.roomindex, name="index"),
     url(r'^(?P<room_id>\d+)/$', views.index, name="menu_index"),
     url(r'^(?P<room_id>\d+)/sale/$', views.sale, name="quickbuy"),
+    url(r'^(?P<room_id>\d+)/api/sale/$', views.api_sale, name="api_sale"),
     url(r'^(?P<room_id>\d+)/sale/(?P<member_id>\d+)/$', views.menu_sale, name="menu"),
     url(r'^(?P<room_id>\d+)/sale/(?P<member_id>\d+)/(?P<product_id>\d+)/$', views.menu_sale, name="menu_sale"),
     url(r'^(?P<room_id>\d+)/user/(?P<member_id>\d+)/$', views.menu_userinfo, name="userinfo"),
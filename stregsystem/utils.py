@@ -1,62 +1,204 @@
 import datetime
+import threading
+from collections import OrderedDict
 
-from django.db.models import Count, F, Q
+from django.core.cache import cache
+from django.db.models import F, Q
+from django.utils import timezone
 
+# How long a cached product list may live, at most. Invalidation is done with
+# signals, which only reach the cache of other processes if the cache backend
+# is shared, so don't let a stale list live forever.
+PRODUCT_LIST_CACHE_TIMEOUT = 5 * 60
+_PRODUCT_LIST_GENERATION_KEY = "stregsystem.product_list.generation"
 
-def make_active_productlist_query(queryset):
+# The sales of a day that is over only change when sales are refunded, and
+# the cache keys of the sales series change with them. The timeout only keeps
+# the keys of old changes from piling up.
+SALES_SERIES_CACHE_TIMEOUT = 60 * 60
+
+# The sale events for the live dashboards. Only the newest ones are kept, a
+# dashboard that falls further behind has to reload.
+SALE_EVENTS_KEPT = 100
+SALE_EVENT_TIMEOUT = 10 * 60
+_SALE_EVENT_SEQUENCE_KEY = "stregsystem.sale_events.sequence"
+
+# The ids of the members that bought something lately, by username, least
+# recently used first. It's kept in each process, and only has the ids, so
+# the members and their balances are still read from the database.
+MEMBER_IDS_KEPT = 2000
+_member_ids = OrderedDict()
+_member_ids_lock = threading.Lock()
+
+
+def _active_candidates_query():
     now = datetime.datetime.now()
-    # Create a query for the set of products that MIGHT be active. Might
-    # because they can be out of stock. Which we compute later
-    active_candidates = (
-        queryset
-        .filter(
-            Q(active=True)
-            & (Q(deactivate_date=None) | Q(deactivate_date__gte=now)))
-    )
-    # This query selects all the candidates that are out of stock.
-    candidates_out_of_stock = (
-        active_candidates
-        .filter(sale__timestamp__gt=F("start_date"))
-        .annotate(c=Count("sale__id"))
-        .filter(c__gte=F("quantity"))
-        .values("id")
-    )
-    # We can now create a query that selects all the candidates which are not
-    # out of stock.
+    # The products that MIGHT be active. Might because they can be out of
+    # stock.
     return (
-        active_candidates
-        .exclude(
-            Q(start_date__isnull=False)
-            & Q(id__in=candidates_out_of_stock)))
+        Q(active=True)
+        & (Q(deactivate_date=None) | Q(deactivate_date__gte=now)))
 
 
-def make_inactive_productlist_query(queryset):
-    now = datetime.datetime.now()
-    # Create a query of things are definitively inactive. Some of the ones
-    # filtered here might be out of stock, but we include that later.
-    inactive_candidates = (
-        queryset
-        .exclude(
-            Q(active=True)
-            & (Q(deactivate_date=None) | Q(deactivate_date__gte=now)))
-        .values("id")
-    )
-    inactive_out_of_stock = (
+def _out_of_stock_query():
+    # Only limited products (the ones with a start date) can run out of
+    # stock, and their bought counter is kept by the sale write path, so we
+    # don't need to look at the sales. A limited product that has never been
+    # bought is not considered out of stock, even with a quantity of 0.
+    return (
+        Q(start_date__isnull=False)
+        & Q(bought_count__gt=0)
+        & Q(bought_count__gte=F("quantity")))
+
+
+def make_active_productlist_query(queryset):
+    return (
         queryset
-        .filter(sale__timestamp__gt=F("start_date"))
-        .annotate(c=Count("sale__id"))
-        .filter(c__gte=F("quantity"))
-        .values("id")
-    )
+        .filter(_active_candidates_query())
+        .exclude(_out_of_stock_query()))
+
+
+def make_inactive_productlist_query(queryset):
     return (
         queryset
-        .filter(
-            Q(id__in=inactive_candidates)
-            | Q(id__in=inactive_out_of_stock))
-    )
+        .filter(~_active_candidates_query() | _out_of_stock_query()))
 
 
 def make_room_specific_query(room):
     return (
         Q(rooms__id=room) | Q(rooms=None)
     )
+
+
+def _product_list_cache_key(room_id):
+    generation = cache.get(_PRODUCT_LIST_GENERATION_KEY, 0)
+    return "stregsystem.product_list.{}.{}".format(generation, room_id)
+
+
+def cached_product_list(room_id, make_product_list):
+    """
+    Get the active product list for a room from the cache, or build it with
+    make_product_list and cache it.
+
+    The list is cached until the first product in it passes its deactivate
+    date, or until invalidate_product_lists is called.
+    """
+    key = _product_list_cache_key(room_id)
+    product_list = cache.get(key)
+    if product_list is not None:
+        return product_list
+
+    product_list = list(make_product_list())
+
+    now = timezone.now()
+    timeout = PRODUCT_LIST_CACHE_TIMEOUT
+    for product in product_list:
+        if (product.deactivate_date is not None
+                and product.deactivate_date > now):
+            seconds_left = (product.deactivate_date - now).total_seconds()
+            timeout = min(timeout, int(seconds_left) + 1)
+    cache.set(key, product_list, timeout)
+    return product_list
+
+
+def invalidate_product_lists():
+    """
+    Throw away the cached product lists of every room
+    """
+    # Rather than finding every room key, we move every room to a new
+    # generation of keys. The old ones will expire by themselves.
+    try:
+        cache.incr(_PRODUCT_LIST_GENERATION_KEY)
+    except ValueError:
+        cache.set(_PRODUCT_LIST_GENERATION_KEY, 1, None)
+
+
+def sales_series_cache_key(name, day, changed):
+    """
+    The cache key of the named series for the given day, given when the sales
+    last changed (see SalesSeriesChange)
+    """
+    generation = changed.isoformat() if changed is not None else "0"
+    return "stregsystem.sales_series.{}.{}.{}".format(
+        name, generation, day.isoformat())
+
+
+def _sale_event_key(sequence):
+    return "stregsystem.sale_events.{}".format(sequence)
+
+
+def publish_sale_event(event):
+    """
+    Tell the live dashboards about event, which must be picklable
+    """
+    try:
+        sequence = cache.incr(_SALE_EVENT_SEQUENCE_KEY)
+    except ValueError:
+        cache.add(_SALE_EVENT_SEQUENCE_KEY, 0, None)
+        sequence = cache.incr(_SALE_EVENT_SEQUENCE_KEY)
+    cache.set(_sale_event_key(sequence), event, SALE_EVENT_TIMEOUT)
+
+
+def sale_event_sequence():
+    """
+    The sequence number of the newest sale event
+    """
+    return cache.get(_SALE_EVENT_SEQUENCE_KEY, 0)
+
+
+def sale_events_after(sequence):
+    """
+    The sale events published after the one with the given sequence number.
+
+    Returns the sequence number of the last event returned, and the events.
+    The events are None if some of them are lost, then the caller has to
+    start over from sale_event_sequence().
+    """
+    latest = sale_event_sequence()
+    if latest < sequence or latest - sequence > SALE_EVENTS_KEPT:
+        return latest, None
+
+    keys = [_sale_event_key(i) for i in range(sequence + 1, latest + 1)]
+    found = cache.get_many(keys)
+    events = []
+    for key in keys:
+        if key not in found:
+            # Either it's being written right now, or it's gone. The caller
+            # can't tell yet, so give it what we have.
+            break
+        events.append(found[key])
+    return sequence + len(events), events
+
+
+def cached_member_id(username):
+    """
+    The member id last remembered for username, or None. The member may have
+    been changed since by another process, so check that it still has the
+    username.
+    """
+    with _member_ids_lock:
+        member_id = _member_ids.pop(username, None)
+        if member_id is not None:
+            _member_ids[username] = member_id
+    return member_id
+
+
+def remember_member_id(username, member_id):
+    with _member_ids_lock:
+        _member_ids.pop(username, None)
+        _member_ids[username] = member_id
+        while len(_member_ids) > MEMBER_IDS_KEPT:
+            _member_ids.popitem(last=False)
+
+
+def forget_member_id(member_id=None):
+    """
+    Forget the usernames of member_id, or every username if it's None
+    """
+    with _member_ids_lock:
+        if member_id is None:
+            _member_ids.clear()
+            return
+        for username in [username for username, cached_id
+                         in _member_ids.items() if cached_id == member_id]:
+            del _member_ids[username]
@@ -1,10 +1,16 @@
 import datetime
+import json
+import re
+from collections import OrderedDict
 from functools import reduce
 
+from django.conf import settings
+from django.db import DatabaseError
 from django.db.models import Q
-from django.http import HttpResponsePermanentRedirect
+from django.http import HttpResponsePermanentRedirect, JsonResponse
 from django.shortcuts import get_object_or_404, render
-from django.utils import timezone
+from django.utils import six, timezone
+from django.views.decorators.http import require_POST
 
 import stregsystem.parser as parser
 
@@ -17,11 +23,19 @@ from stregsystem.models import (
     StregForbudError,
     NoMoreInventoryError,
     Order,
-    Sale,
+)
+from stregsystem.offline import (
+    OfflineJournal,
+    UnknownMemberError,
+    UnknownProductsError
 )
 from stregsystem.utils import (
+    cached_member_id,
+    cached_product_list,
+    forget_member_id,
     make_active_productlist_query,
-    make_room_specific_query
+    make_room_specific_query,
+    remember_member_id
 )
 
 from .booze import ballmer_peak
@@ -35,11 +49,12 @@ def __get_news():
 
 
 def __get_productlist(room_id):
-    l = (
-        make_active_productlist_query(Product.objects)
-                       .filter(make_room_specific_query(room_id))
-    )
-    return l
+    def make_productlist():
+        return (
+            make_active_productlist_query(Product.objects)
+            .filter(make_room_specific_query(room_id))
+        )
+    return cached_product_list(room_id, make_productlist)
 
 def roomindex(request):
     return HttpResponsePermanentRedirect('/1/')
@@ -55,17 +70,23 @@ def index(request, room_id):
     return render(request, 'stregsystem/index.html', locals())
 
 def sale(request, room_id):
-    room = get_object_or_404(Room, pk=room_id)
-    news = __get_news()
-    product_list = __get_productlist(room_id)
-
     buy_string = request.POST['quickbuy'].strip()
+    try:
+        room = get_object_or_404(Room, pk=room_id)
+        news = __get_news()
+        product_list = __get_productlist(room_id)
+    except DatabaseError:
+        if not settings.OFFLINE_JOURNAL:
+            raise
+        return offline_sale(request, room_id, buy_string)
+
     # Handle empty line
     if buy_string == "":
         return render(request, 'stregsystem/index.html', locals())
     # Extract username and product ids
     try:
-        username, bought_ids = parser.parse(buy_string)
+        username, bought_counts = parser.parse_counts(
+            buy_string, settings.QUICKBUY_MAX_COUNT)
     except parser.QuickBuyError as err:
         values = {
             'correct': err.parsed_part,
@@ -76,54 +97,163 @@ def sale(request, room_id):
         return render(request, 'stregsystem/error_invalidquickbuy.html', values)
     # Fetch member from DB
     try:
-        member = Member.objects.get(username=username, active=True)
+        member = _active_member(username)
     except Member.DoesNotExist:
         return render(request, 'stregsystem/error_usernotfound.html', locals())
-
-    if len(bought_ids):
-        return quicksale(request, room, member, bought_ids)
+    except DatabaseError:
+        if not settings.OFFLINE_JOURNAL:
+            raise
+        return offline_sale(request, room_id, buy_string)
+
+    if len(bought_counts):
+        try:
+            return quicksale(request, room, member, bought_counts,
+                             _purchase_token(request.POST))
+        except OfflineFallback:
+            return offline_sale(request, room_id, buy_string)
     else:
         return usermenu(request, room, member, None)
 
 
-def _multibuy_hint(now, member):
-    # Get a timestamp to fetch sales for the member since.
-    earliest_recent_purchase = now - datetime.timedelta(seconds=60)
-    # Count the sales since
-    number_of_recent_distinct_purchases = (
-        Sale.objects
-            .filter(member=member, timestamp__gt=earliest_recent_purchase)
-            .values("timestamp")
-            .distinct()
-            .count()
-    )
-    # Only give hint if the user did not just do a multibuy
-    return number_of_recent_distinct_purchases > 1
+def _active_member(username):
+    """
+    The active member with username. The id of the member is looked up in
+    the members remembered by this process first, but the member, and its
+    balance, is always read from the database.
+    """
+    member_id = cached_member_id(username)
+    if member_id is not None:
+        member = Member.objects.filter(
+            pk=member_id, username=username, active=True).first()
+        if member is not None:
+            return member
+        # Changed by another process
+        forget_member_id(member_id)
+
+    member = Member.objects.get(username=username, active=True)
+    remember_member_id(username, member.id)
+    return member
+
+
+_token_matcher = re.compile(r'^[0-9A-Za-z_-]{1,64}$')
+
+
+def _purchase_token(data):
+    """
+    The PurchaseToken sent with a purchase, or None if there is none
+    """
+    token = data.get("token")
+    if isinstance(token, six.string_types) and _token_matcher.match(token):
+        return token
+    return None
+
+
+class OfflineFallback(Exception):
+    """
+    The database failed before anything was bought, so the sale can be
+    journaled instead
+    """
+
+
+def offline_sale(request, room_id, buy_string):
+    """
+    The sale view when the database can't be reached. The quickbuy is checked
+    against the snapshot of the offline journal and written to it, to be
+    replayed by replay_offline_journal.
+    """
+    journal = OfflineJournal(settings.OFFLINE_JOURNAL)
+    values = {
+        'room': {"id": int(room_id)},
+        'product_list': journal.product_list(room_id),
+    }
 
+    if buy_string == "":
+        return render(request, 'stregsystem/offline_sale.html', values)
+    try:
+        username, bought_counts = parser.parse_counts(
+            buy_string, settings.QUICKBUY_MAX_COUNT)
+    except parser.QuickBuyError as err:
+        values.update(error="invalid_quickbuy", err=err)
+        return render(request, 'stregsystem/offline_sale.html', values)
+    values['username'] = username
+    if not bought_counts:
+        # The menu needs the database
+        values['error'] = "no_products"
+        return render(request, 'stregsystem/offline_sale.html', values)
 
-def quicksale(request, room, member, bought_ids):
+    try:
+        entry, bought_products = journal.record(room_id, username,
+                                                bought_counts)
+    except UnknownMemberError:
+        values['error'] = "member_not_found"
+    except UnknownProductsError as err:
+        values.update(error="invalid_products",
+                      invalid_product_ids=err.product_ids)
+    except StregForbudError:
+        values['error'] = "stregforbud"
+    else:
+        values.update(entry=entry, bought_products=bought_products,
+                      cost=entry.cost)
+    return render(request, 'stregsystem/offline_sale.html', values)
+
+
+def _multibuy_hint(now, previous_purchase_on):
+    """
+    Whether the member bought something else less than a minute before now,
+    in which case they might as well have used multibuy
+    """
+    return (previous_purchase_on is not None
+            and previous_purchase_on > now - datetime.timedelta(seconds=60))
+
+
+def _find_products(room, product_ids, now):
+    """
+    The products of product_ids that can be bought in room now, by id
+    """
+    return {
+        product.id: product
+        for product in Product.objects.filter(
+            Q(pk__in=list(product_ids)), Q(active=True), Q(deactivate_date__gte=now) | Q(
+                deactivate_date__isnull=True), Q(rooms__id=room.id) | Q(rooms=None))
+    }
+
+
+def quicksale(request, room, member, bought_counts, token=None):
     news = __get_news()
     product_list = __get_productlist(room.id)
     now = timezone.now()
 
-    # Retrieve products and construct transaction
-    products = []
+    # Retrieve all the products at once and construct transaction
+    product_counts = OrderedDict(bought_counts)
     try:
-        for i in bought_ids:
-            product = Product.objects.get(Q(pk=i), Q(active=True), Q(deactivate_date__gte=now) | Q(
-                deactivate_date__isnull=True), Q(rooms__id=room.id) | Q(rooms=None))
-            products.append(product)
-    except Product.DoesNotExist:
-        return usermenu(request, room, member, None)
-
-    order = Order.from_products(
+        found_products = _find_products(room, product_counts, now)
+    except DatabaseError:
+        if not settings.OFFLINE_JOURNAL:
+            raise
+        raise OfflineFallback()
+    invalid_product_ids = sorted(set(product_counts) - set(found_products))
+    if invalid_product_ids:
+        return usermenu(request, room, member, None,
+                        invalid_product_ids=invalid_product_ids)
+
+    bought_products = [(found_products[i], count)
+                       for i, count in product_counts.items()]
+    products = [product for product, count in bought_products]
+    order = Order.from_product_counts(
         member=member,
-        products=products,
-        room=room
+        product_counts=bought_products,
+        room=room,
+        token=token
     )
 
     try:
         order.execute()
+    except DatabaseError:
+        # Nothing was bought, the transaction is rolled back. Anything
+        # failing after this is not journaled, it would be bought twice.
+        if not settings.OFFLINE_JOURNAL:
+            raise
+        raise OfflineFallback()
     except StregForbudError:
         return render(request, 'stregsystem/error_stregforbud.html', locals())
     except NoMoreInventoryError:
@@ -135,19 +265,21 @@ def quicksale(request, room, member, bought_ids):
 
     cost = order.total
 
-    give_multibuy_hint = _multibuy_hint(now, member) and len(bought_ids) == 1
+    give_multibuy_hint = (_multibuy_hint(now, order.previous_purchase_on)
+                          and sum(product_counts.values()) == 1)
 
     return render(request, 'stregsystem/index_sale.html', locals())
 
 
-def usermenu(request, room, member, bought, from_sale=False):
+def usermenu(request, room, member, bought, from_sale=False,
+             invalid_product_ids=None, previous_purchase_on=None):
     negative_balance = member.balance < 0
     product_list = __get_productlist(room.id)
     news = __get_news()
     promille = member.calculate_alcohol_promille()
     is_ballmer_peaking, bp_minutes, bp_seconds, = ballmer_peak(promille)
 
-    give_multibuy_hint = _multibuy_hint(timezone.now(), member) and from_sale
+    give_multibuy_hint = from_sale and _multibuy_hint(timezone.now(), previous_purchase_on)
 
     if member.has_stregforbud():
         return render(request, 'stregsystem/error_stregforbud.html', locals())
@@ -177,6 +309,7 @@ def menu_sale(request, room_id, member_id, product_id=None):
     news = __get_news()
     member = Member.objects.get(pk=member_id, active=True)
     product = None
+    previous_purchase_on = None
     try:
         product = Product.objects.get(Q(pk=product_id), Q(active=True), Q(rooms__id=room_id) | Q(rooms=None),
                                       Q(deactivate_date__gte=datetime.datetime.now()) | Q(deactivate_date__isnull=True))
@@ -184,10 +317,12 @@ def menu_sale(request, room_id, member_id, product_id=None):
         order = Order.from_products(
             member=member,
             room=room,
-            products=(product, )
+            products=(product, ),
+            token=_purchase_token(request.GET)
         )
 
         order.execute()
+        previous_purchase_on = order.previous_purchase_on
 
     except Product.DoesNotExist:
         pass
@@ -198,4 +333,147 @@ def menu_sale(request, room_id, member_id, product_id=None):
         return render(request, 'stregsystem/error_stregforbud.html', locals())
     # Refresh member, to get new amount
     member = Member.objects.get(pk=member_id, active=True)
-    return usermenu(request, room, member, product, from_sale=True)
+    return usermenu(request, room, member, product, from_sale=True,
+                    previous_purchase_on=previous_purchase_on)
+
+
+def _api_error(status, error, **details):
+    details["status"] = "error"
+    details["error"] = error
+    return JsonResponse(details, status=status)
+
+
+def _api_order(request):
+    """
+    The username, (product id, count) pairs and purchase token of an api
+    sale. Either a quickbuy string, as a form field or in a JSON body, or a
+    JSON body like {"member": "jokke", "products": [{"id": 1, "count": 2}]}.
+    The token is sent as the token field or key.
+
+    Raises parser.QuickBuyError for bad quickbuy strings, and ValueError for
+    anything else that isn't an order.
+    """
+    if request.content_type != "application/json":
+        username, counts = parser.parse_counts(
+            request.POST.get("quickbuy", "").strip(),
+            settings.QUICKBUY_MAX_COUNT)
+        return username, counts, _purchase_token(request.POST)
+
+    try:
+        data = json.loads(request.body.decode("utf-8"))
+    except (UnicodeDecodeError, ValueError):
+        raise ValueError("The body is not valid JSON")
+    if not isinstance(data, dict):
+        raise ValueError("The body must be a JSON object")
+    if "quickbuy" in data:
+        username, counts = parser.parse_counts(
+            six.text_type(data["quickbuy"]).strip(),
+            settings.QUICKBUY_MAX_COUNT)
+        return username, counts, _purchase_token(data)
+
+    username = data.get("member")
+    if not username or not isinstance(username, six.string_types):
+        raise ValueError("member must be a username")
+    products = data.get("products", [])
+    if (not isinstance(products, list)
+            or not all(isinstance(line, dict) for line in products)):
+        raise ValueError("products must be a list of {\"id\": .., \"count\": ..}")
+    counts = OrderedDict()
+    for line in products:
+        try:
+            product_id = int(line["id"])
+            count = int(line.get("count", 1))
+        except (KeyError, TypeError, ValueError):
+            raise ValueError("products must be a list of {\"id\": .., \"count\": ..}")
+        if count < 0 or count > settings.QUICKBUY_MAX_COUNT:
+            raise ValueError("count must be between 0 and {}".format(
+                settings.QUICKBUY_MAX_COUNT))
+        if count > 0:
+            counts[product_id] = counts.get(product_id, 0) + count
+    return username, list(counts.items()), _purchase_token(data)
+
+
+def _api_member(member):
+    promille = member.calculate_alcohol_promille()
+    is_ballmer_peaking, bp_minutes, bp_seconds = ballmer_peak(promille)
+    return {
+        "id": member.id,
+        "username": member.username,
+        "balance": member.balance,
+        "promille": promille,
+        "ballmer_peak": {
+            "peaking": is_ballmer_peaking,
+            "minutes": bp_minutes,
+            "seconds": bp_seconds,
+        },
+    }
+
+
+@require_POST
+def api_sale(request, room_id):
+    """
+    The quickbuy of the sale view, answered with JSON instead of a page, so
+    terminals can show the result without fetching the product list again.
+
+    Amounts are in oere. With no products the member is looked up without
+    buying anything. Send a token to retry safely, a sale with a token that
+    has been bought already is answered as before, with replayed set, and
+    isn't bought again.
+    """
+    room = get_object_or_404(Room, pk=room_id)
+
+    try:
+        username, bought_counts, token = _api_order(request)
+    except parser.QuickBuyError as err:
+        return _api_error(400, "invalid_quickbuy",
+                          parsed_part=err.parsed_part,
+                          failed_part=err.failed_part)
+    except ValueError as err:
+        return _api_error(400, "invalid_order", message=str(err))
+
+    try:
+        member = _active_member(username)
+    except Member.DoesNotExist:
+        return _api_error(404, "member_not_found", username=username)
+
+    now = timezone.now()
+    product_counts = OrderedDict(bought_counts)
+    found_products = _find_products(room, product_counts, now)
+    invalid_product_ids = sorted(set(product_counts) - set(found_products))
+    if invalid_product_ids:
+        return _api_error(400, "invalid_products",
+                          product_ids=invalid_product_ids)
+
+    order = Order.from_product_counts(
+        member=member,
+        product_counts=[(found_products[i], count)
+                        for i, count in product_counts.items()],
+        room=room,
+        token=token
+    )
+    if order.items:
+        try:
+            order.execute()
+        except StregForbudError:
+            return _api_error(402, "stregforbud", balance=member.balance,
+                              cost=order.total())
+        except NoMoreInventoryError:
+            return _api_error(409, "out_of_stock")
+
+    return JsonResponse({
+        "status": "ok",
+        "replayed": order.replayed,
+        "member": _api_member(member),
+        "cost": order.total(),
+        "products": [
+            {
+                "id": found_products[i].id,
+                "name": found_products[i].name,
+                "count": count,
+                "price": found_products[i].price * count,
+            }
+            for i, count in product_counts.items()
+        ],
+        "multibuy_hint": (_multibuy_hint(now, order.previous_purchase_on)
+                          and sum(product_counts.values()) == 1),
+    })
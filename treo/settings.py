@@ -51,6 +51,26 @@ PASSWORD =
 [hostnames]
 2=127.0.0.1
 3=localhost
+
+[offline]
+# A local SQLite file to journal quickbuys to when the database can't be
+# reached. Leave empty to fail instead
+JOURNAL =
+
+[quickbuy]
+# The largest count a quickbuy, like "jokke 12:3", may buy of one product.
+# Anything larger is taken to be a typo
+MAX_COUNT = 1000
+
+[cache]
+# The product lists, sales series and live dashboard events are kept here.
+# The default only lives inside one process. Running more than one process,
+# e.g. under Apache, REQUIRES a cache shared by all of them, or the live
+# dashboard misses sales and keeps reloading. Use
+# django.core.cache.backends.db.DatabaseCache with a table name as LOCATION
+# (make it with manage.py createcachetable)
+BACKEND = django.core.cache.backends.locmem.LocMemCache
+LOCATION =
 """
 
 cfg = SafeConfigParser()
@@ -144,6 +164,20 @@ DATABASES = {
     }
 }
 
+# The journal of the offline terminal mode, see stregsystem/offline.py
+OFFLINE_JOURNAL = cfg.get("offline", "JOURNAL") or None
+
+# See the [quickbuy] section of the defaults
+QUICKBUY_MAX_COUNT = cfg.getint("quickbuy", "MAX_COUNT")
+
+# Has to be shared by every process, see the [cache] section of the defaults
+CACHES = {
+    'default': {
+        'BACKEND': cfg.get("cache", "BACKEND"),
+        'LOCATION': cfg.get("cache", "LOCATION"),
+    }
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/1.10/ref/settings/#auth-password-validators
 